@@ -0,0 +1,75 @@
+"""
+Benchmark of the eager and the torch.compile embedding net per image size.
+
+The compile time is reported separately from the latency of a forward pass.
+FFT filter embeddings are built for each image size with the given frequency cutoff.
+
+Usage:
+    python benchmarks/benchmark_embedding_compile.py --embedding RESNET18_FFT_FILTER --image_sizes 128 256
+"""
+
+import argparse
+import time
+import timeit
+import torch
+
+from cryo_sbi.inference.models.embedding_nets import EMBEDDING_NETS
+from cryo_sbi.inference.models.estimator_models import NPEWithEmbedding
+
+
+def main():
+    cl_parser = argparse.ArgumentParser()
+    cl_parser.add_argument("--embedding", type=str, default="RESNET18_FFT_FILTER")
+    cl_parser.add_argument("--image_sizes", type=int, nargs="+", default=[128, 256])
+    cl_parser.add_argument("--frequency_cutoff", type=int, default=25)
+    cl_parser.add_argument("--batch_size", type=int, default=64)
+    cl_parser.add_argument("--out_dim", type=int, default=256)
+    cl_parser.add_argument("--repeats", type=int, default=5)
+    cl_parser.add_argument("--device", type=str, default="cpu")
+    args = cl_parser.parse_args()
+
+    print(
+        f"{'image_size':>10} {'eager [ms]':>11} {'compiled [ms]':>14}"
+        f" {'speedup':>8} {'compile [s]':>12}"
+    )
+    for image_size in args.image_sizes:
+        embedding_kwargs = {}
+        if "FFT_FILTER" in args.embedding:
+            embedding_kwargs = {
+                "image_size": image_size,
+                "frequency_cutoff": args.frequency_cutoff,
+            }
+        estimator = NPEWithEmbedding(
+            embedding_net=lambda: EMBEDDING_NETS[args.embedding](
+                args.out_dim, **embedding_kwargs
+            ),
+            output_embedding_dim=args.out_dim,
+        ).to(args.device)
+        estimator.eval()
+        images = torch.randn(
+            args.batch_size, image_size, image_size, device=args.device
+        )
+
+        def embed():
+            with torch.no_grad():
+                estimator.embed(images)
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+
+        embed()
+        time_eager = min(timeit.repeat(embed, number=1, repeat=args.repeats))
+
+        estimator.compile_embedding()
+        start = time.perf_counter()
+        embed()
+        time_compile = time.perf_counter() - start
+        time_compiled = min(timeit.repeat(embed, number=1, repeat=args.repeats))
+
+        print(
+            f"{image_size:>10} {1e3 * time_eager:>11.1f} {1e3 * time_compiled:>14.1f}"
+            f" {time_eager / time_compiled:>8.2f} {time_compile:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
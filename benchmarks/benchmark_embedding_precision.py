@@ -0,0 +1,58 @@
+"""
+Benchmark of the embedding networks in fp32, bf16 autocast and channels last.
+
+Reports images per second of the forward pass of the embedding in inference mode.
+
+Usage:
+    python benchmarks/benchmark_embedding_precision.py --embeddings RESNET18 ConvEncoder_Tutorial --num_pixels 64
+"""
+
+import argparse
+import timeit
+import torch
+
+from cryo_sbi.inference.models.embedding_nets import EMBEDDING_NETS
+from cryo_sbi.inference.models.estimator_models import NPEWithEmbedding
+
+MODES = [("fp32", False), ("fp32", True), ("bf16", False), ("bf16", True)]
+
+
+def main():
+    cl_parser = argparse.ArgumentParser()
+    cl_parser.add_argument("--embeddings", type=str, nargs="+", default=["RESNET18"])
+    cl_parser.add_argument("--num_pixels", type=int, default=128)
+    cl_parser.add_argument("--batch_size", type=int, default=256)
+    cl_parser.add_argument("--out_dim", type=int, default=256)
+    cl_parser.add_argument("--repeats", type=int, default=3)
+    cl_parser.add_argument("--device", type=str, default="cpu")
+    args = cl_parser.parse_args()
+
+    images = torch.randn(
+        args.batch_size, args.num_pixels, args.num_pixels, device=args.device
+    )
+    print(f"{'embedding':>24} {'precision':>10} {'channels_last':>14} {'images/s':>10}")
+    for name in args.embeddings:
+        estimator = NPEWithEmbedding(
+            embedding_net=lambda: EMBEDDING_NETS[name](args.out_dim),
+            output_embedding_dim=args.out_dim,
+        ).to(args.device)
+        estimator.eval()
+        for precision, channels_last in MODES:
+            estimator.set_precision(precision, channels_last)
+
+            def embed():
+                with torch.inference_mode():
+                    estimator.embed(images)
+                if args.device.startswith("cuda"):
+                    torch.cuda.synchronize()
+
+            embed()
+            seconds = min(timeit.repeat(embed, number=1, repeat=args.repeats))
+            print(
+                f"{name:>24} {precision:>10} {str(channels_last):>14}"
+                f" {args.batch_size / seconds:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark of LowPassFilter and Mask against the boolean-mask implementations.
+
+The reference low pass filter runs fft2, fftshift, a boolean scatter and ifft2, the
+reference mask a boolean scatter. Reports images per second.
+
+Usage:
+    python benchmarks/benchmark_image_transforms.py --image_sizes 128 256 --batch_size 256
+"""
+
+import argparse
+import timeit
+import torch
+
+from cryo_sbi.utils.image_utils import LowPassFilter, Mask, circular_mask
+
+
+def low_pass_filter_reference(images, mask):
+    fft_images = torch.fft.fftshift(torch.fft.fft2(images), dim=(-2, -1))
+    fft_images[:, mask] = 0
+    return torch.fft.ifft2(torch.fft.fftshift(fft_images, dim=(-2, -1))).real
+
+
+def mask_reference(images, mask):
+    images[:, mask] = 0
+    return images
+
+
+def main():
+    cl_parser = argparse.ArgumentParser()
+    cl_parser.add_argument("--image_sizes", type=int, nargs="+", default=[128, 256])
+    cl_parser.add_argument("--batch_size", type=int, default=256)
+    cl_parser.add_argument("--frequency_cutoff", type=int, default=25)
+    cl_parser.add_argument("--repeats", type=int, default=5)
+    cl_parser.add_argument("--device", type=str, default="cpu")
+    args = cl_parser.parse_args()
+
+    def images_per_second(function):
+        def run():
+            function()
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+
+        run()
+        return args.batch_size / min(timeit.repeat(run, number=1, repeat=args.repeats))
+
+    print(
+        f"{'image_size':>10} {'lowpass ref':>12} {'lowpass':>10}"
+        f" {'mask ref':>10} {'mask':>10}   [images/s]"
+    )
+    for image_size in args.image_sizes:
+        images = torch.randn(
+            args.batch_size, image_size, image_size, device=args.device
+        )
+        low_pass_filter = LowPassFilter(image_size, args.frequency_cutoff)
+        low_pass_filter.to(args.device)
+        low_pass_mask = circular_mask(image_size, args.frequency_cutoff).to(args.device)
+        mask = Mask(image_size, image_size // 2).to(args.device)
+        reference_mask = circular_mask(image_size, image_size // 2, inside=False).to(
+            args.device
+        )
+
+        print(
+            f"{image_size:>10}"
+            f" {images_per_second(lambda: low_pass_filter_reference(images, low_pass_mask)):>12.0f}"
+            f" {images_per_second(lambda: low_pass_filter(images)):>10.0f}"
+            f" {images_per_second(lambda: mask_reference(images, reference_mask)):>10.0f}"
+            f" {images_per_second(lambda: mask(images)):>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark of the log probability of a theta grid x image stack.
+
+Compares the previous per-batch evaluation, which repeats the full theta grid for
+every image batch and concatenates the results, with the tiled evaluate_log_prob.
+
+Usage:
+    python benchmarks/benchmark_log_prob.py --num_images 512 --num_eval 100 1000
+"""
+
+import argparse
+import json
+import timeit
+import torch
+
+from cryo_sbi.inference.models import build_models
+from cryo_sbi.utils.estimator_utils import evaluate_log_prob
+
+
+@torch.no_grad()
+def evaluate_log_prob_repeat(estimator, images, theta, batch_size, device):
+    log_probs = []
+    for image_batch in torch.split(images, batch_size, dim=0):
+        theta_batch = theta.reshape(-1, 1, 1).repeat(1, image_batch.shape[0], 1)
+        posterior = estimator.flow(image_batch.to(device))
+        log_probs.append(posterior.log_prob(estimator.standardize(theta_batch)))
+    return torch.cat(log_probs, dim=1)
+
+
+def main():
+    cl_parser = argparse.ArgumentParser()
+    cl_parser.add_argument(
+        "--config",
+        type=str,
+        default="tests/config_files/training_params_npe_testing.json",
+    )
+    cl_parser.add_argument("--num_images", type=int, default=256)
+    cl_parser.add_argument("--num_pixels", type=int, default=128)
+    cl_parser.add_argument("--num_eval", type=int, nargs="+", default=[100, 1000])
+    cl_parser.add_argument("--batch_size", type=int, default=128)
+    cl_parser.add_argument("--max_evaluations", type=int, default=2**16)
+    cl_parser.add_argument("--repeats", type=int, default=3)
+    cl_parser.add_argument("--device", type=str, default="cpu")
+    args = cl_parser.parse_args()
+
+    estimator = build_models.build_npe_flow_model(json.load(open(args.config)))
+    estimator.to(args.device).eval()
+    images = torch.randn(args.num_images, args.num_pixels, args.num_pixels)
+
+    print(f"{'num_eval':>9} {'repeat [s]':>11} {'tiled [s]':>10}")
+    for num_eval in args.num_eval:
+        theta = torch.linspace(0, 1, num_eval, device=args.device)
+        time_repeat = min(
+            timeit.repeat(
+                lambda: evaluate_log_prob_repeat(
+                    estimator, images, theta, args.batch_size, args.device
+                ),
+                number=1,
+                repeat=args.repeats,
+            )
+        )
+        time_tiled = min(
+            timeit.repeat(
+                lambda: evaluate_log_prob(
+                    estimator,
+                    images,
+                    theta,
+                    batch_size=args.batch_size,
+                    device=args.device,
+                    max_evaluations=args.max_evaluations,
+                ),
+                number=1,
+                repeat=args.repeats,
+            )
+        )
+        print(f"{num_eval:>9} {time_repeat:>11.3f} {time_tiled:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark of the average PSD of random micrograph patches.
+
+Compares one crop and fft2 per patch with batched patch extraction and rfft2.
+
+Usage:
+    python benchmarks/benchmark_micrograph_psd.py --num_patches 1024 --patch_sizes 64 128
+"""
+
+import argparse
+import random
+import timeit
+import torch
+import torchvision.transforms.functional as TF
+
+from cryo_sbi.utils.micrograph_utils import RandomMicrographPatches, compute_average_psd
+
+
+def average_psd_per_patch(micrograph, patch_size, num_patches):
+    avg_psd = torch.zeros(patch_size, patch_size)
+    for _ in range(num_patches):
+        top = random.randint(0, micrograph.shape[0] - patch_size)
+        left = random.randint(0, micrograph.shape[1] - patch_size)
+        patch = TF.crop(micrograph, top, left, patch_size, patch_size)
+        avg_psd += torch.abs(torch.fft.fft2(patch)) ** 2 / num_patches
+    return avg_psd
+
+
+def main():
+    cl_parser = argparse.ArgumentParser()
+    cl_parser.add_argument("--micrograph_size", type=int, default=4096)
+    cl_parser.add_argument("--patch_sizes", type=int, nargs="+", default=[64, 128])
+    cl_parser.add_argument("--num_patches", type=int, default=1024)
+    cl_parser.add_argument("--batch_size", type=int, default=256)
+    cl_parser.add_argument("--repeats", type=int, default=3)
+    args = cl_parser.parse_args()
+
+    micrograph = torch.randn(args.micrograph_size, args.micrograph_size)
+    print(f"{'patch_size':>10} {'per patch [s]':>14} {'batched [s]':>12}")
+    for patch_size in args.patch_sizes:
+        random_patches = RandomMicrographPatches(
+            [micrograph],
+            transform=None,
+            patch_size=patch_size,
+            max_iter=args.num_patches // args.batch_size,
+            batch_size=args.batch_size,
+        )
+        time_per_patch = min(
+            timeit.repeat(
+                lambda: average_psd_per_patch(micrograph, patch_size, args.num_patches),
+                number=1,
+                repeat=args.repeats,
+            )
+        )
+        time_batched = min(
+            timeit.repeat(
+                lambda: compute_average_psd(random_patches),
+                number=1,
+                repeat=args.repeats,
+            )
+        )
+        print(f"{patch_size:>10} {time_per_patch:>14.3f} {time_batched:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark of the dense and the chunked projection over atoms x pixels x batch.
+
+The memory column is the size of the Gaussian temporaries of each method. The chunked
+projection evaluates the Gaussians in one window per image, truncated after 5 sigma.
+
+Usage:
+    python benchmarks/benchmark_projection.py --num_atoms 500 2000 --num_pixels 128 256
+"""
+
+import argparse
+import itertools
+import timeit
+import torch
+
+from cryo_sbi.inference.priors import gen_quats
+from cryo_sbi.wpa_simulator.image_generation import (
+    gen_rot_matrix,
+    project_density,
+    project_density_chunked,
+    _pixel_windows,
+)
+
+
+def make_inputs(num_batch: int, num_atoms: int, device: str):
+    coords = 15 * torch.randn(num_batch, 3, num_atoms, device=device)
+    quats = gen_quats(num_batch, device=device)
+    sigma = 0.5 + 4.5 * torch.rand(num_batch, 1, 1, device=device)
+    shift = 10 * torch.randn(num_batch, 2, device=device)
+    return coords, quats, sigma, shift
+
+
+def window_width(coords, quats, sigma, shift, num_pixels, pixel_size):
+    coords_rot = torch.bmm(gen_rot_matrix(quats), coords)
+    coords_rot[:, :2, :] += shift.unsqueeze(-1)
+    margin = 5.0 * sigma.reshape(-1)
+    grid_min = -pixel_size * num_pixels * 0.5
+    width = 0
+    for dim in range(2):
+        lower, upper = _pixel_windows(
+            coords_rot[:, dim, :], margin, grid_min, pixel_size, num_pixels
+        )
+        width = max(width, int((upper - lower).max()))
+    return width
+
+
+def main():
+    cl_parser = argparse.ArgumentParser()
+    cl_parser.add_argument("--num_atoms", type=int, nargs="+", default=[500, 2000])
+    cl_parser.add_argument("--num_pixels", type=int, nargs="+", default=[128, 256])
+    cl_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[64, 256])
+    cl_parser.add_argument("--pixel_size", type=float, default=2.0)
+    cl_parser.add_argument("--max_memory", type=int, default=2**28)
+    cl_parser.add_argument("--repeats", type=int, default=3)
+    cl_parser.add_argument("--device", type=str, default="cpu")
+    args = cl_parser.parse_args()
+
+    print(
+        f"{'atoms':>6} {'pixels':>6} {'batch':>6} {'dense [s]':>10} {'dense [MB]':>11}"
+        f" {'chunked [s]':>12} {'chunked [MB]':>13}"
+    )
+    for num_atoms, num_pixels, num_batch in itertools.product(
+        args.num_atoms, args.num_pixels, args.batch_sizes
+    ):
+        coords, quats, sigma, shift = make_inputs(num_batch, num_atoms, args.device)
+        pixels = torch.tensor(num_pixels, device=args.device)
+        pixel_size = torch.tensor(args.pixel_size, device=args.device)
+
+        dense_memory = 2 * num_batch * num_pixels * num_atoms * 4
+        width = window_width(coords, quats, sigma, shift, num_pixels, args.pixel_size)
+        chunked_memory = min(2 * num_batch * width * num_atoms * 4, args.max_memory)
+        if dense_memory > 4 * args.max_memory:
+            time_dense = float("nan")
+        else:
+            time_dense = min(
+                timeit.repeat(
+                    lambda: project_density(
+                        coords.clone(), quats, sigma, shift, pixels, pixel_size
+                    ),
+                    number=1,
+                    repeat=args.repeats,
+                )
+            )
+        time_chunked = min(
+            timeit.repeat(
+                lambda: project_density_chunked(
+                    coords,
+                    quats,
+                    sigma,
+                    shift,
+                    pixels,
+                    pixel_size,
+                    max_memory=args.max_memory,
+                ),
+                number=1,
+                repeat=args.repeats,
+            )
+        )
+        print(
+            f"{num_atoms:>6} {num_pixels:>6} {num_batch:>6} {time_dense:>10.3f}"
+            f" {dense_memory / 2**20:>11.1f} {time_chunked:>12.3f}"
+            f" {chunked_memory / 2**20:>13.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
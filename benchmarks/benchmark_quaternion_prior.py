@@ -0,0 +1,44 @@
+"""
+Benchmark of the batched quaternion sampler against the per-sample rejection loop.
+
+Usage:
+    python benchmarks/benchmark_quaternion_prior.py --batch_sizes 256 1024 4096
+"""
+
+import argparse
+import timeit
+import torch
+
+from cryo_sbi.inference.priors import gen_quat, gen_quats
+
+
+def sample_loop(num_quats: int) -> torch.Tensor:
+    return torch.stack([gen_quat() for _ in range(num_quats)], dim=0)
+
+
+def main():
+    cl_parser = argparse.ArgumentParser()
+    cl_parser.add_argument(
+        "--batch_sizes", type=int, nargs="+", default=[256, 1024, 4096]
+    )
+    cl_parser.add_argument("--repeats", type=int, default=5)
+    args = cl_parser.parse_args()
+
+    print(f"{'batch_size':>10} {'loop [ms]':>12} {'batched [ms]':>14} {'speedup':>9}")
+    for batch_size in args.batch_sizes:
+        time_loop = min(
+            timeit.repeat(
+                lambda: sample_loop(batch_size), number=1, repeat=args.repeats
+            )
+        )
+        time_batched = min(
+            timeit.repeat(lambda: gen_quats(batch_size), number=1, repeat=args.repeats)
+        )
+        print(
+            f"{batch_size:>10} {1e3 * time_loop:>12.3f} {1e3 * time_batched:>14.3f}"
+            f" {time_loop / time_batched:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
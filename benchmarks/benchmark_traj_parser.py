@@ -0,0 +1,119 @@
+"""
+Benchmark of the chunked trajectory conversion against the in-memory alignment with AlignTraj
+on a synthetic .trr trajectory.
+
+The memory column is the peak of the memory allocated by python and numpy during the conversion.
+
+Usage:
+    python benchmarks/benchmark_traj_parser.py --n_residues 500 --n_frames 2000
+"""
+
+import os
+import argparse
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import torch
+import MDAnalysis as mda
+from MDAnalysis.analysis import align
+from scipy.spatial.transform import Rotation
+
+from cryo_sbi.utils.generate_models import traj_parser
+
+
+def write_trajectory(
+    directory: str, n_residues: int, n_frames: int, atoms_per_residue: int
+):
+    rng = np.random.default_rng(0)
+    names = ["N", "CA", "C", "O", "CB", "CG", "CD", "CE"][:atoms_per_residue]
+    top_file = os.path.join(directory, "top.pdb")
+    with open(top_file, "w") as pdb_file:
+        coords = 30 * rng.standard_normal((atoms_per_residue * n_residues, 3))
+        for i, (x, y, z) in enumerate(coords):
+            name = names[i % atoms_per_residue]
+            pdb_file.write(
+                f"ATOM  {(i + 1) % 100000:>5d}  {name:<3s} ALA A{(i // atoms_per_residue + 1) % 10000:>4d}    "
+                f"{x:>8.3f}{y:>8.3f}{z:>8.3f}  1.00  0.00           {name[0]}\n"
+            )
+        pdb_file.write("END\n")
+
+    traj_file = os.path.join(directory, "traj.trr")
+    universe = mda.Universe(top_file)
+    positions = universe.atoms.positions.copy()
+    rotations = Rotation.random(n_frames, random_state=1).as_matrix()
+    with mda.Writer(traj_file, universe.atoms.n_atoms) as writer:
+        for rotation in rotations:
+            universe.atoms.positions = positions @ rotation.T + rng.standard_normal(
+                positions.shape
+            )
+            writer.write(universe.atoms)
+    return top_file, traj_file
+
+
+def traj_parser_in_memory(top_file: str, traj_file: str, output_file: str):
+    ref = mda.Universe(top_file)
+    ref.atoms.translate(-ref.atoms.center_of_mass())
+
+    mobile = mda.Universe(top_file, traj_file)
+    align.AlignTraj(mobile, ref, select="name CA", in_memory=True).run()
+
+    atomic_models = torch.zeros(
+        (mobile.trajectory.n_frames, 3, mobile.select_atoms("name CA").n_atoms)
+    )
+    for i in range(mobile.trajectory.n_frames):
+        mobile.trajectory[i]
+        atomic_models[i, 0:3, :] = torch.from_numpy(
+            mobile.select_atoms("name CA").positions.T
+        )
+    torch.save(atomic_models, output_file)
+
+
+def measure(function, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 2**20
+
+
+def main():
+    cl_parser = argparse.ArgumentParser()
+    cl_parser.add_argument("--n_residues", type=int, default=500)
+    cl_parser.add_argument("--n_frames", type=int, default=2000)
+    cl_parser.add_argument("--atoms_per_residue", type=int, default=8)
+    cl_parser.add_argument("--chunk_size", type=int, default=256)
+    args = cl_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        top_file, traj_file = write_trajectory(
+            directory, args.n_residues, args.n_frames, args.atoms_per_residue
+        )
+        time_memory, peak_memory = measure(
+            traj_parser_in_memory,
+            top_file,
+            traj_file,
+            os.path.join(directory, "in_memory.pt"),
+        )
+        time_chunked, peak_chunked = measure(
+            traj_parser,
+            top_file,
+            traj_file,
+            os.path.join(directory, "chunked.npy"),
+            chunk_size=args.chunk_size,
+        )
+        difference = np.abs(
+            torch.load(os.path.join(directory, "in_memory.pt")).numpy()
+            - np.load(os.path.join(directory, "chunked.npy"))
+        ).max()
+
+    print(f"{'method':>10} {'time [s]':>10} {'peak [MB]':>10}")
+    print(f"{'in memory':>10} {time_memory:>10.2f} {peak_memory:>10.1f}")
+    print(f"{'chunked':>10} {time_chunked:>10.2f} {peak_chunked:>10.1f}")
+    print(f"max abs difference: {difference:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
+import os
 import argparse
 from cryo_sbi.inference.train_npe_model import (
     npe_train_no_saving,
+    npe_train_from_bank,
+    npe_train_distributed,
 )
 
 
@@ -44,10 +47,40 @@ def cl_npe_train_no_saving():
         required=False,
         default=1024,
     )
+    cl_parser.add_argument(
+        "--prefetch_batches", action="store", type=int, required=False, default=0
+    )
+    cl_parser.add_argument(
+        "--simulation_workers", action="store", type=int, required=False, default=0
+    )
+    cl_parser.add_argument(
+        "--num_processes", action="store", type=int, required=False, default=1
+    )
+    cl_parser.add_argument(
+        "--world_size", action="store", type=int, required=False, default=1
+    )
+    cl_parser.add_argument(
+        "--rank", action="store", type=int, required=False, default=0
+    )
+    cl_parser.add_argument(
+        "--master_port", action="store", type=int, required=False, default=None
+    )
+    cl_parser.add_argument(
+        "--seed", action="store", type=int, required=False, default=None
+    )
+    cl_parser.add_argument(
+        "--compile_embedding",
+        action="store",
+        type=bool,
+        nargs="?",
+        required=False,
+        const=True,
+        default=False,
+    )
 
     args = cl_parser.parse_args()
 
-    npe_train_no_saving(
+    train_kwargs = dict(
         image_config=args.image_config_file,
         train_config=args.train_config_file,
         epochs=args.epochs,
@@ -59,4 +92,79 @@ def cl_npe_train_no_saving():
         device=args.train_device,
         saving_frequency=args.saving_freq,
         simulation_batch_size=args.simulation_batch_size,
+        prefetch_batches=args.prefetch_batches,
+        simulation_workers=args.simulation_workers,
+        seed=args.seed,
+        compile_embedding=args.compile_embedding,
+    )
+
+    if args.num_processes > 1:
+        assert args.world_size == 1, "Use either --num_processes or --world_size."
+        npe_train_distributed(
+            args.num_processes,
+            master_port=29500 if args.master_port is None else args.master_port,
+            **train_kwargs,
+        )
+    else:
+        if args.master_port is not None:
+            # npe_train_no_saving initializes the process group from the environment
+            os.environ["MASTER_PORT"] = str(args.master_port)
+        npe_train_no_saving(world_size=args.world_size, rank=args.rank, **train_kwargs)
+
+
+def cl_npe_train_from_bank():
+    cl_parser = argparse.ArgumentParser()
+
+    cl_parser.add_argument("--simulation_bank", action="store", type=str, required=True)
+    cl_parser.add_argument(
+        "--train_config_file", action="store", type=str, required=True
+    )
+    cl_parser.add_argument("--epochs", action="store", type=int, required=True)
+    cl_parser.add_argument("--estimator_file", action="store", type=str, required=True)
+    cl_parser.add_argument("--loss_file", action="store", type=str, required=True)
+    cl_parser.add_argument(
+        "--train_from_checkpoint",
+        action="store",
+        type=bool,
+        nargs="?",
+        required=False,
+        const=True,
+        default=False,
+    )
+    cl_parser.add_argument(
+        "--state_dict_file", action="store", type=str, required=False, default=False
+    )
+    cl_parser.add_argument(
+        "--n_workers", action="store", type=int, required=False, default=0
+    )
+    cl_parser.add_argument(
+        "--train_device", action="store", type=str, required=False, default="cpu"
+    )
+    cl_parser.add_argument(
+        "--saving_freq", action="store", type=int, required=False, default=20
+    )
+    cl_parser.add_argument(
+        "--compile_embedding",
+        action="store",
+        type=bool,
+        nargs="?",
+        required=False,
+        const=True,
+        default=False,
+    )
+
+    args = cl_parser.parse_args()
+
+    npe_train_from_bank(
+        simulation_bank=args.simulation_bank,
+        train_config=args.train_config_file,
+        epochs=args.epochs,
+        estimator_file=args.estimator_file,
+        loss_file=args.loss_file,
+        train_from_checkpoint=args.train_from_checkpoint,
+        model_state_dict=args.state_dict_file,
+        n_workers=args.n_workers,
+        device=args.train_device,
+        saving_frequency=args.saving_freq,
+        compile_embedding=args.compile_embedding,
     )
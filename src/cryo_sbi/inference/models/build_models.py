@@ -13,7 +13,7 @@ def build_npe_flow_model(config: dict, **embedding_kwargs) -> nn.Module:
 
     Args:
         config (dict): config file
-        embedding_kwargs (dict): kwargs for embedding net
+        embedding_kwargs (dict): kwargs for embedding net, added to EMBEDDING_KWARGS of the config
 
     Returns:
         estimator (nn.Module): NPE estimator
@@ -30,6 +30,7 @@ def build_npe_flow_model(config: dict, **embedding_kwargs) -> nn.Module:
             f"Model : {config['MODEL']} has not been implemented yet!"
         )
 
+    embedding_kwargs = {**config.get("EMBEDDING_KWARGS", {}), **embedding_kwargs}
     try:
         embedding = partial(
             EMBEDDING_NETS[config["EMBEDDING"]], config["OUT_DIM"], **embedding_kwargs
@@ -49,6 +50,8 @@ The following embeddings are implemented : {[key for key in EMBEDDING_NETS.keys(
         flow=model,
         theta_shift=config["THETA_SHIFT"],
         theta_scale=config["THETA_SCALE"],
+        precision=config.get("PRECISION", "fp32"),
+        channels_last=config.get("CHANNELS_LAST", False),
         **{"activation": partial(nn.LeakyReLU, 0.1)},
     )
 
@@ -235,7 +235,9 @@ class ShuffleNet_Encoder(nn.Module):
 
 @add_embedding("RESNET18_FFT_FILTER")
 class ResNet18_FFT_Encoder(nn.Module):
-    def __init__(self, output_dimension: int):
+    def __init__(
+        self, output_dimension: int, image_size: int = 128, frequency_cutoff: int = 25
+    ):
         super(ResNet18_FFT_Encoder, self).__init__()
         self.resnet = models.resnet18()
         self.resnet.conv1 = nn.Conv2d(
@@ -245,7 +247,7 @@ class ResNet18_FFT_Encoder(nn.Module):
             in_features=512, out_features=output_dimension, bias=True
         )
 
-        self._fft_filter = LowPassFilter(128, 25)
+        self._fft_filter = LowPassFilter(image_size, frequency_cutoff)
 
     def forward(self, x):
         # Low pass filter images
@@ -257,72 +259,27 @@ class ResNet18_FFT_Encoder(nn.Module):
 
 
 @add_embedding("RESNET18_FFT_FILTER_132")
-class ResNet18_FFT_Encoder_132(nn.Module):
+class ResNet18_FFT_Encoder_132(ResNet18_FFT_Encoder):
     def __init__(self, output_dimension: int):
-        super(ResNet18_FFT_Encoder_132, self).__init__()
-        self.resnet = models.resnet18()
-        self.resnet.conv1 = nn.Conv2d(
-            1, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False
-        )
-        self.resnet.fc = nn.Linear(
-            in_features=512, out_features=output_dimension, bias=True
+        super(ResNet18_FFT_Encoder_132, self).__init__(
+            output_dimension, image_size=132, frequency_cutoff=25
         )
 
-        self._fft_filter = LowPassFilter(132, 25)
-
-    def forward(self, x):
-        # Low pass filter images
-        x = self._fft_filter(x)
-        # Proceed as normal
-        x = x.unsqueeze(1)
-        x = self.resnet(x)
-        return x
-
 
 @add_embedding("RESNET18_FFT_FILTER_224")
-class ResNet18_FFT_Encoder_224(nn.Module):
+class ResNet18_FFT_Encoder_224(ResNet18_FFT_Encoder):
     def __init__(self, output_dimension: int):
-        super(ResNet18_FFT_Encoder_224, self).__init__()
-        self.resnet = models.resnet18()
-        self.resnet.conv1 = nn.Conv2d(
-            1, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False
-        )
-        self.resnet.fc = nn.Linear(
-            in_features=512, out_features=output_dimension, bias=True
+        super(ResNet18_FFT_Encoder_224, self).__init__(
+            output_dimension, image_size=224, frequency_cutoff=25
         )
 
-        self._fft_filter = LowPassFilter(224, 25)
-
-    def forward(self, x):
-        # Low pass filter images
-        x = self._fft_filter(x)
-        # Proceed as normal
-        x = x.unsqueeze(1)
-        x = self.resnet(x)
-        return x
-
 
 @add_embedding("RESNET18_FFT_FILTER_256")
-class ResNet18_FFT_Encoder_256(nn.Module):
+class ResNet18_FFT_Encoder_256(ResNet18_FFT_Encoder):
     def __init__(self, output_dimension: int):
-        super(ResNet18_FFT_Encoder_256, self).__init__()
-        self.resnet = models.resnet18()
-        self.resnet.conv1 = nn.Conv2d(
-            1, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False
+        super(ResNet18_FFT_Encoder_256, self).__init__(
+            output_dimension, image_size=256, frequency_cutoff=10
         )
-        self.resnet.fc = nn.Linear(
-            in_features=512, out_features=output_dimension, bias=True
-        )
-
-        self._fft_filter = LowPassFilter(256, 10)
-
-    def forward(self, x):
-        # Low pass filter images
-        x = self._fft_filter(x)
-        # Proceed as normal
-        x = x.unsqueeze(1)
-        x = self.resnet(x)
-        return x
 
 
 @add_embedding("RESNET34")
@@ -343,10 +300,12 @@ class ResNet34_Encoder(nn.Module):
         return x
 
 
-@add_embedding("RESNET34_FFT_FILTER_256")
-class ResNet34_Encoder_FFT_FILTER_256(nn.Module):
-    def __init__(self, output_dimension: int):
-        super(ResNet34_Encoder_FFT_FILTER_256, self).__init__()
+@add_embedding("RESNET34_FFT_FILTER")
+class ResNet34_FFT_Encoder(nn.Module):
+    def __init__(
+        self, output_dimension: int, image_size: int = 128, frequency_cutoff: int = 25
+    ):
+        super(ResNet34_FFT_Encoder, self).__init__()
         self.resnet = models.resnet34()
         self.resnet.conv1 = nn.Conv2d(
             1, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False
@@ -354,7 +313,7 @@ class ResNet34_Encoder_FFT_FILTER_256(nn.Module):
         self.resnet.fc = nn.Linear(
             in_features=512, out_features=output_dimension, bias=True
         )
-        self._fft_filter = LowPassFilter(256, 50)
+        self._fft_filter = LowPassFilter(image_size, frequency_cutoff)
 
     def forward(self, x):
         # Low pass filter images
@@ -365,6 +324,14 @@ class ResNet34_Encoder_FFT_FILTER_256(nn.Module):
         return x
 
 
+@add_embedding("RESNET34_FFT_FILTER_256")
+class ResNet34_Encoder_FFT_FILTER_256(ResNet34_FFT_Encoder):
+    def __init__(self, output_dimension: int):
+        super(ResNet34_Encoder_FFT_FILTER_256, self).__init__(
+            output_dimension, image_size=256, frequency_cutoff=50
+        )
+
+
 @add_embedding("VGG19")
 class VGG19_Encoder(nn.Module):
     def __init__(self, output_dimension: int):
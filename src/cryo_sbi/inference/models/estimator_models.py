@@ -1,8 +1,11 @@
+from typing import Union
 import torch
 import torch.nn as nn
 import zuko
 from lampe.inference import NPE, NRE
 
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
 
 class Standardize(nn.Module):
     """
@@ -71,6 +74,8 @@ class NPEWithEmbedding(nn.Module):
         flow: nn.Module = zuko.flows.MAF,
         theta_shift: float = 0.0,
         theta_scale: float = 1.0,
+        precision: str = "fp32",
+        channels_last: bool = False,
         **kwargs,
     ) -> None:
         """
@@ -85,6 +90,8 @@ class NPEWithEmbedding(nn.Module):
             flow (nn.Module, optional): flow. Defaults to zuko.flows.MAF.
             theta_shift (float, optional): Shift of the theta for standardization. Defaults to 0.0.
             theta_scale (float, optional): Scale of the theta for standardization. Defaults to 1.0.
+            precision (str, optional): Autocast precision of the embedding net, "fp32", "bf16" or "fp16". Defaults to "fp32".
+            channels_last (bool, optional): Use channels last memory format in the embedding net. Defaults to False.
             kwargs: additional arguments for the flow
 
         Returns:
@@ -104,6 +111,88 @@ class NPEWithEmbedding(nn.Module):
 
         self.embedding = embedding_net()
         self.standardize = Standardize(theta_shift, theta_scale)
+        self.set_precision(precision, channels_last)
+        # kept out of the submodules so the state dict does not change
+        object.__setattr__(self, "_compiled_embedding", None)
+
+    def compile_embedding(self, **compile_kwargs) -> None:
+        """
+        Compiles the embedding net, including its preprocessing, with torch.compile.
+        The compiled net shares the parameters with the embedding net.
+
+        Args:
+            compile_kwargs: keyword arguments passed to torch.compile.
+
+        Returns:
+            None
+        """
+
+        object.__setattr__(
+            self, "_compiled_embedding", torch.compile(self.embedding, **compile_kwargs)
+        )
+
+    def trace_embedding(
+        self, example_images: torch.Tensor, path: Union[str, None] = None
+    ) -> torch.jit.ScriptModule:
+        """
+        Exports the embedding net, including its preprocessing, as a TorchScript trace.
+
+        Args:
+            example_images (torch.Tensor): Images with the shape used for inference.
+            path (str, optional): File to save the traced embedding net to. Defaults to None.
+
+        Returns:
+            torch.jit.ScriptModule: The traced embedding net.
+        """
+
+        with torch.no_grad():
+            traced_embedding = torch.jit.trace(self.embedding, example_images)
+        if path is not None:
+            traced_embedding.save(path)
+        return traced_embedding
+
+    def set_precision(self, precision: str = "fp32", channels_last: bool = False):
+        """
+        Sets the execution mode of the embedding net. The flow always runs in fp32.
+
+        Args:
+            precision (str, optional): Autocast precision of the embedding net, "fp32", "bf16" or "fp16". Defaults to "fp32".
+            channels_last (bool, optional): Use channels last memory format in the embedding net. Defaults to False.
+
+        Returns:
+            None
+        """
+
+        if precision not in PRECISIONS:
+            raise NotImplementedError(
+                f"Precision : {precision} has not been implemented yet! \
+The following precisions are implemented : {list(PRECISIONS.keys())}"
+            )
+        self.precision = precision
+        self.channels_last = channels_last
+        memory_format = (
+            torch.channels_last if channels_last else torch.contiguous_format
+        )
+        self.embedding.to(memory_format=memory_format)
+
+    def embed(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Computes the embedding of the images in the precision of the embedding net.
+
+        Args:
+            x (torch.Tensor): Images to embed.
+
+        Returns:
+            torch.Tensor: Embedding in fp32.
+        """
+
+        dtype = PRECISIONS[self.precision]
+        embedding_net = self.embedding
+        if self._compiled_embedding is not None:
+            embedding_net = self._compiled_embedding
+        with torch.autocast(x.device.type, dtype=dtype, enabled=dtype is not None):
+            embedding = embedding_net(x)
+        return embedding.float()
 
     def forward(self, theta: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
         """
@@ -117,31 +206,37 @@ class NPEWithEmbedding(nn.Module):
             torch.Tensor: Log probability of the posterior.
         """
 
-        return self.npe(self.standardize(theta), self.embedding(x))
+        return self.npe(self.standardize(theta), self.embed(x))
 
-    def flow(self, x: torch.Tensor):
+    def flow(self, x: torch.Tensor, precomputed_embedding: bool = False):
         """
         Conditions the posterior on an image.
 
         Args:
             x (torch.Tensor): Image to condition the posterior on.
+            precomputed_embedding (bool, optional): x is the embedding of the image. Defaults to False.
 
         Returns:
             zuko.flows.Flow: The posterior distribution.
         """
-        return self.npe.flow(self.embedding(x))
+        if precomputed_embedding:
+            return self.npe.flow(x.float())
+        return self.npe.flow(self.embed(x))
 
-    def sample(self, x: torch.Tensor, shape=(1,)) -> torch.Tensor:
+    def sample(
+        self, x: torch.Tensor, shape=(1,), precomputed_embedding: bool = False
+    ) -> torch.Tensor:
         """
         Generate samples from the posterior distribution.
 
         Args:
             x (torch.Tensor): Image to condition the posterior on.
             shape (tuple, optional): Shape of the samples. Defaults to (1,).
+            precomputed_embedding (bool, optional): x is the embedding of the image. Defaults to False.
 
         Returns:
             torch.Tensor: Samples from the posterior distribution.
         """
 
-        samples_standardized = self.flow(x).sample(shape)
+        samples_standardized = self.flow(x, precomputed_embedding).sample(shape)
         return self.standardize.transform(samples_standardized)
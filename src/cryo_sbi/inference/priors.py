@@ -1,20 +1,82 @@
+from typing import Union
+import numpy as np
 import torch
 import zuko
 from torch.distributions.distribution import Distribution
-from torch.utils.data import DataLoader, Dataset, IterableDataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 
 
-def gen_quat() -> torch.Tensor:
+def get_generator(seed: int, *key: int, device: str = "cpu") -> torch.Generator:
+    """
+    Derives a random number generator from a seed and an integer key.
+
+    The seed of the generator is drawn from a numpy SeedSequence with the key as spawn key,
+    so generators with different keys give independent streams and the generator of any key,
+    e.g. (stream, batch_id), can be recreated without drawing the preceding ones.
+    Generators on different device types give different streams for the same seed and key.
+
+    Args:
+        seed (int): Root seed.
+        *key (int): Key of the generator, e.g. the id of the batch.
+        device (str, optional): Device of the generator. Defaults to "cpu".
+
+    Returns:
+        torch.Generator: Seeded generator.
+    """
+
+    sequence = np.random.SeedSequence(seed, spawn_key=key)
+    generator = torch.Generator(device=device)
+    generator.manual_seed(int(sequence.generate_state(1, dtype=np.uint64)[0] >> 1))
+    return generator
+
+
+GENERATOR_PURPOSES = ("prior", "noise")
+
+
+def batch_generator(
+    seed: int, stream: int, batch_id: int, purpose: str, device: str = "cpu"
+) -> torch.Generator:
+    """
+    Returns the generator of the parameters or of the noise of a simulation batch.
+
+    All seeded simulations, CryoEmSimulator.simulate and simulate_to_disk, the prior loader
+    and simulation of the training and SimulationWorkerPool, draw with these generators, so
+    the same seed, stream and batch_id give the same batch on every path.
+
+    Args:
+        seed (int): Root seed.
+        stream (int): Key of the stream, e.g. the rank of the training process.
+        batch_id (int): Number of the batch in the stream.
+        purpose (str): "prior" for the parameters or "noise" for the noise of the batch.
+        device (str, optional): Device of the generator. Defaults to "cpu".
+
+    Returns:
+        torch.Generator: Seeded generator.
+    """
+
+    if purpose not in GENERATOR_PURPOSES:
+        raise ValueError(
+            f"Unknown generator purpose {purpose}, use one of {GENERATOR_PURPOSES}."
+        )
+    return get_generator(
+        seed, stream, batch_id, GENERATOR_PURPOSES.index(purpose), device=device
+    )
+
+
+def gen_quat(generator: torch.Generator = None) -> torch.Tensor:
     """
     Generate a random quaternion.
 
+    Args:
+        generator (torch.Generator, optional): Random number generator. Defaults to None.
+
     Returns:
         quat (np.ndarray): Random quaternion
 
     """
     count = 0
     while count < 1:
-        quat = 2 * torch.rand(size=(4,)) - 1
+        quat = 2 * torch.rand(size=(4,), generator=generator) - 1
         norm = torch.sqrt(torch.sum(quat**2))
         if 0.2 <= norm <= 1.0:
             quat /= norm
@@ -23,6 +85,30 @@ def gen_quat() -> torch.Tensor:
     return quat
 
 
+def gen_quats(
+    num_quats: int, device: str = "cpu", generator: torch.Generator = None
+) -> torch.Tensor:
+    """
+    Generate a batch of random quaternions uniformly distributed on SO(3).
+
+    A normalized standard normal 4-vector is uniformly distributed on the
+    unit 3-sphere, which yields uniformly distributed rotations.
+
+    Args:
+        num_quats (int): Number of quaternions to generate.
+        device (str, optional): Device on which the quaternions are generated. Defaults to "cpu".
+        generator (torch.Generator, optional): Random number generator. Defaults to None.
+
+    Returns:
+        quats (torch.Tensor): Random quaternions of shape (num_quats, 4).
+    """
+
+    quats = torch.randn((num_quats, 4), device=device, generator=generator)
+    quats /= torch.linalg.vector_norm(quats, dim=1, keepdim=True)
+
+    return quats
+
+
 def get_image_priors(
     max_index, image_config: dict, device="cuda"
 ) -> zuko.distributions.BoxUniform:
@@ -104,11 +190,7 @@ def get_image_priors(
 
         snr_prior = zuko.distributions.BoxUniform(lower=lower, upper=upper, ndims=1)
 
-    amp_prior = zuko.distributions.BoxUniform(
-        lower=torch.tensor([[image_config["AMP"]]], dtype=torch.float32, device=device),
-        upper=torch.tensor([[image_config["AMP"]]], dtype=torch.float32, device=device),
-        ndims=1,
-    )
+    amp_prior = ConstantPrior([[image_config["AMP"]]], device)
 
     index_prior = zuko.distributions.BoxUniform(
         lower=torch.tensor([0], dtype=torch.float32, device=device),
@@ -137,12 +219,16 @@ def get_image_priors(
 
 
 class QuaternionPrior:
-    def __init__(self, device) -> None:
+    def __init__(self, device, generator: torch.Generator = None) -> None:
         self.device = device
-
-    def sample(self, shape) -> torch.Tensor:
-        quats = torch.stack(
-            [gen_quat().to(self.device) for _ in range(shape[0])], dim=0
+        self.generator = generator
+        self.event_shape = torch.Size([4])
+
+    def sample(self, shape, generator: torch.Generator = None) -> torch.Tensor:
+        quats = gen_quats(
+            shape[0],
+            device=self.device,
+            generator=self.generator if generator is None else generator,
         )
         return quats
 
@@ -151,13 +237,54 @@ class QuaternionTestPrior:
     def __init__(self, quat, device) -> None:
         self.device = device
         self.quat = torch.tensor(quat, device=device)
+        self.event_shape = torch.Size([4])
 
     def sample(self, shape) -> torch.Tensor:
         quats = torch.stack([self.quat for _ in range(shape[0])], dim=0)
         return quats
 
 
+class ConstantPrior:
+    def __init__(self, value, device) -> None:
+        self.device = device
+        self.value = torch.tensor(value, dtype=torch.float32, device=device)
+        self.event_shape = self.value.shape
+
+    def sample(self, shape) -> torch.Tensor:
+        return self.value.expand(*shape, *self.value.shape)
+
+
 class ImagePrior:
+    """
+    Joint prior over all simulation parameters.
+
+    Samples are drawn into a single packed tensor of shape (num_samples, num_parameters).
+    The columns of each parameter are given by the layout attribute, and the packed tensor
+    can be split into the list of parameters expected by the simulator with unpack.
+
+    Args:
+        index_prior: Prior over the model index.
+        quaternion_prior: Prior over the orientation.
+        sigma_prior: Prior over the standard deviation of the atom Gaussians.
+        shift_prior: Prior over the in-plane shift.
+        defocus_prior: Prior over the defocus.
+        b_factor_prior: Prior over the B-factor.
+        amp_prior: Prior over the amplitude contrast.
+        snr_prior: Prior over the log10 signal-to-noise ratio.
+        device: Device on which the samples are drawn.
+    """
+
+    parameter_names = (
+        "index",
+        "quaternion",
+        "sigma",
+        "shift",
+        "defocus",
+        "b_factor",
+        "amp",
+        "snr",
+    )
+
     def __init__(
         self,
         index_prior,
@@ -170,6 +297,7 @@ class ImagePrior:
         snr_prior,
         device,
     ) -> None:
+        self.device = device
         self.priors = [
             index_prior,
             quaternion_prior,
@@ -181,25 +309,130 @@ class ImagePrior:
             snr_prior,
         ]
 
-    def sample(self, shape) -> torch.Tensor:
-        samples = [prior.sample(shape) for prior in self.priors]
+        self._shapes = []
+        self.layout = {}
+        start = 0
+        for name, prior in zip(self.parameter_names, self.priors):
+            if isinstance(prior, Distribution):
+                shape = prior.batch_shape + prior.event_shape
+            else:
+                shape = prior.event_shape
+            self._shapes.append(shape)
+            self.layout[name] = slice(start, start + shape.numel())
+            start += shape.numel()
+        self.num_parameters = start
+
+    def sample_packed(
+        self, shape, pin_memory: bool = False, generator: torch.Generator = None
+    ) -> torch.Tensor:
+        """
+        Samples all parameters into one contiguous tensor.
+
+        Args:
+            shape (tuple): Shape of the batch, (num_samples,).
+            pin_memory (bool, optional): Allocate the samples in pinned memory, so they are copied to the GPU with one non-blocking copy. Only used by priors on the CPU. Defaults to False.
+            generator (torch.Generator, optional): Random number generator on the device of the prior. Defaults to None, which uses the global generator.
+
+        Returns:
+            torch.Tensor: Packed samples of shape (num_samples, num_parameters).
+        """
+
+        packed = torch.empty(
+            (shape[0], self.num_parameters),
+            dtype=torch.float32,
+            device=self.device,
+            pin_memory=pin_memory and torch.device(self.device).type == "cpu",
+        )
+        for prior, columns in zip(self.priors, self.layout.values()):
+            if isinstance(prior, ConstantPrior):
+                packed[:, columns] = prior.value.flatten()
+            elif isinstance(prior, zuko.distributions.BoxUniform):
+                low = prior.base_dist.low.flatten()
+                high = prior.base_dist.high.flatten()
+                samples = packed[:, columns].uniform_(generator=generator)
+                samples.mul_(high - low).add_(low)
+            elif isinstance(prior, QuaternionPrior):
+                packed[:, columns] = prior.sample(shape, generator=generator)
+            else:
+                packed[:, columns] = prior.sample(shape).reshape(shape[0], -1)
+
+        return packed
+
+    def unpack(self, packed: torch.Tensor) -> list:
+        """
+        Splits packed samples into views of the individual parameters.
+
+        Args:
+            packed (torch.Tensor): Packed samples of shape (num_samples, num_parameters).
+
+        Returns:
+            list: Parameters in the order index, quaternion, sigma, shift, defocus, b_factor, amp, snr.
+        """
+
+        return [
+            packed[:, columns].reshape(-1, *shape)
+            for shape, columns in zip(self._shapes, self.layout.values())
+        ]
+
+    def sample(self, shape, generator: torch.Generator = None) -> list:
+        samples = self.unpack(self.sample_packed(shape, generator=generator))
         return samples
 
 
 class PriorDataset(IterableDataset):
+    """
+    Infinite stream of batches sampled from a prior.
+
+    With a seed, batch number i of the stream is sampled with
+    batch_generator(seed, stream, i, "prior").
+    With multiple dataloader workers, worker w samples the batches w, w + num_workers, ...,
+    which the dataloader yields in order, so the stream does not depend on the number of
+    workers and every batch can be sampled again from its number.
+
+    Args:
+        prior (Distribution): Prior, an ImagePrior if packed or seed is used.
+        batch_shape (torch.Size, optional): Shape of a batch. Defaults to ().
+        packed (bool, optional): Yield packed samples, see ImagePrior.sample_packed. Defaults to False.
+        pin_memory (bool, optional): Sample packed batches into pinned memory. Defaults to False.
+        seed (int, optional): Seed of the stream. Defaults to None, which uses the global generator.
+        stream (int, optional): Key of the stream, e.g. the rank of the process. Defaults to 0.
+    """
+
     def __init__(
         self,
         prior: Distribution,
         batch_shape: torch.Size = (),
+        packed: bool = False,
+        pin_memory: bool = False,
+        seed: Union[int, None] = None,
+        stream: int = 0,
     ):
         super().__init__()
 
         self.prior = prior
         self.batch_shape = batch_shape
+        self.packed = packed
+        self.pin_memory = pin_memory
+        self.seed = seed
+        self.stream = stream
 
     def __iter__(self):
+        worker_info = get_worker_info()
+        batch_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
         while True:
-            theta = self.prior.sample(self.batch_shape)
+            kwargs = {}
+            if self.seed is not None:
+                kwargs["generator"] = batch_generator(
+                    self.seed, self.stream, batch_id, "prior", device=self.prior.device
+                )
+            if self.packed:
+                theta = self.prior.sample_packed(
+                    self.batch_shape, pin_memory=self.pin_memory, **kwargs
+                )
+            else:
+                theta = self.prior.sample(self.batch_shape, **kwargs)
+            batch_id += num_workers
             yield theta
 
 
@@ -208,10 +441,25 @@ class PriorLoader(DataLoader):
         self,
         prior: Distribution,
         batch_size: int = 2**8,  # 256
+        packed: bool = False,
+        seed: Union[int, None] = None,
+        stream: int = 0,
+        pin_memory: bool = False,
         **kwargs,
     ):
+        num_workers = kwargs.get("num_workers", 0)
+        # without workers packed batches are sampled pinned, otherwise the loader pins them
+        pin_in_dataset = pin_memory and packed and num_workers == 0
         super().__init__(
-            PriorDataset(prior, batch_shape=(batch_size,)),
+            PriorDataset(
+                prior,
+                batch_shape=(batch_size,),
+                packed=packed,
+                pin_memory=pin_in_dataset,
+                seed=seed,
+                stream=stream,
+            ),
             batch_size=None,
+            pin_memory=pin_memory and not pin_in_dataset,
             **kwargs,
         )
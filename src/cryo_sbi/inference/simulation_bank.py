@@ -0,0 +1,191 @@
+import os
+import json
+from typing import Union
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+
+
+class SimulationBankWriter:
+    """
+    Writes simulated images and packed parameters into a directory of .npy shards.
+
+    Each shard is preallocated on disk with its final size and filled through a memory map,
+    so images can be streamed to disk batch by batch. An index.json file describes the shards.
+
+    Args:
+        directory (str): Directory of the simulation bank. Created if it does not exist.
+        image_shape (tuple): Shape of a single image.
+        parameter_layout (dict): Column layout of the packed parameters, see ImagePrior.layout.
+    """
+
+    def __init__(self, directory: str, image_shape: tuple, parameter_layout: dict):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.image_shape = tuple(image_shape)
+        self.parameter_layout = {
+            name: [columns.start, columns.stop]
+            for name, columns in parameter_layout.items()
+        }
+        self.num_parameters = max(stop for _, stop in self.parameter_layout.values())
+        self.shards = []
+
+    def open_shard(self, num_simulations: int) -> tuple:
+        """
+        Creates a new shard on disk.
+
+        Args:
+            num_simulations (int): Number of simulations in the shard.
+
+        Returns:
+            tuple: Memory maps of the parameters (num_simulations, num_parameters)
+            and images (num_simulations, *image_shape) of the shard.
+        """
+
+        shard = {
+            "parameters": f"parameters_{len(self.shards):05d}.npy",
+            "images": f"images_{len(self.shards):05d}.npy",
+            "num_simulations": num_simulations,
+        }
+        parameters = np.lib.format.open_memmap(
+            os.path.join(self.directory, shard["parameters"]),
+            mode="w+",
+            dtype=np.float32,
+            shape=(num_simulations, self.num_parameters),
+        )
+        images = np.lib.format.open_memmap(
+            os.path.join(self.directory, shard["images"]),
+            mode="w+",
+            dtype=np.float32,
+            shape=(num_simulations, *self.image_shape),
+        )
+        self.shards.append(shard)
+        return parameters, images
+
+    def close(self) -> None:
+        """
+        Writes the index of the simulation bank.
+        """
+
+        index = {
+            "num_simulations": sum(shard["num_simulations"] for shard in self.shards),
+            "image_shape": list(self.image_shape),
+            "parameter_layout": self.parameter_layout,
+            "shards": self.shards,
+        }
+        with open(os.path.join(self.directory, "index.json"), "w") as index_file:
+            json.dump(index, index_file, indent=4)
+
+
+class SimulationBankDataset(IterableDataset):
+    """
+    Reads batches of parameters and images from a simulation bank.
+
+    Shards are opened as memory maps and every batch is a contiguous slice of a shard, so
+    batches are zero-copy views of the files. The order of the shards and of the batches
+    within each shard is shuffled every epoch. With multiple workers, the shards are split
+    between the workers.
+
+    The shuffling is drawn from the seed, the epoch counted by the dataset and the seed of the
+    dataloader worker, which changes every epoch for non-persistent workers. With a seed,
+    SimulationBankLoader seeds the dataloader, so the order of every epoch is reproducible.
+
+    Args:
+        directory (str): Directory of the simulation bank.
+        batch_size (int): Number of simulations per batch.
+        shuffle (bool, optional): Shuffle the order of shards and batches. Defaults to True.
+        seed (int, optional): Seed for the shuffling. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        batch_size: int,
+        shuffle: bool = True,
+        seed: Union[int, None] = None,
+    ):
+        super().__init__()
+        self.directory = directory
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self._epoch = 0
+        with open(os.path.join(directory, "index.json")) as index_file:
+            self.index = json.load(index_file)
+        self.parameter_layout = {
+            name: slice(*columns)
+            for name, columns in self.index["parameter_layout"].items()
+        }
+
+    def __len__(self) -> int:
+        return sum(
+            -(-shard["num_simulations"] // self.batch_size)
+            for shard in self.index["shards"]
+        )
+
+    def _load_shard(self, shard: dict) -> tuple:
+        # copy-on-write maps give writable arrays without reading the files
+        parameters = np.load(
+            os.path.join(self.directory, shard["parameters"]), mmap_mode="c"
+        )
+        images = np.load(os.path.join(self.directory, shard["images"]), mmap_mode="c")
+        return parameters, images
+
+    def __iter__(self):
+        shards = self.index["shards"]
+        worker_info = get_worker_info()
+        worker_seed = 0
+        if worker_info is not None:
+            shards = shards[worker_info.id :: worker_info.num_workers]
+            worker_seed = worker_info.seed
+
+        rng = np.random.default_rng(
+            None if self.seed is None else [self.seed, worker_seed, self._epoch]
+        )
+        self._epoch += 1
+
+        shard_order = np.arange(len(shards))
+        if self.shuffle:
+            rng.shuffle(shard_order)
+
+        for shard_idx in shard_order:
+            parameters, images = self._load_shard(shards[shard_idx])
+            batch_starts = np.arange(0, len(images), self.batch_size)
+            if self.shuffle:
+                rng.shuffle(batch_starts)
+            for start in batch_starts:
+                stop = start + self.batch_size
+                yield (
+                    torch.from_numpy(parameters[start:stop]),
+                    torch.from_numpy(images[start:stop]),
+                )
+
+
+class SimulationBankLoader(DataLoader):
+    """
+    Creates a dataloader of batches from a simulation bank.
+
+    Args:
+        directory (str): Directory of the simulation bank.
+        batch_size (int): Number of simulations per batch.
+        shuffle (bool, optional): Shuffle the order of shards and batches. Defaults to True.
+        seed (int, optional): Seed for the shuffling and of the dataloader. Defaults to None.
+        **kwargs: Keyword arguments passed to torch.utils.data.DataLoader.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        batch_size: int,
+        shuffle: bool = True,
+        seed: Union[int, None] = None,
+        **kwargs,
+    ):
+        if seed is not None and "generator" not in kwargs:
+            # the seeds of the workers are drawn from the generator every epoch
+            kwargs["generator"] = torch.Generator().manual_seed(seed)
+        super().__init__(
+            SimulationBankDataset(directory, batch_size, shuffle=shuffle, seed=seed),
+            batch_size=None,
+            **kwargs,
+        )
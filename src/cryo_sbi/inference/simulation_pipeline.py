@@ -0,0 +1,176 @@
+import time
+import queue
+import threading
+import contextlib
+from typing import Callable, Iterator
+import torch
+
+
+class ThroughputCounter:
+    """
+    Thread-safe counter of processed items and time spent in a pipeline stage.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Resets the counter.
+        """
+
+        with self._lock:
+            self.num_items = 0
+            self.seconds = 0.0
+
+    @contextlib.contextmanager
+    def measure(self, num_items: int = 0):
+        """
+        Context manager adding the time spent in the block and the processed items.
+
+        Args:
+            num_items (int, optional): Number of items processed in the block. Defaults to 0.
+        """
+
+        start = time.perf_counter()
+        yield
+        self.add(num_items, time.perf_counter() - start)
+
+    def add(self, num_items: int, seconds: float) -> None:
+        """
+        Adds processed items and the time spent processing them.
+
+        Args:
+            num_items (int): Number of processed items.
+            seconds (float): Time spent in seconds.
+        """
+
+        with self._lock:
+            self.num_items += num_items
+            self.seconds += seconds
+
+    @property
+    def rate(self) -> float:
+        """
+        Processed items per second spent in the stage.
+
+        Returns:
+            float: Throughput of the stage.
+        """
+
+        with self._lock:
+            return self.num_items / self.seconds if self.seconds > 0 else 0.0
+
+
+class SimulationPipeline:
+    """
+    Produces simulated training batches, optionally in a background thread.
+
+    With prefetch > 0, a producer thread simulates up to prefetch batches ahead into a
+    bounded queue while the consumer trains on the current batch. On CUDA devices the
+    producer runs on its own stream and the consumer waits for the batch with an event,
+    so simulation and training overlap on the device. With prefetch = 0 batches are
+    simulated serially when requested.
+
+    The counters simulation (images simulated per second of simulation) and waiting
+    (time the consumer spent blocked on the producer) show whether the simulation
+    is the bottleneck.
+
+    Args:
+        simulate_batch (Callable): Function without arguments returning a tuple of tensors, the first dimension is the batch.
+        prefetch (int, optional): Number of batches simulated ahead. Defaults to 0.
+        device (str, optional): Device on which the batches are simulated. Defaults to "cpu".
+    """
+
+    def __init__(
+        self,
+        simulate_batch: Callable[[], tuple],
+        prefetch: int = 0,
+        device: str = "cpu",
+    ) -> None:
+        self._simulate_batch = simulate_batch
+        self.prefetch = prefetch
+        self.device = torch.device(device)
+        self.simulation = ThroughputCounter()
+        self.waiting = ThroughputCounter()
+
+    def _simulate(self) -> tuple:
+        start = time.perf_counter()
+        batch = self._simulate_batch()
+        if self.device.type == "cuda":
+            torch.cuda.current_stream(self.device).synchronize()
+        self.simulation.add(len(batch[0]), time.perf_counter() - start)
+        return batch
+
+    def batches(self, num_batches: int) -> Iterator[tuple]:
+        """
+        Yields simulated batches.
+
+        Args:
+            num_batches (int): Number of batches to yield.
+
+        Yields:
+            tuple: Simulated batch.
+        """
+
+        if self.prefetch == 0:
+            for _ in range(num_batches):
+                yield self._simulate()
+            return
+
+        batch_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(
+            target=self._produce, args=(batch_queue, stop, num_batches), daemon=True
+        )
+        producer.start()
+        try:
+            for _ in range(num_batches):
+                with self.waiting.measure():
+                    batch, event = batch_queue.get()
+                if isinstance(batch, BaseException):
+                    raise batch
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    for tensor in batch:
+                        tensor.record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+            while producer.is_alive():
+                try:
+                    batch_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            producer.join()
+
+    def _produce(
+        self, batch_queue: queue.Queue, stop: threading.Event, num_batches: int
+    ) -> None:
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        try:
+            for _ in range(num_batches):
+                if stop.is_set():
+                    return
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self._simulate()
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = self._simulate()
+                self._put(batch_queue, stop, (batch, event))
+        except BaseException as error:
+            self._put(batch_queue, stop, (error, None))
+
+    @staticmethod
+    def _put(batch_queue: queue.Queue, stop: threading.Event, item: tuple) -> None:
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
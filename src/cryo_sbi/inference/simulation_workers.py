@@ -0,0 +1,232 @@
+import os
+import time
+import queue
+import itertools
+import traceback
+from typing import Union
+import torch
+import torch.multiprocessing as mp
+
+from cryo_sbi.inference.priors import get_image_priors, batch_generator
+from cryo_sbi.inference.simulation_pipeline import ThroughputCounter
+from cryo_sbi.wpa_simulator.cryo_em_simulator import (
+    cryo_em_simulator,
+    cryo_em_simulator_fourier,
+    load_whitening_filter,
+)
+from cryo_sbi.wpa_simulator.model_store import MemoryMappedModels
+
+
+def _simulation_worker(
+    models: Union[torch.Tensor, MemoryMappedModels],
+    image_config: dict,
+    images: torch.Tensor,
+    parameters: torch.Tensor,
+    free_slots: mp.Queue,
+    ready_slots: mp.Queue,
+    num_threads: int,
+    seed: Union[int, None],
+    stream: int,
+) -> None:
+    try:
+        torch.set_num_threads(num_threads)
+
+        image_prior = get_image_priors(len(models) - 1, image_config, device="cpu")
+        if image_config.get("FOURIER_SIMULATION", False):
+            simulator = cryo_em_simulator_fourier
+        else:
+            simulator = cryo_em_simulator
+        whitening_filter = load_whitening_filter(image_config)
+        num_pixels = torch.tensor(image_config["N_PIXELS"], dtype=torch.float32)
+        pixel_size = torch.tensor(image_config["PIXEL_SIZE"], dtype=torch.float32)
+
+        while True:
+            # the pool hands out the free slots with the number of the batch to simulate
+            item = free_slots.get()
+            if item is None:
+                return
+            slot, batch_id = item
+            start = time.perf_counter()
+            prior_generator, noise_generator = None, None
+            if seed is not None:
+                prior_generator = batch_generator(seed, stream, batch_id, "prior")
+                noise_generator = batch_generator(seed, stream, batch_id, "noise")
+            packed = image_prior.sample_packed(
+                (images.shape[1],), generator=prior_generator
+            )
+            images[slot] = simulator(
+                models,
+                *image_prior.unpack(packed),
+                num_pixels,
+                pixel_size,
+                max_projection_memory=image_config.get("MAX_PROJECTION_MEMORY"),
+                whitening_filter=whitening_filter,
+                generator=noise_generator,
+            )
+            parameters[slot] = packed
+            ready_slots.put((slot, batch_id, time.perf_counter() - start))
+    except BaseException:
+        ready_slots.put((None, None, traceback.format_exc()))
+
+
+class SimulationWorkerPool:
+    """
+    Simulates training batches in a pool of worker processes.
+
+    The model ensemble is placed once in shared memory, or memory mapped from disk by every
+    worker when it is a MemoryMappedModels, so the workers do not copy it. Every worker samples
+    the image prior and runs the whole simulator on the CPU, writing the packed parameters and the
+    images into a free slot of a ring buffer in shared memory. The training process only copies
+    finished batches out of the ring buffer, so the simulation runs on all cores next to training.
+
+    The workers are started on the first call of batches and keep simulating ahead into the free
+    slots between calls, until close is called. Every free slot is handed out with the number of
+    the next batch of the stream, and finished batches are held back until all preceding batches
+    are yielded, so the batches are yielded in the order of their number, counted from 0 after
+    every start, independently of the timing of the workers. The counters simulation (images simulated per
+    second of simulation in one worker) and waiting (time the consumer spent blocked on the
+    workers) have the same meaning as for SimulationPipeline.
+
+    Args:
+        models (Union[torch.Tensor, MemoryMappedModels]): Model ensemble on the CPU, see load_models.
+        image_config (dict): Image config of the simulation.
+        batch_size (int): Number of images per batch.
+        num_workers (int): Number of simulation processes.
+        num_slots (int, optional): Number of batches in the ring buffer. Defaults to 2 * num_workers.
+        device (str, optional): Device the batches are moved to. Defaults to "cpu".
+        num_threads (int, optional): Number of torch threads per worker. Defaults to the CPUs not used by the torch threads of the creating process, i.e. the training, divided by num_workers, and at least 1.
+        seed (int, optional): Seed of the simulations. Batch i of the stream is simulated with the generators batch_generator(seed, stream, i, purpose). Defaults to None.
+        stream (int, optional): Key of the stream, e.g. the rank of the process. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        models: Union[torch.Tensor, MemoryMappedModels],
+        image_config: dict,
+        batch_size: int,
+        num_workers: int,
+        num_slots: Union[int, None] = None,
+        device: str = "cpu",
+        num_threads: Union[int, None] = None,
+        seed: Union[int, None] = None,
+        stream: int = 0,
+    ) -> None:
+        if isinstance(models, torch.Tensor):
+            models = models.cpu().share_memory_()
+        self.models = models
+        self.image_config = image_config
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.num_slots = 2 * num_workers if num_slots is None else num_slots
+        self.device = torch.device(device)
+        if num_threads is None:
+            # the workers share the cores left by the threads of the training process
+            free_cpus = (os.cpu_count() or 1) - torch.get_num_threads()
+            num_threads = max(1, free_cpus // num_workers)
+        self.num_threads = num_threads
+        self.seed = seed
+        self.stream = stream
+        self.prior = get_image_priors(len(models) - 1, image_config, device="cpu")
+        self.simulation = ThroughputCounter()
+        self.waiting = ThroughputCounter()
+        self._workers = []
+
+    def start(self) -> None:
+        """
+        Allocates the ring buffer in shared memory and starts the workers.
+        """
+
+        if self._workers:
+            return
+        num_pixels = int(self.image_config["N_PIXELS"])
+        self._images = torch.empty(
+            self.num_slots, self.batch_size, num_pixels, num_pixels
+        ).share_memory_()
+        self._parameters = torch.empty(
+            self.num_slots, self.batch_size, self.prior.num_parameters
+        ).share_memory_()
+
+        context = mp.get_context("spawn")
+        self._free_slots = context.Queue()
+        self._ready_slots = context.Queue()
+        self._batch_ids = itertools.count()
+        self._next_batch_id = 0
+        self._finished = {}
+        for slot in range(self.num_slots):
+            self._free_slots.put((slot, next(self._batch_ids)))
+        for _ in range(self.num_workers):
+            worker = context.Process(
+                target=_simulation_worker,
+                args=(
+                    self.models,
+                    self.image_config,
+                    self._images,
+                    self._parameters,
+                    self._free_slots,
+                    self._ready_slots,
+                    self.num_threads,
+                    self.seed,
+                    self.stream,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def close(self) -> None:
+        """
+        Stops the workers.
+        """
+
+        for _ in self._workers:
+            self._free_slots.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _next_slot(self) -> int:
+        # batches finished ahead of their turn wait in their slots
+        while self._next_batch_id not in self._finished:
+            try:
+                slot, batch_id, result = self._ready_slots.get(timeout=1.0)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError("A simulation worker exited unexpectedly.")
+                continue
+            if slot is None:
+                raise RuntimeError(f"Simulation worker failed:\n{result}")
+            self.simulation.add(self.batch_size, result)
+            self._finished[batch_id] = slot
+        slot = self._finished.pop(self._next_batch_id)
+        self._next_batch_id += 1
+        return slot
+
+    def batches(self, num_batches: int):
+        """
+        Yields simulated batches.
+
+        Args:
+            num_batches (int): Number of batches to yield.
+
+        Yields:
+            tuple: Packed parameters (batch_size, num_parameters) and images (batch_size, num_pixels, num_pixels) on the device, see ImagePrior.unpack.
+        """
+
+        self.start()
+        for _ in range(num_batches):
+            with self.waiting.measure():
+                slot = self._next_slot()
+            # copy the batch out of the ring buffer before the slot is handed back
+            parameters = self._parameters[slot].to(self.device, copy=True)
+            images = self._images[slot].to(self.device, copy=True)
+            self._free_slots.put((slot, next(self._batch_ids)))
+            yield parameters, images
@@ -1,20 +1,34 @@
 from typing import Union
+import os
+import itertools
 import json
 import torch
-import numpy as np
 import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import TensorDataset
 from torchvision import transforms
 from tqdm import tqdm
 from lampe.data import JointLoader, H5Dataset
 from lampe.inference import NPELoss
 from lampe.utils import GDStep
-from itertools import islice
 
-from cryo_sbi.inference.priors import get_image_priors, PriorLoader
+from cryo_sbi.inference.priors import get_image_priors, batch_generator, PriorLoader
+from cryo_sbi.inference.simulation_bank import SimulationBankLoader
+from cryo_sbi.inference.simulation_pipeline import (
+    SimulationPipeline,
+    ThroughputCounter,
+)
+from cryo_sbi.inference.simulation_workers import SimulationWorkerPool
 from cryo_sbi.inference.models.build_models import build_npe_flow_model
 from cryo_sbi.inference.validate_train_config import check_train_params
-from cryo_sbi.wpa_simulator.cryo_em_simulator import cryo_em_simulator
+from cryo_sbi.wpa_simulator.cryo_em_simulator import (
+    cryo_em_simulator,
+    cryo_em_simulator_fourier,
+    load_whitening_filter,
+)
+from cryo_sbi.wpa_simulator.model_store import load_models
 from cryo_sbi.wpa_simulator.validate_image_config import check_image_params
 from cryo_sbi.inference.validate_train_config import check_train_params
 import cryo_sbi.utils.image_utils as img_utils
@@ -44,6 +58,96 @@ def load_model(
     return estimator
 
 
+def build_simulation_pipeline(
+    image_config: dict,
+    models,
+    simulation_batch_size: int,
+    device: str = "cpu",
+    n_workers: int = 0,
+    prefetch_batches: int = 0,
+    simulation_workers: int = 0,
+    seed: Union[int, None] = None,
+    stream: int = 0,
+) -> Union[SimulationPipeline, SimulationWorkerPool]:
+    """
+    Builds the simulation of the training batches.
+
+    With a seed, batch i of the stream is simulated with the generators
+    batch_generator(seed, stream, i, purpose), as CryoEmSimulator.simulate does on the CPU.
+
+    Args:
+        image_config (dict): image config of the simulation
+        models (Union[torch.Tensor, MemoryMappedModels]): model ensemble, on the CPU with simulation workers
+        simulation_batch_size (int): number of images simulated per batch
+        device (str, optional): device of the simulated batches. Defaults to "cpu".
+        n_workers (int, optional): number of workers of the prior loader. Defaults to 0.
+        prefetch_batches (int, optional): number of batches simulated in a background thread. Defaults to 0.
+        simulation_workers (int, optional): number of simulation processes, see SimulationWorkerPool. Defaults to 0.
+        seed (int, optional): seed for the simulations. Defaults to None.
+        stream (int, optional): key of the stream, e.g. the rank of the process. Defaults to 0.
+
+    Returns:
+        Union[SimulationPipeline, SimulationWorkerPool]: pipeline yielding packed parameters and images with batches, a SimulationWorkerPool must be closed.
+    """
+
+    if simulation_workers > 0:
+        return SimulationWorkerPool(
+            models,
+            image_config,
+            simulation_batch_size,
+            simulation_workers,
+            device=device,
+            seed=seed,
+            stream=stream,
+        )
+
+    image_prior = get_image_priors(len(models) - 1, image_config, device="cpu")
+    prior_loader = PriorLoader(
+        image_prior,
+        batch_size=simulation_batch_size,
+        packed=True,
+        num_workers=n_workers,
+        pin_memory=torch.device(device).type == "cuda",
+        seed=seed,
+        stream=stream,
+    )
+
+    num_pixels = torch.tensor(
+        image_config["N_PIXELS"], dtype=torch.float32, device=device
+    )
+    pixel_size = torch.tensor(
+        image_config["PIXEL_SIZE"], dtype=torch.float32, device=device
+    )
+
+    if image_config.get("FOURIER_SIMULATION", False):
+        simulator = cryo_em_simulator_fourier
+    else:
+        simulator = cryo_em_simulator
+    whitening_filter = load_whitening_filter(image_config)
+
+    prior_iterator = iter(prior_loader)
+    batch_ids = itertools.count()
+
+    def simulate_batch():
+        packed = next(prior_iterator).to(device, non_blocking=True)
+        batch_id = next(batch_ids)
+        generator = None
+        if seed is not None:
+            generator = batch_generator(seed, stream, batch_id, "noise", device=device)
+        images = simulator(
+            models,
+            *image_prior.unpack(packed),
+            num_pixels,
+            pixel_size,
+            max_projection_memory=image_config.get("MAX_PROJECTION_MEMORY"),
+            whitening_filter=whitening_filter,
+            generator=generator,
+        )
+        return packed, images
+
+    return SimulationPipeline(simulate_batch, prefetch=prefetch_batches, device=device)
+
+
 def npe_train_no_saving(
     image_config: str,
     train_config: str,
@@ -56,11 +160,22 @@ def npe_train_no_saving(
     device: str = "cpu",
     saving_frequency: int = 20,
     simulation_batch_size: int = 1024,
+    prefetch_batches: int = 0,
+    world_size: int = 1,
+    rank: int = 0,
+    seed: Union[int, None] = None,
+    compile_embedding: bool = False,
+    simulation_workers: int = 0,
 ) -> None:
     """
     Train NPE model by simulating training data on the fly.
     Saves model and loss to disk.
 
+    With world_size > 1 the model is trained data-parallel with torch.distributed on the
+    gloo backend. The process group is initialized from the MASTER_ADDR and MASTER_PORT
+    environment variables. Every rank simulates its own batches, gradients are
+    all-reduced, and only rank 0 saves the model and loss.
+
     Args:
         image_config (str): path to image config file
         train_config (str): path to train config file
@@ -72,7 +187,13 @@ def npe_train_no_saving(
         n_workers (int, optional): number of workers. Defaults to 1.
         device (str, optional): training device. Defaults to "cpu".
         saving_frequency (int, optional): frequency of saving model. Defaults to 20.
-        whiten_filter (Union[None, str], optional): path to whiten filter. Defaults to None.
+        simulation_batch_size (int, optional): number of images simulated per batch. Defaults to 1024.
+        prefetch_batches (int, optional): number of batches simulated in a background thread while training. Defaults to 0.
+        world_size (int, optional): number of data-parallel processes. Defaults to 1.
+        rank (int, optional): rank of this process. Defaults to 0.
+        seed (int, optional): seed for the simulations, every rank and batch draws from its own generators, see build_simulation_pipeline. Defaults to None.
+        compile_embedding (bool, optional): compile the embedding net with torch.compile. Defaults to False.
+        simulation_workers (int, optional): number of processes simulating the batches on the CPU, see SimulationWorkerPool. Defaults to 0, which simulates in the training process.
 
     Raises:
         Warning: No model state dict specified! --model_state_dict is empty
@@ -85,35 +206,191 @@ def npe_train_no_saving(
     check_train_params(train_config)
     image_config = json.load(open(image_config))
 
+    distributed = world_size > 1
+    if distributed:
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    if seed is not None:
+        # the global generator only initializes the network, the simulations draw from
+        # generators derived from the seed, the rank and the batch number
+        torch.manual_seed(seed + rank)
+
     assert simulation_batch_size >= train_config["BATCH_SIZE"]
     assert simulation_batch_size % train_config["BATCH_SIZE"] == 0
 
-    if image_config["MODEL_FILE"].endswith("npy"):
-        models = (
-            torch.from_numpy(
-                np.load(image_config["MODEL_FILE"]),
-            )
-            .to(device)
-            .to(torch.float32)
-        )
-    else:
-        models = torch.load(image_config["MODEL_FILE"]).to(device).to(torch.float32)
+    models = load_models(
+        image_config["MODEL_FILE"],
+        device="cpu" if simulation_workers > 0 else device,
+        mmap=image_config.get("MMAP_MODELS", False),
+        cache_size=image_config.get("MODEL_CACHE_SIZE", 0),
+    )
 
     image_prior = get_image_priors(len(models) - 1, image_config, device="cpu")
-    prior_loader = PriorLoader(
-        image_prior, batch_size=simulation_batch_size, num_workers=n_workers
+    simulation_pipeline = build_simulation_pipeline(
+        image_config,
+        models,
+        simulation_batch_size,
+        device=device,
+        n_workers=n_workers,
+        prefetch_batches=prefetch_batches,
+        simulation_workers=simulation_workers,
+        seed=seed,
+        stream=rank,
     )
 
-    num_pixels = torch.tensor(
-        image_config["N_PIXELS"], dtype=torch.float32, device=device
+    training = ThroughputCounter()
+
+    estimator = load_model(
+        train_config, model_state_dict, device, train_from_checkpoint
     )
-    pixel_size = torch.tensor(
-        image_config["PIXEL_SIZE"], dtype=torch.float32, device=device
+    if compile_embedding:
+        estimator.compile_embedding()
+
+    loss = NPELoss(DistributedDataParallel(estimator) if distributed else estimator)
+    optimizer = optim.AdamW(
+        estimator.parameters(), lr=train_config["LEARNING_RATE"], weight_decay=0.001
+    )
+    step = GDStep(optimizer, clip=train_config["CLIP_GRADIENT"])
+    mean_loss = []
+
+    if rank == 0:
+        print("Training neural netowrk:")
+    estimator.train()
+    try:
+        with tqdm(range(epochs), unit="epoch", disable=rank != 0) as tq:
+            for epoch in tq:
+                losses = []
+                for counter in (
+                    simulation_pipeline.simulation,
+                    simulation_pipeline.waiting,
+                ):
+                    counter.reset()
+                training.reset()
+                for parameters, images in simulation_pipeline.batches(100):
+                    indices = image_prior.unpack(parameters)[0]
+                    with training.measure(len(images)):
+                        for _indices, _images in zip(
+                            indices.split(train_config["BATCH_SIZE"]),
+                            images.split(train_config["BATCH_SIZE"]),
+                        ):
+                            losses.append(step(loss(_indices, _images)))
+                losses = torch.stack(losses).mean()
+                if distributed:
+                    dist.all_reduce(losses)
+                    losses /= world_size
+
+                tq.set_postfix(
+                    loss=losses.item(),
+                    sim_per_s=simulation_pipeline.simulation.rate,
+                    train_per_s=training.rate,
+                    wait_s=simulation_pipeline.waiting.seconds,
+                )
+                mean_loss.append(losses.item())
+                if epoch % saving_frequency == 0 and rank == 0:
+                    torch.save(
+                        estimator.state_dict(), estimator_file + f"_epoch={epoch}"
+                    )
+    finally:
+        # the simulation workers are stopped even if training fails
+        if simulation_workers > 0:
+            simulation_pipeline.close()
+
+    if rank == 0:
+        torch.save(estimator.state_dict(), estimator_file)
+        torch.save(torch.tensor(mean_loss), loss_file)
+    if distributed:
+        dist.destroy_process_group()
+
+
+def _npe_train_worker(rank: int, num_processes: int, train_kwargs: dict) -> None:
+    torch.set_num_threads(max(1, torch.get_num_threads() // num_processes))
+    npe_train_no_saving(world_size=num_processes, rank=rank, **train_kwargs)
+
+
+def npe_train_distributed(
+    num_processes: int,
+    master_addr: str = "127.0.0.1",
+    master_port: int = 29500,
+    **train_kwargs,
+) -> None:
+    """
+    Launches data-parallel NPE training with num_processes processes on this machine.
+    The CPU threads are split evenly between the processes.
+
+    Args:
+        num_processes (int): number of training processes.
+        master_addr (str, optional): address of the rank 0 process. Defaults to "127.0.0.1".
+        master_port (int, optional): free port for the process group. Defaults to 29500.
+        **train_kwargs: keyword arguments passed to npe_train_no_saving.
+
+    Returns:
+        None
+    """
+
+    if num_processes == 1:
+        npe_train_no_saving(**train_kwargs)
+        return
+
+    os.environ["MASTER_ADDR"] = master_addr
+    os.environ["MASTER_PORT"] = str(master_port)
+    mp.spawn(
+        _npe_train_worker,
+        args=(num_processes, train_kwargs),
+        nprocs=num_processes,
+        join=True,
+    )
+
+
+def npe_train_from_bank(
+    simulation_bank: str,
+    train_config: str,
+    epochs: int,
+    estimator_file: str,
+    loss_file: str,
+    train_from_checkpoint: bool = False,
+    model_state_dict: Union[str, None] = None,
+    n_workers: int = 0,
+    device: str = "cpu",
+    saving_frequency: int = 20,
+    compile_embedding: bool = False,
+) -> None:
+    """
+    Train NPE model on simulations stored in a simulation bank.
+    One epoch is one pass over the bank in shuffled shard order.
+    Saves model and loss to disk.
+
+    Args:
+        simulation_bank (str): path to simulation bank directory, see CryoEmSimulator.simulate_to_disk
+        train_config (str): path to train config file
+        epochs (int): number of epochs
+        estimator_file (str): path to estimator file
+        loss_file (str): path to loss file
+        train_from_checkpoint (bool, optional): train from checkpoint. Defaults to False.
+        model_state_dict (str, optional): path to pretrained model state dict. Defaults to None.
+        n_workers (int, optional): number of workers reading the bank. Defaults to 0.
+        device (str, optional): training device. Defaults to "cpu".
+        saving_frequency (int, optional): frequency of saving model. Defaults to 20.
+        compile_embedding (bool, optional): compile the embedding net with torch.compile. Defaults to False.
+
+    Returns:
+        None
+    """
+
+    train_config = json.load(open(train_config))
+    check_train_params(train_config)
+
+    bank_loader = SimulationBankLoader(
+        simulation_bank,
+        batch_size=train_config["BATCH_SIZE"],
+        num_workers=n_workers,
+        pin_memory=torch.device(device).type == "cuda",
     )
+    index_columns = bank_loader.dataset.parameter_layout["index"]
 
     estimator = load_model(
         train_config, model_state_dict, device, train_from_checkpoint
     )
+    if compile_embedding:
+        estimator.compile_embedding()
 
     loss = NPELoss(estimator)
     optimizer = optim.AdamW(
@@ -127,42 +404,15 @@ def npe_train_no_saving(
     with tqdm(range(epochs), unit="epoch") as tq:
         for epoch in tq:
             losses = []
-            for parameters in islice(prior_loader, 100):
-                (
-                    indices,
-                    quaternions,
-                    res,
-                    shift,
-                    defocus,
-                    b_factor,
-                    amp,
-                    snr,
-                ) = parameters
-                images = cryo_em_simulator(
-                    models,
-                    indices.to(device, non_blocking=True),
-                    quaternions.to(device, non_blocking=True),
-                    res.to(device, non_blocking=True),
-                    shift.to(device, non_blocking=True),
-                    defocus.to(device, non_blocking=True),
-                    b_factor.to(device, non_blocking=True),
-                    amp.to(device, non_blocking=True),
-                    snr.to(device, non_blocking=True),
-                    num_pixels,
-                    pixel_size,
-                )
-                for _indices, _images in zip(
-                    indices.split(train_config["BATCH_SIZE"]),
-                    images.split(train_config["BATCH_SIZE"]),
-                ):
-                    losses.append(
-                        step(
-                            loss(
-                                _indices.to(device, non_blocking=True),
-                                _images.to(device, non_blocking=True),
-                            )
+            for parameters, images in bank_loader:
+                losses.append(
+                    step(
+                        loss(
+                            parameters[:, index_columns].to(device, non_blocking=True),
+                            images.to(device, non_blocking=True),
                         )
                     )
+                )
             losses = torch.stack(losses)
 
             tq.set_postfix(loss=losses.mean().item())
@@ -20,10 +20,30 @@ def cl_models_to_tensor():
     cl_parser.add_argument(
         "--top_file", action="store", type=str, required=False, default=None
     )
+    cl_parser.add_argument(
+        "--n_workers", action="store", type=int, required=False, default=1
+    )
+    cl_parser.add_argument(
+        "--cache_dir", action="store", type=str, required=False, default=None
+    )
+    cl_parser.add_argument(
+        "--start_frame", action="store", type=int, required=False, default=None
+    )
+    cl_parser.add_argument(
+        "--stop_frame", action="store", type=int, required=False, default=None
+    )
+    cl_parser.add_argument(
+        "--stride", action="store", type=int, required=False, default=None
+    )
     args = cl_parser.parse_args()
     models_to_tensor(
         model_files=args.model_files,
         output_file=args.output_file,
         n_pdbs=args.n_pdbs,
-        top_file=args.top_file
+        top_file=args.top_file,
+        n_workers=args.n_workers,
+        cache_dir=args.cache_dir,
+        start_frame=args.start_frame,
+        stop_frame=args.stop_frame,
+        stride=args.stride,
     )
\ No newline at end of file
@@ -1,6 +1,12 @@
-import torch
+import os
 import json
+import hashlib
+import tempfile
+from typing import Callable, Union
+import numpy as np
+import torch
 from cryo_sbi.inference.models import build_models
+from cryo_sbi.utils.image_utils import MRCdataset, MRCloader
 
 
 @torch.no_grad()
@@ -10,47 +16,71 @@ def evaluate_log_prob(
     theta: torch.Tensor,
     batch_size: int = 0,
     device: str = "cpu",
+    precomputed_embeddings: bool = False,
+    max_evaluations: int = 2**20,
+    out: Union[torch.Tensor, None] = None,
 ) -> torch.Tensor:
     """
     Evaluates the log probability of a given set of images under a given estimator.
 
+    Each image batch is embedded once and the theta values are evaluated in tiles of at
+    most max_evaluations (theta, image) pairs, which are written into the output tensor.
+
     Args:
         estimator (torch.nn.Module): The posterior model to use for evaluation.
         images (torch.Tensor): The input images used to condition the posterior.
-        theta (torch.Tensor): The parameter values at which to evaluate the log probability.
+        theta (torch.Tensor): The parameter values at which to evaluate the log probability,
+            either a grid [num_eval] shared by all images or [num_eval, num_images, 1].
         batch_size (int, optional): The batch size for batching the images. Defaults to 0.
         device (str, optional): The device to use for computation. Defaults to "cpu".
+        precomputed_embeddings (bool, optional): images are embeddings from compute_cached_latent_repr. Defaults to False.
+        max_evaluations (int, optional): Maximum number of (theta, image) pairs evaluated at once. Defaults to 2**20.
+        out (torch.Tensor, optional): Output tensor of shape [num_eval, num_images]. Defaults to None.
 
     Returns:
-        torch.Tensor: The log probabilities of the images under the estimator.
+        torch.Tensor: The log probabilities [num_eval, num_images] of the images under the estimator.
     """
 
-    # batching images if necessary
-    if images.shape[0] > batch_size and batch_size > 0:
-        images = torch.split(images, split_size_or_sections=batch_size, dim=0)
-    else:
-        batch_size = images.shape[0]
-        images = [images]
+    num_images = images.shape[0]
+    if batch_size <= 0 or batch_size > num_images:
+        batch_size = num_images
 
     # theta dimensions [num_eval, num_images, 1]
     if theta.ndim == 3:
-        num_eval = theta.shape[0]
-        num_images = images.shape[0]
-        assert theta.shape == torch.Size([num_eval, num_images, 1])
+        assert theta.shape == torch.Size([theta.shape[0], num_images, 1])
+        per_image_theta = True
 
     elif theta.ndim == 2:
         raise IndexError("theta must have 3 dimensions [num_eval, num_images, 1]")
 
     elif theta.ndim == 1:
-        theta = theta.reshape(-1, 1, 1).repeat(1, batch_size, 1)
-
-    log_probs = []
-    for image_batch in images:
-        posterior = estimator.flow(image_batch.to(device))
-        log_probs.append(posterior.log_prob(estimator.standardize(theta.to(device))))
-
-    log_probs = torch.cat(log_probs, dim=1)
-    return log_probs
+        theta = theta.reshape(-1, 1, 1)
+        per_image_theta = False
+
+    num_eval = theta.shape[0]
+    if out is None:
+        out = torch.empty((num_eval, num_images), device=device)
+    assert out.shape == torch.Size([num_eval, num_images])
+
+    for start in range(0, num_images, batch_size):
+        image_batch = images[start : start + batch_size]
+        stop = start + image_batch.shape[0]
+        posterior = estimator.flow(
+            image_batch.to(device, non_blocking=True),
+            precomputed_embedding=precomputed_embeddings,
+        )
+
+        eval_chunk = max(1, max_evaluations // image_batch.shape[0])
+        for eval_start in range(0, num_eval, eval_chunk):
+            eval_stop = min(eval_start + eval_chunk, num_eval)
+            theta_tile = theta[eval_start:eval_stop]
+            if per_image_theta:
+                theta_tile = theta_tile[:, start:stop]
+            theta_tile = estimator.standardize(theta_tile.to(device))
+            theta_tile = theta_tile.expand(-1, image_batch.shape[0], -1)
+            out[eval_start:eval_stop, start:stop] = posterior.log_prob(theta_tile)
+
+    return out
 
 
 @torch.no_grad()
@@ -60,6 +90,7 @@ def sample_posterior(
     num_samples: int,
     batch_size: int = 100,
     device: str = "cpu",
+    precomputed_embeddings: bool = False,
 ) -> torch.Tensor:
     """
     Samples from the posterior distribution
@@ -70,6 +101,7 @@ def sample_posterior(
         num_samples (int): The number of samples to draw
         batch_size (int, optional): The batch size for sampling. Defaults to 100.
         device (str, optional): The device to use. Defaults to "cpu".
+        precomputed_embeddings (bool, optional): images are embeddings from compute_cached_latent_repr. Defaults to False.
 
     Returns:
         torch.Tensor: The posterior samples
@@ -85,13 +117,157 @@ def sample_posterior(
 
     for image_batch in images:
         samples = estimator.sample(
-            image_batch.to(device, non_blocking=True), shape=(num_samples,)
+            image_batch.to(device, non_blocking=True),
+            shape=(num_samples,),
+            precomputed_embedding=precomputed_embeddings,
         ).cpu()
         theta_samples.append(samples.reshape(-1, image_batch.shape[0]))
 
     return torch.cat(theta_samples, dim=1)
 
 
+def _open_stream_outputs(output_dir: str, shapes: dict, mode: str) -> dict:
+    return {
+        name: np.lib.format.open_memmap(
+            os.path.join(output_dir, f"{name}.npy"),
+            mode=mode,
+            dtype=np.float32,
+            shape=shape,
+        )
+        for name, shape in shapes.items()
+    }
+
+
+def _write_progress(output_dir: str, progress: dict) -> None:
+    progress_file = os.path.join(output_dir, "progress.json")
+    with open(progress_file + ".tmp", "w") as tmp_file:
+        json.dump(progress, tmp_file, indent=4)
+    os.replace(progress_file + ".tmp", progress_file)
+
+
+@torch.no_grad()
+def sample_posterior_streaming(
+    estimator: torch.nn.Module,
+    images: Union[MRCdataset, MRCloader],
+    output_dir: str,
+    num_samples: int,
+    batch_size: int = 100,
+    device: str = "cpu",
+    save_samples: bool = True,
+    quantiles: tuple = (0.025, 0.5, 0.975),
+    histogram_bins: Union[torch.Tensor, None] = None,
+    transform: Union[Callable, None] = None,
+) -> dict:
+    """
+    Samples from the posterior distribution of all particles in a set of MRC files.
+
+    Particle batches are read lazily from the files and the results are written batch by
+    batch into .npy files in output_dir, so neither the particles nor the samples need to
+    fit into memory. All outputs are stored per particle in the rows:
+    samples (num_particles, num_samples), mean and std (num_particles,),
+    quantiles (num_particles, num_quantiles) and, if histogram_bins is given,
+    histogram (num_particles, num_bins - 1) with the sample counts between the bin edges.
+
+    The number of finished particles is recorded in progress.json after every batch. Calling
+    the function again with the same output_dir and arguments resumes after the last batch.
+
+    Args:
+        estimator (torch.nn.Module): The posterior to use for sampling.
+        images (MRCdataset, MRCloader): The MRC files of the particles.
+        output_dir (str): Directory of the output files. Created if it does not exist.
+        num_samples (int): The number of samples to draw per particle.
+        batch_size (int, optional): The number of particles per batch. Defaults to 100.
+        device (str, optional): The device to use. Defaults to "cpu".
+        save_samples (bool, optional): Write the posterior samples. Defaults to True.
+        quantiles (tuple, optional): Quantiles of the posterior to write. Defaults to (0.025, 0.5, 0.975).
+        histogram_bins (torch.Tensor, optional): Bin edges of a histogram of the samples. Defaults to None.
+        transform (Callable, optional): Transform applied to each particle batch. Defaults to None.
+
+    Returns:
+        dict: The memory mapped outputs.
+    """
+
+    dataset = images.dataset if isinstance(images, MRCloader) else images
+    if dataset._index_map is None:
+        dataset.build_index_map()
+    num_particles = dataset.num_particles
+
+    shapes = {
+        "mean": (num_particles,),
+        "std": (num_particles,),
+        "quantiles": (num_particles, len(quantiles)),
+    }
+    if save_samples:
+        shapes["samples"] = (num_particles, num_samples)
+    if histogram_bins is not None:
+        histogram_bins = torch.as_tensor(histogram_bins, dtype=torch.float32)
+        shapes["histogram"] = (num_particles, len(histogram_bins) - 1)
+        histogram_bins = histogram_bins.to(device)
+    quantiles_tensor = torch.tensor(quantiles, dtype=torch.float32, device=device)
+
+    progress = {
+        "num_particles": num_particles,
+        "num_samples": num_samples,
+        "quantiles": list(quantiles),
+        "histogram_bins": (
+            None if histogram_bins is None else histogram_bins.cpu().tolist()
+        ),
+        "outputs": sorted(shapes.keys()),
+        "completed": 0,
+    }
+    progress_file = os.path.join(output_dir, "progress.json")
+    if os.path.exists(progress_file):
+        with open(progress_file) as f:
+            saved_progress = json.load(f)
+        completed = saved_progress.pop("completed")
+        progress.pop("completed")
+        if saved_progress != progress:
+            raise ValueError(
+                f"The outputs in {output_dir} were written with different arguments."
+            )
+        progress["completed"] = completed
+        outputs = _open_stream_outputs(output_dir, shapes, mode="r+")
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+        outputs = _open_stream_outputs(output_dir, shapes, mode="w+")
+        _write_progress(output_dir, progress)
+
+    for start in range(progress["completed"], num_particles, batch_size):
+        stop = min(start + batch_size, num_particles)
+        image_batch = dataset.get_image(np.arange(start, stop))
+        image_batch = image_batch.to(device, non_blocking=True)
+        if transform is not None:
+            image_batch = transform(image_batch)
+
+        samples = estimator.sample(image_batch, shape=(num_samples,))
+        samples = samples.reshape(num_samples, stop - start).T.contiguous()
+
+        summaries = {
+            "mean": samples.mean(dim=1),
+            "std": samples.std(dim=1),
+            "quantiles": torch.quantile(samples, quantiles_tensor, dim=1).T,
+        }
+        if save_samples:
+            summaries["samples"] = samples
+        if histogram_bins is not None:
+            bin_index = torch.bucketize(samples, histogram_bins, right=True)
+            counts = torch.zeros(
+                (stop - start, len(histogram_bins) + 1), device=samples.device
+            )
+            counts.scatter_add_(1, bin_index, torch.ones_like(samples))
+            # the last edge closes the last bin
+            counts[:, -2] += (samples == histogram_bins[-1]).sum(dim=1)
+            summaries["histogram"] = counts[:, 1:-1]
+
+        for name, summary in summaries.items():
+            outputs[name][start:stop] = summary.cpu().numpy()
+            outputs[name].flush()
+        progress["completed"] = stop
+        _write_progress(output_dir, progress)
+
+    return outputs
+
+
 @torch.no_grad()
 def compute_latent_repr(
     estimator: torch.nn.Module,
@@ -121,14 +297,134 @@ def compute_latent_repr(
         images = [images]
 
     for image_batch in images:
-        samples = estimator.embedding(image_batch.to(device, non_blocking=True)).cpu()
+        samples = estimator.embed(image_batch.to(device, non_blocking=True)).cpu()
         latent_space_samples.append(samples.reshape(image_batch.shape[0], -1))
 
     return torch.cat(latent_space_samples, dim=0)
 
 
+def hash_estimator(estimator: torch.nn.Module) -> str:
+    """
+    Computes a hash of the embedding net weights, buffers, module settings and precision
+    of an estimator.
+
+    Non-persistent buffers, e.g. the mask of a LowPassFilter, are not part of the state
+    dict and are hashed separately, the settings of the modules are hashed from their
+    extra_repr.
+
+    Args:
+        estimator (torch.nn.Module): Posterior model with an embedding net.
+
+    Returns:
+        str: Hex digest of the embedding net.
+    """
+
+    sha = hashlib.sha256(getattr(estimator, "precision", "fp32").encode())
+    for name, module in estimator.embedding.named_modules():
+        sha.update(f"{name}({module.extra_repr()})".encode())
+    tensors = estimator.embedding.state_dict()
+    tensors.update(estimator.embedding.named_buffers())
+    for name, tensor in tensors.items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def hash_images(images: torch.Tensor) -> str:
+    """
+    Computes a hash of the shape, data type and content of an image stack.
+
+    Args:
+        images (torch.Tensor): Image stack.
+
+    Returns:
+        str: Hex digest of the image stack.
+    """
+
+    sha = hashlib.sha256(f"{tuple(images.shape)}{images.dtype}".encode())
+    for image_batch in torch.split(images, 1024, dim=0):
+        sha.update(image_batch.cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+@torch.no_grad()
+def compute_cached_latent_repr(
+    estimator: torch.nn.Module,
+    images: torch.Tensor,
+    cache_dir: str,
+    batch_size: int = 100,
+    device: str = "cpu",
+    images_key: Union[str, None] = None,
+) -> torch.Tensor:
+    """
+    Computes the latent representation of images and caches it on disk.
+
+    The cache file is keyed by the hash of the embedding net weights and the image stack,
+    so a stack is embedded once per estimator and later calls memory map the file. The
+    returned embeddings can be passed to evaluate_log_prob and sample_posterior with
+    precomputed_embeddings=True, which then only run the flow.
+
+    Args:
+        estimator (torch.nn.Module): Posterior model for which to compute the latent representation.
+        images (torch.Tensor): The images to compute the latent representation for.
+        cache_dir (str): Directory of the cache files. Created if it does not exist.
+        batch_size (int, optional): The batch size to use. Defaults to 100.
+        device (str, optional): The device to use. Defaults to "cpu".
+        images_key (str, optional): Identifier of the image stack, e.g. its path, hashed instead of the images. Defaults to None.
+
+    Returns:
+        torch.Tensor: The memory mapped latent representation of the images.
+    """
+
+    if images_key is None:
+        images_key = hash_images(images)
+    else:
+        # hashed, so any identifier gives a distinct and valid file name
+        images_key = hashlib.sha256(images_key.encode()).hexdigest()
+    key = f"{hash_estimator(estimator)[:16]}_{images_key[:32]}"
+    cache_file = os.path.join(cache_dir, f"embeddings_{key}.npy")
+
+    if not os.path.exists(cache_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        # every process writes its own partial file, the last one replaces the cache
+        fd, partial_file = tempfile.mkstemp(
+            prefix=f"embeddings_{key}.", suffix=".partial.npy", dir=cache_dir
+        )
+        os.close(fd)
+        num_images = images.shape[0]
+        batch_size = batch_size if batch_size > 0 else max(num_images, 1)
+        try:
+            embeddings = None
+            # an empty stack is embedded as one empty batch to get the latent dimension
+            for start in range(0, max(num_images, 1), batch_size):
+                image_batch = images[start : start + batch_size]
+                latent = estimator.embed(image_batch.to(device, non_blocking=True))
+                latent = latent.flatten(start_dim=1).cpu().numpy()
+                if embeddings is None:
+                    embeddings = np.lib.format.open_memmap(
+                        partial_file,
+                        mode="w+",
+                        dtype=np.float32,
+                        shape=(num_images, latent.shape[1]),
+                    )
+                embeddings[start : start + batch_size] = latent
+            embeddings.flush()
+            del embeddings
+            os.replace(partial_file, cache_file)
+        except BaseException:
+            os.remove(partial_file)
+            raise
+
+    # copy-on-write maps give writable arrays without reading the file
+    return torch.from_numpy(np.load(cache_file, mmap_mode="c"))
+
+
 def load_estimator(
-    config_file_path: str, estimator_path: str, device: str = "cpu"
+    config_file_path: str,
+    estimator_path: str,
+    device: str = "cpu",
+    precision: Union[str, None] = None,
+    channels_last: Union[bool, None] = None,
 ) -> torch.nn.Module:
     """
     Loads a trained estimator.
@@ -137,12 +433,18 @@ def load_estimator(
         config_file_path (str): Path to the config file used to train the estimator.
         estimator_path (str): Path to the estimator.
         device (str, optional): The device to use. Defaults to "cpu".
+        precision (str, optional): Precision of the embedding net, overrides PRECISION of the config. Defaults to None.
+        channels_last (bool, optional): Channels last embedding net, overrides CHANNELS_LAST of the config. Defaults to None.
 
     Returns:
         torch.nn.Module: The loaded estimator.
     """
 
     train_config = json.load(open(config_file_path))
+    if precision is not None:
+        train_config["PRECISION"] = precision
+    if channels_last is not None:
+        train_config["CHANNELS_LAST"] = channels_last
     estimator = build_models.build_npe_flow_model(train_config)
     estimator.load_state_dict(
         torch.load(estimator_path, map_location=torch.device(device))
@@ -1,6 +1,10 @@
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Union
+import numpy as np
+from tqdm import tqdm
 import MDAnalysis as mda
-from MDAnalysis.analysis import align
 import torch
 
 
@@ -29,10 +33,112 @@ def pdb_parser_(fname: str) -> torch.tensor:
     return model
 
 
-def pdb_parser(file_formatter, n_pdbs, output_file, start_index=1):
+def _hash_file(fname: str) -> str:
+    """
+    Computes the sha256 digest of the content of a file.
+    """
+
+    digest = hashlib.sha256()
+    with open(fname, "rb") as model_file:
+        for block in iter(lambda: model_file.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _parse_pdb_cached(fname: str, cache_dir: Union[str, None] = None) -> np.ndarray:
+    """
+    Parses a pdb file with pdb_parser_, reusing the parsed model stored in cache_dir
+    under the content hash of the file if it exists.
+
+    Parameters
+    ----------
+    fname : str
+        The path to the pdb file.
+    cache_dir : str, optional
+        Directory of the parsed models. If None, the file is always parsed.
+
+    Returns
+    -------
+    model : np.ndarray
+        The coarse grained atomic model of the protein (3, N).
+    """
+
+    if cache_dir is None:
+        return pdb_parser_(fname).numpy()
+
+    cache_file = os.path.join(cache_dir, f"{_hash_file(fname)}.npy")
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    model = pdb_parser_(fname).numpy()
+    partial_file = f"{cache_file[:-4]}.{os.getpid()}.partial.npy"
+    np.save(partial_file, model)
+    os.replace(partial_file, cache_file)
+    return model
+
+
+def _parse_pdb_chunk(
+    fnames: list, start: int, output_file: str, cache_dir: Union[str, None] = None
+) -> int:
+    """
+    Parses a chunk of pdb files and writes the models into the rows start, start + 1, ...
+    of the memory mapped output file.
+    """
+
+    models = np.load(output_file, mmap_mode="r+")
+    for i, fname in enumerate(fnames):
+        model = _parse_pdb_cached(fname, cache_dir)
+        if model.shape != models.shape[1:]:
+            raise ValueError(
+                f"The model in {fname} has shape {model.shape}, "
+                f"expected {models.shape[1:]}."
+            )
+        models[start + i] = model
+    models.flush()
+    return len(fnames)
+
+
+def _models_file(output_file: str) -> str:
+    """
+    Returns the path of the .npy file the models are memory mapped to while they are written.
+    Models for a .pt output are written to a partial .npy file next to it.
+    """
+
+    if output_file.endswith("npy"):
+        return output_file
+    elif output_file.endswith("pt"):
+        return f"{output_file}.partial.npy"
+    else:
+        raise ValueError("Model file format not supported. Please use .pt or .npy.")
+
+
+def _finalize_models_file(models_file: str, output_file: str) -> None:
+    """
+    Converts the partial .npy file of a .pt output into the .pt file.
+    """
+
+    if models_file != output_file:
+        torch.save(torch.from_numpy(np.load(models_file, mmap_mode="c")), output_file)
+        os.remove(models_file)
+
+
+def pdb_parser(
+    file_formatter,
+    n_pdbs,
+    output_file,
+    start_index=1,
+    n_workers: int = 1,
+    cache_dir: Union[str, None] = None,
+):
     """
     Parses multiple pdb files and returns an coarsed grained model of the protein. The atomic model is a 5xN array, where N is the number of atoms or residues in the protein. The first three rows are the x, y, z coordinates of the atoms or residues. The fourth row is the atomic number of the atoms or the density of the residues. The fifth row is the variance of the atoms or residues, which is the resolution of the cryo-EM map divided by pi squared.
 
+    The models are written into a memory mapped .npy file preallocated with the final shape, so the
+    ensemble never has to fit in memory twice. With n_workers > 1 the files are parsed by a process pool,
+    every worker writing its chunk of models straight into the output file. With a cache_dir, every parsed
+    model is stored under the content hash of its pdb file, so re-running on a partially changed set of
+    files only parses the new or modified ones.
+
     Parameters
     ----------
     file_formatter : str
@@ -40,36 +146,155 @@ def pdb_parser(file_formatter, n_pdbs, output_file, start_index=1):
     n_pdbs : int
         The number of pdb files to parse.
     output_file : str
-        The path to the output file. The output file must be a .pt file.
-    mode : str
-        The mode of the atomic model. Either "resid" or "all atom". Resid mode returns a coarse grained atomic model of the protein. All atom mode returns an all atom atomic model of the protein.
+        The path to the output file. The output file must be a .pt or .npy file.
+    start_index : int
+        The index of the first pdb file.
+    n_workers : int
+        The number of processes parsing the pdb files. Defaults to 1, which parses the files in this process.
+    cache_dir : str
+        Directory of the cache of parsed models. Defaults to None, which disables the cache.
     """
 
-    models = pdb_parser_(file_formatter.format(start_index))
-    models = torch.zeros((n_pdbs, *models.shape))
-
-    for i in range(0, n_pdbs):
-        models[i] = pdb_parser_(file_formatter.format(start_index + i))
+    models_file = _models_file(output_file)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
 
-    if output_file.endswith("pt"):
-        torch.save(models, output_file)
+    fnames = [file_formatter.format(start_index + i) for i in range(n_pdbs)]
 
-    else:
-        raise ValueError("Model file format not supported. Please use .pt.")
+    # the first model gives the shape of the output and is written directly
+    first_model = _parse_pdb_cached(fnames[0], cache_dir)
+    models = np.lib.format.open_memmap(
+        models_file, mode="w+", dtype=np.float32, shape=(n_pdbs, *first_model.shape)
+    )
+    models[0] = first_model
+    models.flush()
+    del models
+
+    chunk_size = max(1, -(-(n_pdbs - 1) // (4 * n_workers)))
+    chunks = [
+        (fnames[start : start + chunk_size], start, models_file, cache_dir)
+        for start in range(1, n_pdbs, chunk_size)
+    ]
+    with tqdm(total=n_pdbs, initial=1, desc="Parsing pdb files") as pbar:
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [
+                    executor.submit(_parse_pdb_chunk, *chunk) for chunk in chunks
+                ]
+                for future in as_completed(futures):
+                    pbar.update(future.result())
+        else:
+            for chunk in chunks:
+                pbar.update(_parse_pdb_chunk(*chunk))
+
+    _finalize_models_file(models_file, output_file)
 
     return
 
 
-def traj_parser_(top_file: str, traj_file: str) -> torch.tensor:
+def _kabsch_align(
+    positions: np.ndarray, ref_coordinates: np.ndarray, ref_center: np.ndarray
+) -> np.ndarray:
+    """
+    Aligns a block of frames to a reference with the Kabsch algorithm, one batched SVD for all frames.
+    Every frame is centered on its geometric center, rotated onto the centered reference coordinates,
+    and translated to the center of the reference.
+
+    Parameters
+    ----------
+    positions : np.ndarray
+        The coordinates of the frames (M, N, 3).
+    ref_coordinates : np.ndarray
+        The centered coordinates of the reference (N, 3).
+    ref_center : np.ndarray
+        The geometric center of the reference (3,).
+
+    Returns
+    -------
+    aligned : np.ndarray
+        The aligned coordinates of the frames (M, N, 3).
+    """
+
+    positions = positions - positions.mean(axis=1, keepdims=True)
+    covariance = positions.transpose(0, 2, 1) @ ref_coordinates
+    u, _, vt = np.linalg.svd(covariance)
+    # flip the last singular vector of improper rotations
+    sign = np.sign(np.linalg.det(u @ vt))
+    u[:, :, -1] *= sign[:, None]
+    return positions @ (u @ vt) + ref_center
+
+
+def _align_traj_chunked(
+    top_file: str,
+    traj_file: str,
+    allocate,
+    start_frame: Union[int, None] = None,
+    stop_frame: Union[int, None] = None,
+    stride: Union[int, None] = None,
+    chunk_size: int = 256,
+) -> np.ndarray:
+    """
+    Streams the alpha carbons of a trajectory in chunks of frames, aligns every chunk to the
+    topology with _kabsch_align and writes it into the array returned by allocate(shape).
+    Only one chunk of frames is held in memory at a time.
+    """
+
+    ref = mda.Universe(top_file)
+    ref.atoms.translate(-ref.atoms.center_of_mass())
+    ref_atoms = ref.select_atoms("name CA")
+    ref_center = ref_atoms.center_of_geometry()
+    ref_coordinates = (ref_atoms.positions - ref_center).astype(np.float64)
+
+    mobile = mda.Universe(top_file, traj_file)
+    mobile_atoms = mobile.select_atoms("name CA")
+    frames = slice(start_frame, stop_frame, stride)
+    n_frames = len(range(mobile.trajectory.n_frames)[frames])
+
+    atomic_models = allocate((n_frames, 3, mobile_atoms.n_atoms))
+    positions = np.empty((chunk_size, mobile_atoms.n_atoms, 3), dtype=np.float64)
+    start = 0
+    for i, _ in enumerate(
+        tqdm(mobile.trajectory[frames], total=n_frames, desc="Aligning frames")
+    ):
+        positions[i - start] = mobile_atoms.positions
+        if i - start + 1 == chunk_size or i + 1 == n_frames:
+            aligned = _kabsch_align(
+                positions[: i - start + 1], ref_coordinates, ref_center
+            )
+            atomic_models[start : i + 1] = aligned.transpose(0, 2, 1)
+            start = i + 1
+
+    return atomic_models
+
+
+def traj_parser_(
+    top_file: str,
+    traj_file: str,
+    start_frame: Union[int, None] = None,
+    stop_frame: Union[int, None] = None,
+    stride: Union[int, None] = None,
+    chunk_size: int = 256,
+) -> torch.tensor:
     """
     Parses a traj file and returns a coarsed grained atomic model of the protein.
     The atomic model is a Mx3xN array, where M is the number of frames in the trajectory,
     and N is the number of residues in the protein. The first three rows in axis 1 are the x, y, z coordinates of the alpha carbons.
+    The frames are aligned to the topology on the alpha carbons in chunks of chunk_size frames.
 
     Parameters
     ----------
     top_file : str
+        The path to the topology file.
+    traj_file : str
         The path to the traj file.
+    start_frame : int
+        The first frame to parse. Defaults to None, which starts at the first frame.
+    stop_frame : int
+        The frame at which the parsing stops, excluded. Defaults to None, which parses until the last frame.
+    stride : int
+        The step between parsed frames. Defaults to None, which parses every frame.
+    chunk_size : int
+        The number of frames aligned at once. Defaults to 256.
 
     Returns
     -------
@@ -77,30 +302,34 @@ def traj_parser_(top_file: str, traj_file: str) -> torch.tensor:
         The coarse grained atomic model of the protein.
     """
 
-    ref = mda.Universe(top_file)
-    ref.atoms.translate(-ref.atoms.center_of_mass())
-
-    mobile = mda.Universe(top_file, traj_file)
-    align.AlignTraj(mobile, ref, select="name CA", in_memory=True).run()
-
-    atomic_models = torch.zeros(
-        (mobile.trajectory.n_frames, 3, mobile.select_atoms("name CA").n_atoms)
+    atomic_models = _align_traj_chunked(
+        top_file,
+        traj_file,
+        lambda shape: np.empty(shape, dtype=np.float32),
+        start_frame=start_frame,
+        stop_frame=stop_frame,
+        stride=stride,
+        chunk_size=chunk_size,
     )
 
-    for i in range(mobile.trajectory.n_frames):
-        mobile.trajectory[i]
-
-        atomic_models[i, 0:3, :] = torch.from_numpy(
-            mobile.select_atoms("name CA").positions.T
-        )
-
-    return atomic_models
+    return torch.from_numpy(atomic_models)
 
 
-def traj_parser(top_file: str, traj_file: str, output_file: str) -> None:
+def traj_parser(
+    top_file: str,
+    traj_file: str,
+    output_file: str,
+    start_frame: Union[int, None] = None,
+    stop_frame: Union[int, None] = None,
+    stride: Union[int, None] = None,
+    chunk_size: int = 256,
+) -> None:
     """
     Parses a traj file and returns an atomic model of the protein. The atomic model is a Mx5xN array, where M is the number of frames in the trajectory, and N is the number of atoms in the protein. The first three rows in axis 1 are the x, y, z coordinates of the atoms. The fourth row is the atomic number of the atoms. The fifth row is the variance of the atoms before the resolution is applied.
 
+    The aligned frames are streamed into a memory mapped .npy file preallocated with the final shape,
+    so trajectories larger than the memory can be converted.
+
     Parameters
     ----------
     top_file : str
@@ -108,22 +337,36 @@ def traj_parser(top_file: str, traj_file: str, output_file: str) -> None:
     traj_file : str
         The path to the trajectory file.
     output_file : str
-        The path to the output file. Must be a .pt file.
-    mode : str
-        The mode of the atomic model. Either "resid" or "all-atom". Resid mode returns a coarse grained atomic model of the protein. All atom mode returns an all atom atomic model of the protein.
+        The path to the output file. Must be a .pt or .npy file.
+    start_frame : int
+        The first frame to parse. Defaults to None, which starts at the first frame.
+    stop_frame : int
+        The frame at which the parsing stops, excluded. Defaults to None, which parses until the last frame.
+    stride : int
+        The step between parsed frames. Defaults to None, which parses every frame.
+    chunk_size : int
+        The number of frames aligned at once. Defaults to 256.
 
     Returns
     -------
     None
     """
 
-    atomic_models = traj_parser_(top_file, traj_file)
-
-    if output_file.endswith("pt"):
-        torch.save(atomic_models, output_file)
-
-    else:
-        raise ValueError("Model file format not supported. Please use .pt.")
+    models_file = _models_file(output_file)
+    atomic_models = _align_traj_chunked(
+        top_file,
+        traj_file,
+        lambda shape: np.lib.format.open_memmap(
+            models_file, mode="w+", dtype=np.float32, shape=shape
+        ),
+        start_frame=start_frame,
+        stop_frame=stop_frame,
+        stride=stride,
+        chunk_size=chunk_size,
+    )
+    atomic_models.flush()
+    del atomic_models
+    _finalize_models_file(models_file, output_file)
 
     return
 
@@ -133,6 +376,11 @@ def models_to_tensor(
         output_file, 
         n_pdbs: Union[int, None] = None,
         top_file: Union[str, None] = None,
+        n_workers: int = 1,
+        cache_dir: Union[str, None] = None,
+        start_frame: Union[int, None] = None,
+        stop_frame: Union[int, None] = None,
+        stride: Union[int, None] = None,
     ):
     """
     Converts different model files to a torch tensor.
@@ -143,26 +391,46 @@ def models_to_tensor(
         A list of model files to convert to a torch tensor.
         
     output_file : str
-        The path to the output file. Must be a .pt file.
+        The path to the output file. Must be a .pt or .npy file.
         
     n_models : int
         The number of models to convert to a torch tensor. Just needed for models in pdb files.
 
     top_file : str
         The path to the topology file. Just needed for models in trr files.
+
+    n_workers : int
+        The number of processes parsing the pdb files. Just used for models in pdb files.
+
+    cache_dir : str
+        Directory of the cache of parsed pdb files. Just used for models in pdb files.
+
+    start_frame, stop_frame, stride : int
+        The range of frames to convert. Just used for models in trr files.
     
     Returns
     -------
         None
     """
-    assert output_file.endswith("pt"), "The output file must be a .pt file."
+    assert output_file.endswith(
+        ("pt", "npy")
+    ), "The output file must be a .pt or .npy file."
     if model_files.endswith("trr"):
         assert top_file is not None, "Please provide a topology file."
         assert n_pdbs is None, "The number of pdb files is not needed for trr files."
-        traj_parser(top_file, model_files, output_file)
+        traj_parser(
+            top_file,
+            model_files,
+            output_file,
+            start_frame=start_frame,
+            stop_frame=stop_frame,
+            stride=stride,
+        )
     elif model_files.endswith("pdb"):
         assert n_pdbs is not None, "Please provide the number of pdb files."
         assert top_file is None, "The topology file is not needed for pdb files."
-        pdb_parser(model_files, n_pdbs, output_file)
+        pdb_parser(
+            model_files, n_pdbs, output_file, n_workers=n_workers, cache_dir=cache_dir
+        )
         
 
@@ -1,7 +1,10 @@
 import math
-from typing import List, Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Union
 import numpy as np
 import torch
+import torch.nn as nn
 import torchvision.transforms as transforms
 import torch.distributions as d
 import mrcfile
@@ -32,10 +35,13 @@ def circular_mask(n_pixels: int, radius: int, inside: bool = True) -> torch.Tens
     return mask
 
 
-class Mask:
+class Mask(nn.Module):
     """
     Mask a circular region in an image.
 
+    The mask is a non-persistent buffer, so it follows the device of the module and is not
+    part of the state dict.
+
     Args:
         image_size (int): Number of pixels in the image.
         radius (int): Radius of the circle.
@@ -43,12 +49,15 @@ class Mask:
     """
 
     def __init__(self, image_size: int, radius: int, inside: bool = False) -> None:
+        super().__init__()
         self.image_size = image_size
         self.n_pixels = radius
-        self.mask = circular_mask(image_size, radius, inside=inside)
+        self.register_buffer(
+            "mask", circular_mask(image_size, radius, inside=inside), persistent=False
+        )
 
-    def __call__(self, image: torch.Tensor) -> torch.Tensor:
-        """Mask a circular region in an image.
+    def forward(self, image: torch.Tensor) -> torch.Tensor:
+        """Mask a circular region in an image. The image is modified in place.
 
         Args:
             image (torch.Tensor): Image of shape (n_pixels, n_pixels) or (n_channels, n_pixels, n_pixels).
@@ -57,14 +66,10 @@ class Mask:
             image (torch.Tensor): Image with masked region equal to zero.
         """
 
-        if len(image.shape) == 2:
-            image[self.mask] = 0
-        elif len(image.shape) == 3:
-            image[:, self.mask] = 0
-        else:
+        if image.ndim not in (2, 3):
             raise NotImplementedError
 
-        return image
+        return image.masked_fill_(self.mask, 0)
 
 
 def fourier_down_sample(
@@ -134,19 +139,34 @@ class FourierDownSample:
         return down_sampled
 
 
-class LowPassFilter:
+class LowPassFilter(nn.Module):
     """
     Low pass filter an image by removing the outer frequencies.
 
+    The filter is applied in rfft2 space with a precomputed real mask, stored as a
+    non-persistent buffer that follows the device of the module.
+
     Args:
         image_size (int): Side length of the image in pixels.
         frequency_cutoff (int): Frequency cutoff.
     """
 
     def __init__(self, image_size: int, frequency_cutoff: int):
-        self.mask = circular_mask(image_size, frequency_cutoff, inside=False)
+        super().__init__()
+        self.image_size = image_size
+        self.frequency_cutoff = frequency_cutoff
+        keep = (~circular_mask(image_size, frequency_cutoff, inside=False)).float()
+        keep = torch.fft.ifftshift(keep)
+        # the real part of the filtered image only depends on the symmetric part of the mask
+        keep = 0.5 * (keep + torch.roll(keep.flip(0, 1), shifts=(1, 1), dims=(0, 1)))
+        self.register_buffer(
+            "rfft_mask", keep[:, : image_size // 2 + 1].contiguous(), persistent=False
+        )
 
-    def __call__(self, image: torch.Tensor) -> torch.Tensor:
+    def extra_repr(self) -> str:
+        return f"image_size={self.image_size}, frequency_cutoff={self.frequency_cutoff}"
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:
         """
         Low pass filter an image by removing the outer frequencies.
 
@@ -156,18 +176,13 @@ class LowPassFilter:
         Returns:
             reconstructed (torch.Tensor): Low pass filtered image.
         """
-        fft_image = torch.fft.fft2(image)
-        fft_image = torch.fft.fftshift(fft_image)
 
-        if len(image.shape) == 2:
-            fft_image[self.mask] = 0 + 0j
-        elif len(image.shape) == 3:
-            fft_image[:, self.mask] = 0 + 0j
-        else:
+        if image.ndim not in (2, 3):
             raise NotImplementedError
 
-        fft_image = torch.fft.fftshift(fft_image)
-        reconstructed = torch.fft.ifft2(fft_image).real
+        fft_image = torch.fft.rfft2(image)
+        fft_image.mul_(self.rfft_mask)
+        reconstructed = torch.fft.irfft2(fft_image, s=image.shape[-2:])
         return reconstructed
 
 
@@ -281,6 +296,28 @@ class MRCtoTensor:
         return mrc_to_tensor(image_path)
 
 
+def rfft_psd_to_full(psd: torch.Tensor, image_size: int) -> torch.Tensor:
+    """
+    Expands a PSD on the half-plane frequency grid of rfft2 to the full fft2 grid,
+    using the symmetry PSD(k) = PSD(-k) of real images.
+
+    Args:
+        psd (torch.Tensor): PSD of shape (..., image_size, image_size // 2 + 1).
+        image_size (int): Side length of the images in pixels.
+
+    Returns:
+        torch.Tensor: PSD of shape (..., image_size, image_size).
+    """
+
+    freq = torch.arange(image_size, device=psd.device)
+    rows = (-freq) % image_size
+    cols = torch.minimum(freq, (-freq) % image_size)
+    full_psd = psd[..., freq[:, None], cols[None, :]]
+    negative = freq > image_size // 2
+    full_psd[..., negative] = psd[..., rows[:, None], cols[None, negative]]
+    return full_psd
+
+
 def estimate_noise_psd(images: torch.Tensor, image_size: int, mask_radius : Union[int, None] = None) -> torch.Tensor:
     """
     Estimates the power spectral density (PSD) of the noise in a set of images.
@@ -307,19 +344,186 @@ def estimate_noise_psd(images: torch.Tensor, image_size: int, mask_radius : Unio
     return noise_psd_est
 
 
+class PSDAccumulator:
+    """
+    Streaming estimate of the power spectral density (PSD) of a set of images.
+
+    Batches of images are added with update. The running mean and variance of the PSD
+    per frequency are combined batch-wise with the parallel Welford algorithm (Chan et al.),
+    and the PSD is considered converged once the standard error of the mean, relative to the
+    mean, is below the tolerance. The PSD is stored on the rfft2 half-plane.
+
+    Args:
+        tolerance (float, optional): Relative standard error of the mean PSD below which it is converged. Defaults to 1e-2.
+        mask_radius (int, optional): If given, only the pixels outside this radius are used and the PSD is
+            normalized by their number, as in estimate_noise_psd. Defaults to None.
+    """
+
+    def __init__(
+        self, tolerance: float = 1e-2, mask_radius: Union[int, None] = None
+    ) -> None:
+        self.tolerance = tolerance
+        self.mask_radius = mask_radius
+        self.image_size = None
+        self.count = 0
+        self.relative_error = float("inf")
+        self._mean = None
+        self._m2 = None
+
+    def _psd(self, images: torch.Tensor) -> torch.Tensor:
+        if self.mask_radius is not None:
+            mask = circular_mask(self.image_size, self.mask_radius, inside=False)
+            mask = mask.to(images.device)
+            images = images * mask
+        fft_images = torch.fft.rfft2(images)
+        fft_images = fft_images.reshape(-1, *fft_images.shape[-2:])
+        psd = fft_images.real.double() ** 2 + fft_images.imag.double() ** 2
+        if self.mask_radius is not None:
+            psd /= mask.sum()
+        return psd
+
+    def update(self, images: torch.Tensor) -> bool:
+        """
+        Adds a batch of images to the estimate.
+
+        Args:
+            images (torch.Tensor): Images of shape (n_pixels, n_pixels) or (num_images, n_pixels, n_pixels).
+
+        Returns:
+            bool: Whether the PSD is converged.
+        """
+
+        if self.image_size is None:
+            self.image_size = images.shape[-1]
+        psd = self._psd(images)
+        batch_count = psd.shape[0]
+        batch_mean = psd.mean(dim=0)
+        batch_m2 = ((psd - batch_mean) ** 2).sum(dim=0)
+
+        if self.count == 0:
+            self._mean, self._m2 = batch_mean, batch_m2
+            self.count = batch_count
+        else:
+            total_count = self.count + batch_count
+            delta = batch_mean - self._mean
+            self._mean = self._mean + delta * (batch_count / total_count)
+            self._m2 = (
+                self._m2
+                + batch_m2
+                + delta**2 * (self.count * batch_count / total_count)
+            )
+            self.count = total_count
+
+        if self.count > 1:
+            # standard error of the mean per frequency, relative in the norm over frequencies
+            standard_error = (self._m2 / ((self.count - 1) * self.count)).sqrt()
+            self.relative_error = (
+                torch.linalg.vector_norm(standard_error)
+                / torch.linalg.vector_norm(self._mean)
+            ).item()
+        return self.converged
+
+    @property
+    def converged(self) -> bool:
+        """
+        Whether the relative standard error of the mean PSD is below the tolerance.
+        """
+        return self.relative_error < self.tolerance
+
+    @property
+    def mean(self) -> torch.Tensor:
+        """
+        Mean PSD of shape (n_pixels, n_pixels).
+        """
+        assert self.count > 0, "No images added. First call update()"
+        return rfft_psd_to_full(self._mean, self.image_size).float()
+
+    @property
+    def variance(self) -> torch.Tensor:
+        """
+        Variance of the PSD of the images of shape (n_pixels, n_pixels).
+        """
+        assert self.count > 1, "The variance needs at least two images"
+        return rfft_psd_to_full(self._m2 / (self.count - 1), self.image_size).float()
+
+    def state_dict(self) -> dict:
+        """
+        Returns the state of the accumulator.
+
+        Returns:
+            dict: State of the accumulator.
+        """
+        return {
+            "tolerance": self.tolerance,
+            "mask_radius": self.mask_radius,
+            "image_size": self.image_size,
+            "count": self.count,
+            "relative_error": self.relative_error,
+            "mean": self._mean,
+            "m2": self._m2,
+        }
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        """
+        Restores the state of the accumulator.
+
+        Args:
+            state_dict (dict): State of the accumulator from state_dict.
+        """
+        self.tolerance = state_dict["tolerance"]
+        self.mask_radius = state_dict["mask_radius"]
+        self.image_size = state_dict["image_size"]
+        self.count = state_dict["count"]
+        self.relative_error = state_dict["relative_error"]
+        self._mean = state_dict["mean"]
+        self._m2 = state_dict["m2"]
+
+    def save(self, path: str) -> None:
+        """
+        Saves the state of the accumulator to a file.
+
+        Args:
+            path (str): Path to save the state to.
+        """
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path: str) -> "PSDAccumulator":
+        """
+        Loads an accumulator from a file.
+
+        Args:
+            path (str): Path of the saved state.
+
+        Returns:
+            PSDAccumulator: The restored accumulator.
+        """
+        accumulator = cls()
+        accumulator.load_state_dict(torch.load(path))
+        return accumulator
+
+
 class WhitenImage:
     """
     Whiten an image by dividing by the square root of the noise PSD.
-    
+
+    Without fitting, the noise PSD is estimated from each batch that is whitened. After fit,
+    the inverse square root of the fitted noise PSD is cached on the rfft2 half-plane and
+    applied to every batch, so the whitening no longer depends on the batch. A fitted
+    operator can be saved and loaded, and used by the simulator with the image config key
+    WHITENING_FILTER.
+
     Args:
         image_size (int): Size of image in pixels.
         mask_radius (int, optional): Radius of the mask. Defaults to None.
-    
+
     """
-    
+
     def __init__(self, image_size: int, mask_radius: Union[int, None] = None) -> None:
         self.image_size = image_size
         self.mask_radius = mask_radius
+        self.noise_psd = None
+        self._rfft_filter = None
 
     def _estimate_noise_psd(self, images: torch.Tensor) -> torch.Tensor:
         """
@@ -327,19 +531,109 @@ class WhitenImage:
         """
         noise_psd = estimate_noise_psd(images, self.image_size, self.mask_radius)
         return noise_psd
-    
+
+    def fit(
+        self,
+        images: Union[torch.Tensor, PSDAccumulator, Iterable],
+        tolerance: Union[float, None] = None,
+    ) -> "WhitenImage":
+        """
+        Fits the noise PSD used for whitening.
+
+        Args:
+            images (torch.Tensor, PSDAccumulator, Iterable): Images (num_images, n_pixels, n_pixels), an iterable
+                of image batches or of (indices, images) tuples such as MRCParticleLoader, or a filled PSDAccumulator.
+            tolerance (float, optional): Stop reading batches once the relative standard error of the PSD is below this value. Defaults to None.
+
+        Returns:
+            WhitenImage: The fitted operator.
+        """
+
+        if isinstance(images, PSDAccumulator):
+            accumulator = images
+        else:
+            mask_radius = self.mask_radius
+            if mask_radius is None:
+                mask_radius = self.image_size // 2
+            accumulator = PSDAccumulator(
+                tolerance=0.0 if tolerance is None else tolerance,
+                mask_radius=mask_radius,
+            )
+            image_batches = [images] if isinstance(images, torch.Tensor) else images
+            for image_batch in image_batches:
+                if isinstance(image_batch, (tuple, list)):
+                    image_batch = image_batch[-1]
+                if accumulator.update(image_batch):
+                    break
+        self.set_noise_psd(accumulator.mean)
+        return self
+
+    def set_noise_psd(self, noise_psd: torch.Tensor) -> None:
+        """
+        Sets the noise PSD used for whitening.
+
+        Args:
+            noise_psd (torch.Tensor): Noise PSD of shape (n_pixels, n_pixels) on the fft2 frequency grid.
+        """
+
+        assert noise_psd.shape == torch.Size([self.image_size, self.image_size])
+        self.noise_psd = noise_psd.detach().cpu().float()
+        self._rfft_filter = self.noise_psd[:, : self.image_size // 2 + 1] ** -0.5
+
+    def save(self, path: str) -> None:
+        """
+        Saves the fitted operator to a file.
+
+        Args:
+            path (str): Path to save the operator to.
+        """
+
+        assert self.noise_psd is not None, "WhitenImage is not fitted. First call fit()"
+        torch.save(
+            {
+                "image_size": self.image_size,
+                "mask_radius": self.mask_radius,
+                "noise_psd": self.noise_psd,
+            },
+            path,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "WhitenImage":
+        """
+        Loads a fitted operator from a file.
+
+        Args:
+            path (str): Path of the saved operator.
+
+        Returns:
+            WhitenImage: The fitted operator.
+        """
+
+        state = torch.load(path)
+        whiten_image = cls(state["image_size"], state["mask_radius"])
+        whiten_image.set_noise_psd(state["noise_psd"])
+        return whiten_image
+
     def __call__(self, images: torch.Tensor) -> torch.Tensor:
         """
         Whiten an image by dividing by the square root of the noise PSD.
-        
+
         Args:
             image (torch.Tensor): Image of shape (n_pixels, n_pixels).
-        
+
         Returns:
             image (torch.Tensor): Whitened image.
         """
 
         assert images.ndim == 3, "Image should have shape (num_images , n_pixels, n_pixels)"
+        if self._rfft_filter is not None:
+            if self._rfft_filter.device != images.device:
+                self._rfft_filter = self._rfft_filter.to(images.device)
+            images_fft = torch.fft.rfft2(images)
+            images_fft *= self._rfft_filter
+            return torch.fft.irfft2(images_fft, s=images.shape[-2:])
+
         noise_psd = self._estimate_noise_psd(images) ** -0.5
         images_fft = torch.fft.fft2(images)
         images_fft = images_fft * noise_psd
@@ -352,8 +646,12 @@ class MRCdataset:
     Creates a dataset of MRC files.
     Each MRC file is converted to a tensor and has a unique index.
 
+    Files are opened as memory maps and only the requested particles are read. The most
+    recently used file handles are kept open, up to max_open_files.
+
     Args:
         image_paths (list[str]): List of paths to MRC files.
+        max_open_files (int, optional): Maximum number of open file handles. Defaults to 64.
 
     Methods:
         build_index_map: Builds a map of indices to file paths and file indices.
@@ -361,42 +659,118 @@ class MRCdataset:
         __getitem__: Returns tensor of the MRC file at the given index.
     """
 
-    def __init__(self, image_paths: List[str]):
+    def __init__(self, image_paths: List[str], max_open_files: int = 64):
         super().__init__()
         self.paths = image_paths
+        self.max_open_files = max_open_files
         self._num_paths = len(image_paths)
         self._index_map = None
+        self._handles = OrderedDict()
 
     def __len__(self):
         return self._num_paths
 
     def __getitem__(self, idx):
-        return idx, mrc_to_tensor(self.paths[idx])
+        return idx, torch.from_numpy(np.array(self._handle(idx).data))
+
+    def __getstate__(self):
+        # open memory maps cannot be sent to other processes
+        state = self.__dict__.copy()
+        state["_handles"] = OrderedDict()
+        return state
+
+    def _handle(self, path_idx: int):
+        """
+        Returns the memory mapped MRC file, reusing the open handle if there is one.
+        """
+        if path_idx in self._handles:
+            self._handles.move_to_end(path_idx)
+        else:
+            self._handles[path_idx] = mrcfile.mmap(self.paths[path_idx], mode="r")
+            if len(self._handles) > self.max_open_files:
+                _, handle = self._handles.popitem(last=False)
+                handle.close()
+        return self._handles[path_idx]
 
-    def _extract_num_particles(self, path):
-        future_mrc = mrcfile.open_async(path)
-        mrc = future_mrc.result()
-        data_shape = mrc.data.shape
-        # img_stack = mrc.is_image_stack()
-        num_images = data_shape[0] if len(data_shape) > 2 else 1
-        return num_images
+    def _data(self, path_idx: int) -> np.ndarray:
+        """
+        Returns the memory mapped particle stack (num_particles, n_pixels, n_pixels) of a file.
+        """
+        data = self._handle(path_idx).data
+        return data[None] if data.ndim == 2 else data
+
+    def close(self):
+        """
+        Closes all open file handles.
+        """
+        while self._handles:
+            _, handle = self._handles.popitem()
+            handle.close()
+
+    @staticmethod
+    def _extract_num_particles(path: str) -> int:
+        with mrcfile.open(path, header_only=True, permissive=True) as mrc:
+            return int(mrc.header.nz)
+
+    def _count_particles(self, paths: List[str], num_workers: int) -> np.ndarray:
+        """
+        Reads the number of particles of each file from the MRC headers in parallel.
+        """
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            num_particles = list(
+                tqdm(
+                    executor.map(self._extract_num_particles, paths),
+                    total=len(paths),
+                )
+            )
+        return np.asarray(num_particles, dtype=np.int64)
+
+    def _set_index(self, num_particles: np.ndarray):
+        self._num_particles = num_particles
+        self._offsets = np.zeros(len(num_particles) + 1, dtype=np.int64)
+        np.cumsum(num_particles, out=self._offsets[1:])
+        self._index_map = True
 
-    def build_index_map(self):
+    @property
+    def num_particles(self) -> int:
+        """
+        Total number of particles in all files.
+        """
+        assert (
+            self._index_map is not None
+        ), "Index map not built. First call build_index_map() or load_index_map()"
+        return int(self._offsets[-1])
+
+    def build_index_map(self, num_workers: int = 8):
         """
         Builds a map of image indices to file paths and file indices.
+
+        Only the headers of the files are read.
+
+        Args:
+            num_workers (int, optional): Number of threads reading the headers. Defaults to 8.
         """
         if self._index_map is not None:
             print("Index map already built.")
             return
 
-        self._path_index = []
-        self._file_index = []
         print("Initalizing indexing...")
-        for idx, path in tqdm(enumerate(self.paths), total=self._num_paths):
-            num_images = self._extract_num_particles(path)
-            self._path_index += [idx] * num_images
-            self._file_index += list(range(num_images))
-        self._index_map = True
+        self._set_index(self._count_particles(self.paths, num_workers))
+
+    def add_paths(self, image_paths: List[str], num_workers: int = 8):
+        """
+        Adds files to the dataset and indexes only the new files.
+        The global indices of the particles in the existing files do not change.
+
+        Args:
+            image_paths (list[str]): List of paths to MRC files.
+            num_workers (int, optional): Number of threads reading the headers. Defaults to 8.
+        """
+        self.paths = list(self.paths) + list(image_paths)
+        self._num_paths = len(self.paths)
+        if self._index_map is not None:
+            num_particles = self._count_particles(image_paths, num_workers)
+            self._set_index(np.concatenate([self._num_particles, num_particles]))
 
     def save_index_map(self, path: str):
         """
@@ -410,43 +784,90 @@ class MRCdataset:
         ), "Index map not built. First call build_index_map()"
         np.savez(
             path,
-            path_index=self._path_index,
-            file_index=self._file_index,
+            num_particles=self._num_particles,
             paths=self.paths,
         )
 
-    def load_index_map(self, path: str):
+    def load_index_map(self, path: str, num_workers: int = 8):
         """
         Loads the index map from a file.
+        If the dataset has additional files after the indexed ones, only those are indexed.
 
         Args:
             path (str): Path to load the index map.
+            num_workers (int, optional): Number of threads reading the headers of new files. Defaults to 8.
         """
         index_map = np.load(path)
-        assert self.paths == index_map["paths"], "Paths do not match the index map."
-        self._path_index = index_map["path_index"]
-        self._file_index = index_map["file_index"]
-        self._index_map = True
+        indexed_paths = [str(indexed_path) for indexed_path in index_map["paths"]]
+        assert (
+            list(self.paths[: len(indexed_paths)]) == indexed_paths
+        ), "Paths do not match the index map."
+        if "num_particles" in index_map:
+            num_particles = index_map["num_particles"].astype(np.int64)
+        else:
+            # index maps saved with one entry per particle
+            num_particles = np.bincount(
+                index_map["path_index"], minlength=len(indexed_paths)
+            ).astype(np.int64)
+        new_paths = self.paths[len(indexed_paths) :]
+        if len(new_paths) > 0:
+            num_particles = np.concatenate(
+                [num_particles, self._count_particles(new_paths, num_workers)]
+            )
+        self._set_index(num_particles)
+
+    def _locate(self, idx: np.ndarray) -> tuple:
+        """
+        Returns the file and the index within the file of global particle indices.
+        """
+        if np.any(idx < 0) or np.any(idx >= self._offsets[-1]):
+            raise IndexError(
+                f"Particle index out of range for {self._offsets[-1]} particles."
+            )
+        path_idx = np.searchsorted(self._offsets, idx, side="right") - 1
+        return path_idx, idx - self._offsets[path_idx]
 
     def get_image(self, idx: Union[int, list]):
         """
         Returns the image at the given global index.
 
+        A list of indices is grouped by file and each file is read once, with a single
+        slice if its indices are consecutive.
+
         Args:
             idx (int, List): Global index of the image.
+
+        Returns:
+            torch.Tensor: Image (n_pixels, n_pixels) or images (len(idx), n_pixels, n_pixels).
         """
         assert (
             self._index_map is not None
         ), "Index map not built. First call build_index_map() or load_index_map()"
-        if isinstance(idx, int):
-            image = mrc_to_tensor(self.paths[self._path_index[idx]])
-            if image.ndim > 2:
-                return image[self._file_index[idx]]
-        if isinstance(idx, (list, np.ndarray, torch.Tensor)):
-            return [
-                mrc_to_tensor(self.paths[self._path_index[i]])[self._file_index[i]]
-                for i in idx
-            ]
+        if isinstance(idx, (int, np.integer)):
+            path_idx, file_idx = self._locate(idx)
+            return torch.from_numpy(np.array(self._data(path_idx)[file_idx]))
+
+        idx = np.asarray(idx, dtype=np.int64).reshape(-1)
+        path_idx, file_idx = self._locate(idx)
+        order = np.argsort(path_idx, kind="stable")
+        file_starts = np.flatnonzero(np.diff(path_idx[order], prepend=-1))
+        file_stops = np.append(file_starts[1:], len(order))
+
+        images = None
+        for start, stop in zip(file_starts, file_stops):
+            positions = order[start:stop]
+            data = self._data(path_idx[positions[0]])
+            particles = file_idx[positions]
+            if np.all(np.diff(particles) == 1):
+                particles = slice(particles[0], particles[-1] + 1)
+            if images is None:
+                images = np.empty(
+                    (len(idx), *data.shape[1:]), dtype=data.dtype.newbyteorder("=")
+                )
+            images[positions] = data[particles]
+        if images is None:
+            raise IndexError("get_image needs at least one index.")
+        return torch.from_numpy(images)
 
 
 class MRCloader(torch.utils.data.DataLoader):
@@ -460,3 +881,132 @@ class MRCloader(torch.utils.data.DataLoader):
 
     def __init__(self, image_paths: List[str], **kwargs):
         super().__init__(MRCdataset(image_paths), batch_size=None, **kwargs)
+
+
+class MRCParticleDataset(torch.utils.data.IterableDataset):
+    """
+    Iterates over the particles of a set of MRC files in batches of a fixed size.
+
+    Batches span file boundaries and each batch is filled in place from the memory mapped
+    files. With multiple workers the files are split between the workers, so every file is
+    read by a single worker. The transform is applied to each batch in the worker.
+
+    Args:
+        images (list[str], MRCdataset): List of paths to MRC files or an indexed MRCdataset.
+        batch_size (int): Number of particles per batch.
+        transform (Callable, optional): Transform applied to each batch of images. Defaults to None.
+        drop_last (bool, optional): Drop the last incomplete batch of each worker. Defaults to False.
+        pin_memory (bool, optional): Allocate batches in pinned memory when iterating in the main process. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        images: Union[List[str], MRCdataset],
+        batch_size: int,
+        transform=None,
+        drop_last: bool = False,
+        pin_memory: bool = False,
+    ):
+        super().__init__()
+        if not isinstance(images, MRCdataset):
+            images = MRCdataset(images)
+        if images._index_map is None:
+            images.build_index_map()
+        self.dataset = images
+        self.batch_size = batch_size
+        self.transform = transform
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.dataset.num_particles // self.batch_size
+        return -(-self.dataset.num_particles // self.batch_size)
+
+    def _new_batch(self, shape: tuple, dtype: np.dtype) -> torch.Tensor:
+        pin_memory = self.pin_memory and torch.utils.data.get_worker_info() is None
+        return torch.empty(
+            (self.batch_size, *shape),
+            dtype=torch.from_numpy(np.empty(0, dtype=dtype)).dtype,
+            pin_memory=pin_memory,
+        )
+
+    def _finish_batch(self, indices: torch.Tensor, images: torch.Tensor) -> tuple:
+        if self.transform is not None:
+            images = self.transform(images)
+        return indices, images
+
+    def __iter__(self):
+        path_ids = np.arange(len(self.dataset.paths))
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            path_ids = path_ids[worker_info.id :: worker_info.num_workers]
+
+        offsets = self.dataset._offsets
+        indices, images, filled = None, None, 0
+        for path_idx in path_ids:
+            data = self.dataset._data(path_idx)
+            file_start = 0
+            while file_start < len(data):
+                if images is None:
+                    images = self._new_batch(
+                        data.shape[1:], data.dtype.newbyteorder("=")
+                    )
+                    indices = torch.empty(self.batch_size, dtype=torch.int64)
+                num_copy = min(self.batch_size - filled, len(data) - file_start)
+                images[filled : filled + num_copy].numpy()[...] = data[
+                    file_start : file_start + num_copy
+                ]
+                indices[filled : filled + num_copy] = torch.arange(
+                    offsets[path_idx] + file_start,
+                    offsets[path_idx] + file_start + num_copy,
+                )
+                filled += num_copy
+                file_start += num_copy
+                if filled == self.batch_size:
+                    yield self._finish_batch(indices, images)
+                    indices, images, filled = None, None, 0
+
+        if filled > 0 and not self.drop_last:
+            yield self._finish_batch(indices[:filled], images[:filled])
+
+
+class MRCParticleLoader(torch.utils.data.DataLoader):
+    """
+    Creates a dataloader of fixed size batches of particles from MRC files.
+    Each batch is a tuple of the global particle indices and the images.
+
+    Args:
+        images (list[str], MRCdataset): List of paths to MRC files or an indexed MRCdataset.
+        batch_size (int): Number of particles per batch.
+        transform (Callable, optional): Transform applied to each batch of images. Defaults to None.
+        drop_last (bool, optional): Drop the last incomplete batch of each worker. Defaults to False.
+        pin_memory (bool, optional): Return batches in pinned memory. Defaults to True if CUDA is available.
+        **kwargs: Keyword arguments passed to torch.utils.data.DataLoader.
+    """
+
+    def __init__(
+        self,
+        images: Union[List[str], MRCdataset],
+        batch_size: int,
+        transform=None,
+        drop_last: bool = False,
+        pin_memory: Union[bool, None] = None,
+        **kwargs,
+    ):
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        num_workers = kwargs.get("num_workers", 0)
+        # without workers the batches are allocated pinned, otherwise the loader pins them
+        super().__init__(
+            MRCParticleDataset(
+                images,
+                batch_size,
+                transform=transform,
+                drop_last=drop_last,
+                pin_memory=pin_memory and num_workers == 0,
+            ),
+            batch_size=None,
+            pin_memory=pin_memory and num_workers > 0,
+            **kwargs,
+        )
@@ -1,19 +1,24 @@
-import random
 from typing import Optional, Union, List
-from cryo_sbi.utils.image_utils import mrc_to_tensor
+import numpy as np
+import mrcfile
+from cryo_sbi.utils.image_utils import PSDAccumulator
 import torch
 import torchvision.transforms as transforms
-import torchvision.transforms.functional as TF
 
 
 class RandomMicrographPatches:
     """
-    Iterator that returns random patches from a list of micrographs.
+    Iterator that returns batches of random patches from a list of micrographs.
+
+    Micrographs given as paths are opened as memory maps, so only the pixels of the
+    extracted patches are read from disk. All patches of a batch are extracted at once
+    with advanced indexing.
 
     Args:
         micro_graphs (List[Union[str, torch.Tensor]]): List of micrographs.
-        transform (Union[None, transforms.Compose]): Transform to apply to the patches.
+        transform (Union[None, transforms.Compose]): Transform to apply to the batch of patches.
         patch_size (int): Size of the patches.
+        max_iter (int, optional): Number of batches per iteration. Defaults to 1000.
         batch_size (int, optional): Batch size. Defaults to 1.
     """
 
@@ -23,41 +28,81 @@ class RandomMicrographPatches:
         transform: Union[None, transforms.Compose],
         patch_size: int,
         max_iter: Optional[int] = 1000,
+        batch_size: int = 1,
     ) -> None:
         if all(map(isinstance, micro_graphs, [str] * len(micro_graphs))):
-            self._micro_graphs = [mrc_to_tensor(path) for path in micro_graphs]
+            self._mrc_files = [mrcfile.mmap(path, mode="r") for path in micro_graphs]
+            self._micro_graphs = [mrc.data for mrc in self._mrc_files]
         else:
             self._micro_graphs = micro_graphs
 
         self._transform = transform
         self._patch_size = patch_size
         self._max_iter = max_iter
+        self._batch_size = batch_size
         self._current_iter = 0
 
     def __iter__(self) -> "RandomMicrographPatches":
+        # every loop starts over, also after a loop that stopped early
+        self._current_iter = 0
         return self
 
+    def _sample_patches(self) -> torch.Tensor:
+        """
+        Extracts a batch of patches at random positions of random micrographs.
+
+        Returns:
+            torch.Tensor: Patches of shape (batch_size, patch_size, patch_size).
+        """
+        micrograph_ids = torch.randint(len(self._micro_graphs), (self._batch_size,))
+        patches = None
+        for micrograph_id in micrograph_ids.unique().tolist():
+            micrograph = self._micro_graphs[micrograph_id]
+            assert micrograph.ndim == 2, "Micrograph should be 2D"
+            in_micrograph = torch.nonzero(micrograph_ids == micrograph_id)[:, 0]
+            num_patches = len(in_micrograph)
+            top = torch.randint(
+                micrograph.shape[0] - self._patch_size + 1, (num_patches,)
+            )
+            left = torch.randint(
+                micrograph.shape[1] - self._patch_size + 1, (num_patches,)
+            )
+            # views of all patches, indexing copies only the selected ones
+            if isinstance(micrograph, np.ndarray):
+                windows = np.lib.stride_tricks.sliding_window_view(
+                    micrograph, (self._patch_size, self._patch_size)
+                )
+                micrograph_patches = windows[top.numpy(), left.numpy()]
+                micrograph_patches = torch.from_numpy(
+                    micrograph_patches.astype(
+                        micrograph_patches.dtype.newbyteorder("="), copy=False
+                    )
+                )
+            else:
+                windows = micrograph.unfold(0, self._patch_size, 1).unfold(
+                    1, self._patch_size, 1
+                )
+                micrograph_patches = windows[top, left]
+            if num_patches == self._batch_size:
+                return micrograph_patches
+            if patches is None:
+                patches = torch.empty(
+                    (self._batch_size, self._patch_size, self._patch_size),
+                    dtype=micrograph_patches.dtype,
+                    device=micrograph_patches.device,
+                )
+            patches[in_micrograph] = micrograph_patches
+        return patches
+
     def __next__(self) -> torch.Tensor:
         if self._current_iter == self._max_iter:
             self._current_iter = 0
             raise StopIteration
-        random_micrograph = random.choice(self._micro_graphs)
-        assert random_micrograph.ndim == 2, "Micrograph should be 2D"
-        x = random.randint(0, random_micrograph.shape[0] - self._patch_size)
-        y = random.randint(0, random_micrograph.shape[1] - self._patch_size)
-        patch = TF.crop(
-            random_micrograph,
-            top=y,
-            left=x,
-            height=self._patch_size,
-            width=self._patch_size,
-        )
+        patches = self._sample_patches()
         if self._transform is not None:
-            patch = self._transform(patch)
-        else:
-            patch = patch.unsqueeze(0)
+            patches = self._transform(patches)
         self._current_iter += 1
-        return patch
+        return patches
 
     def __len__(self) -> int:
         return self._max_iter
@@ -65,17 +110,21 @@ class RandomMicrographPatches:
     @property
     def shape(self) -> torch.Size:
         """
-        Shape of the transformed patches.
+        Shape of the transformed batches of patches.
 
         Returns:
-            torch.Size: Shape of the transformed patches.
+            torch.Size: Shape of the transformed batches of patches.
         """
-        return self.__next__().shape
+        patches = self._sample_patches()
+        if self._transform is not None:
+            patches = self._transform(patches)
+        return patches.shape
 
 
 def compute_average_psd(
     images: Union[torch.Tensor, RandomMicrographPatches],
     device: str = "cpu",
+    tolerance: Optional[float] = None,
 ) -> torch.Tensor:
     """
     Compute the average PSD of a set of images.
@@ -83,19 +132,19 @@ def compute_average_psd(
     Args:
         images (Union[torch.Tensor, RandomMicrographPatches]): Images to compute the average PSD of.
         device (str, optional): Device to compute the PSD on. Defaults to "cpu".
+        tolerance (float, optional): Stop once the relative standard error of the average PSD is below this value. Defaults to None.
 
     Returns:
         avg_psd (torch.Tensor): Average PSD of the images.
     """
 
     if isinstance(images, RandomMicrographPatches):
-        avg_psd = torch.zeros(images.shape[1:], device=device)
-        for image in images:  # TODO add progress bar with tqdm
-            fft_image = torch.fft.fft2(image[0].to(device, non_blocking=True))
-            psd = torch.abs(fft_image) ** 2
-            avg_psd += psd / len(images)
-            # add convergence check
+        image_batches = images
     elif isinstance(images, torch.Tensor):
-        fft_images = torch.fft.fft2(images.to(device=device), dim=(-2, -1))
-        avg_psd = torch.mean(torch.abs(fft_images) ** 2, dim=0)
-    return avg_psd.cpu()
+        image_batches = [images]
+
+    accumulator = PSDAccumulator(tolerance=0.0 if tolerance is None else tolerance)
+    for image_batch in image_batches:  # TODO add progress bar with tqdm
+        if accumulator.update(image_batch.to(device, non_blocking=True)):
+            break
+    return accumulator.mean.cpu()
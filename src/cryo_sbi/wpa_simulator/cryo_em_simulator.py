@@ -1,13 +1,19 @@
 from typing import Union, Callable
 import json
-import numpy as np
 import torch
 
-from cryo_sbi.wpa_simulator.ctf import apply_ctf
-from cryo_sbi.wpa_simulator.image_generation import project_density
+from cryo_sbi.wpa_simulator.ctf import apply_ctf, get_ctf_operator
+from cryo_sbi.wpa_simulator.image_generation import (
+    project_density,
+    project_density_chunked,
+    project_density_fourier,
+)
+from cryo_sbi.wpa_simulator.model_store import load_models
 from cryo_sbi.wpa_simulator.noise import add_noise
 from cryo_sbi.wpa_simulator.normalization import gaussian_normalize_image
-from cryo_sbi.inference.priors import get_image_priors
+from cryo_sbi.inference.priors import get_image_priors, batch_generator
+from cryo_sbi.inference.simulation_bank import SimulationBankWriter
+from cryo_sbi.utils.image_utils import WhitenImage
 from cryo_sbi.wpa_simulator.validate_image_config import check_image_params
 
 
@@ -23,6 +29,9 @@ def cryo_em_simulator(
     snr,
     num_pixels,
     pixel_size,
+    max_projection_memory: Union[int, None] = None,
+    whitening_filter: Union[Callable, None] = None,
+    generator: Union[torch.Generator, None] = None,
 ):
     """
     Simulates a bacth of cryo-electron microscopy (cryo-EM) images of a set of given coars-grained models.
@@ -39,31 +48,146 @@ def cryo_em_simulator(
         snr (float): The signal-to-noise ratio of the simulated image.
         num_pixels (int): The number of pixels in the simulated image.
         pixel_size (float): The size of each pixel in the simulated image.
+        max_projection_memory (int, optional): Memory budget in bytes for the projection. If None, the projection is computed in a single pass.
+        whitening_filter (Callable, optional): Whitening applied after the CTF and before the noise, e.g. a fitted WhitenImage. Defaults to None.
+        generator (torch.Generator, optional): Random number generator of the noise on the device of the models. Defaults to None.
 
     Returns:
         torch.Tensor: A tensor of the simulated cryo-EM image.
     """
     models_selected = models[index.round().long().flatten()]
-    image = project_density(
+    if max_projection_memory is None:
+        image = project_density(
+            models_selected,
+            quaternion,
+            sigma,
+            shift,
+            num_pixels,
+            pixel_size,
+        )
+    else:
+        image = project_density_chunked(
+            models_selected,
+            quaternion,
+            sigma,
+            shift,
+            num_pixels,
+            pixel_size,
+            max_memory=int(max_projection_memory),
+        )
+    image = apply_ctf(image, defocus, b_factor, amp, pixel_size)
+    if whitening_filter is not None:
+        image = whitening_filter(image)
+    image = add_noise(image, snr, generator=generator)
+    image = gaussian_normalize_image(image)
+    return image
+
+
+def cryo_em_simulator_fourier(
+    models,
+    index,
+    quaternion,
+    sigma,
+    shift,
+    defocus,
+    b_factor,
+    amp,
+    snr,
+    num_pixels,
+    pixel_size,
+    max_projection_memory: Union[int, None] = None,
+    whitening_filter: Union[Callable, None] = None,
+    generator: Union[torch.Generator, None] = None,
+):
+    """
+    Simulates a batch of cryo-EM images by building the projections directly in Fourier space.
+
+    The Fourier transform of the Gaussian beads is computed in closed form and multiplied with
+    the CTF, so only one inverse real FFT per image is needed. The noiseless images agree with
+    cryo_em_simulator to a relative error below 2e-3 for sigma of at least one pixel and below
+    1e-4 for sigma of at least 1.5 pixels, as long as the beads stay more than 3 sigma away from
+    the image edges. Smaller sigmas are band-limited instead of aliased.
+
+    Args:
+        models (torch.Tensor): A tensor of coars grained models (num_models, 3, num_beads).
+        index (torch.Tensor): A tensor of indices to select the models to simulate.
+        quaternion (torch.Tensor): A tensor of quaternions to rotate the models.
+        sigma (float): The standard deviation of the Gaussian kernel used to project the density.
+        shift (torch.Tensor): A tensor of shifts to apply to the models.
+        defocus (float): The defocus value of the contrast transfer function (CTF).
+        b_factor (float): The B-factor of the CTF.
+        amp (float): The amplitude contrast of the CTF.
+        snr (float): The signal-to-noise ratio of the simulated image.
+        num_pixels (int): The number of pixels in the simulated image.
+        pixel_size (float): The size of each pixel in the simulated image.
+        max_projection_memory (int, optional): Memory budget in bytes for the projection. Defaults to 2**28.
+        whitening_filter (Callable, optional): Whitening applied after the CTF and before the noise, e.g. a fitted WhitenImage. Defaults to None.
+        generator (torch.Generator, optional): Random number generator of the noise on the device of the models. Defaults to None.
+
+    Returns:
+        torch.Tensor: A tensor of the simulated cryo-EM image.
+    """
+    models_selected = models[index.round().long().flatten()]
+    spectrum = project_density_fourier(
         models_selected,
         quaternion,
         sigma,
         shift,
         num_pixels,
         pixel_size,
+        max_memory=(
+            2**28 if max_projection_memory is None else int(max_projection_memory)
+        ),
     )
-    image = apply_ctf(image, defocus, b_factor, amp, pixel_size)
-    image = add_noise(image, snr)
+    ctf = get_ctf_operator(
+        int(num_pixels), float(pixel_size), spectrum.device, models_selected.dtype
+    )
+    spectrum *= ctf.spectrum(defocus, b_factor, amp)
+    image = torch.fft.irfft2(spectrum, s=(int(num_pixels), int(num_pixels)))
+    if whitening_filter is not None:
+        image = whitening_filter(image)
+    image = add_noise(image, snr, generator=generator)
     image = gaussian_normalize_image(image)
     return image
 
 
+def load_whitening_filter(image_config: dict) -> Union[WhitenImage, None]:
+    """
+    Loads the whitening filter of the image config key WHITENING_FILTER.
+
+    Args:
+        image_config (dict): Image config of the simulation.
+
+    Raises:
+        ValueError: The image size of the filter differs from N_PIXELS.
+
+    Returns:
+        Union[WhitenImage, None]: The fitted filter, or None if the key is not set.
+    """
+
+    if image_config.get("WHITENING_FILTER") is None:
+        return None
+    whitening_filter = WhitenImage.load(image_config["WHITENING_FILTER"])
+    if whitening_filter.image_size != image_config["N_PIXELS"]:
+        raise ValueError(
+            f"The whitening filter {image_config['WHITENING_FILTER']} was fitted on "
+            f"images of {whitening_filter.image_size} pixels, but N_PIXELS is "
+            f"{image_config['N_PIXELS']}."
+        )
+    return whitening_filter
+
+
 class CryoEmSimulator:
     def __init__(self, config_fname: str, device: str = "cpu"):
         self._device = device
         self._load_params(config_fname)
         self._load_models()
         self._priors = get_image_priors(self.max_index, self._config, device=device)
+        if self._config.get("FOURIER_SIMULATION", False):
+            self._simulator = cryo_em_simulator_fourier
+        else:
+            self._simulator = cryo_em_simulator
+        self._whitening_filter = load_whitening_filter(self._config)
         self._num_pixels = torch.tensor(
             self._config["N_PIXELS"], dtype=torch.float32, device=device
         )
@@ -89,32 +213,20 @@ class CryoEmSimulator:
     def _load_models(self) -> None:
         """
         Loads the models from the model file specified in the config file.
+        With MMAP_MODELS set in the config, the models are memory mapped and only the
+        models of each simulated batch are read, see MemoryMappedModels.
 
         Returns:
             None
 
         """
-        if self._config["MODEL_FILE"].endswith("npy"):
-            models = (
-                torch.from_numpy(
-                    np.load(self._config["MODEL_FILE"]),
-                )
-                .to(self._device)
-                .to(torch.float32)
-            )
-        elif self._config["MODEL_FILE"].endswith("pt"):
-            models = (
-                torch.load(self._config["MODEL_FILE"])
-                .to(self._device)
-                .to(torch.float32)
-            )
-
-        else:
-            raise NotImplementedError(
-                "Model file format not supported. Please use .npy or .pt."
-            )
 
-        self._models = models
+        self._models = load_models(
+            self._config["MODEL_FILE"],
+            device=self._device,
+            mmap=self._config.get("MMAP_MODELS", False),
+            cache_size=self._config.get("MODEL_CACHE_SIZE", 0),
+        )
 
         assert self._models.ndim == 3, "Models are not of shape (models, 3, atoms)."
         assert self._models.shape[1] == 3, "Models are not of shape (models, 3, atoms)."
@@ -129,23 +241,53 @@ class CryoEmSimulator:
         """
         return len(self._models) - 1
 
-    def simulate(self, num_sim, indices=None, return_parameters=False, batch_size=None):
+    def _batch_generators(
+        self, seed: Union[int, None], stream: int, batch_id: int
+    ) -> tuple:
+        """
+        Returns the generators of the parameters and of the noise of a batch, see
+        batch_generator, or None for both without a seed.
+        """
+
+        if seed is None:
+            return None, None
+        return (
+            batch_generator(seed, stream, batch_id, "prior", device=self._device),
+            batch_generator(seed, stream, batch_id, "noise", device=self._device),
+        )
+
+    def simulate(
+        self,
+        num_sim,
+        indices=None,
+        return_parameters=False,
+        batch_size=None,
+        seed: Union[int, None] = None,
+        first_batch: int = 0,
+        stream: int = 0,
+    ):
         """
         Simulate cryo-EM images using the specified models and prior distributions.
 
+        With a seed, the parameters and the noise of batch i are drawn from the generators
+        batch_generator(seed, stream, first_batch + i, purpose), so any batch of a seeded
+        simulation can be simulated again on its own by passing its number as first_batch.
+        The training with the same seed simulates the same batches in the stream of its rank.
+
         Args:
             num_sim (int): The number of images to simulate.
             indices (torch.Tensor, optional): The indices of the images to simulate. If None, all images are simulated.
             return_parameters (bool, optional): Whether to return the sampled parameters used for simulation.
             batch_size (int, optional): The batch size to use for simulation. If None, all images are simulated in a single batch.
+            seed (int, optional): Seed of the simulation. If None, the global random number generator is used.
+            first_batch (int, optional): Number of the first batch for a seeded simulation. Defaults to 0.
+            stream (int, optional): Key of the stream for a seeded simulation, e.g. the rank of a training process. Defaults to 0.
 
         Returns:
             torch.Tensor or tuple: The simulated images as a tensor of shape (num_sim, num_pixels, num_pixels),
             and optionally the sampled parameters as a tuple of tensors.
         """
 
-        parameters = self._priors.sample((num_sim,))
-        indices = parameters[0] if indices is None else indices
         if indices is not None:
             assert isinstance(
                 indices, torch.Tensor
@@ -156,26 +298,98 @@ class CryoEmSimulator:
             assert (
                 indices.ndim == 2
             ), "Indices are not a 2D tensor, converting to 2D tensor. With shape (batch_size, 1)."
-            parameters[0] = indices
 
         images = []
+        packed = []
         if batch_size is None:
             batch_size = num_sim
         for i in range(0, num_sim, batch_size):
-            batch_indices = indices[i : i + batch_size]
-            batch_parameters = [param[i : i + batch_size] for param in parameters[1:]]
-            batch_images = cryo_em_simulator(
+            prior_generator, noise_generator = self._batch_generators(
+                seed, stream, first_batch + i // batch_size
+            )
+            batch_packed = self._priors.sample_packed(
+                (min(batch_size, num_sim - i),), generator=prior_generator
+            )
+            batch_parameters = self._priors.unpack(batch_packed)
+            if indices is not None:
+                batch_parameters[0] = indices[i : i + batch_size]
+            batch_images = self._simulator(
                 self._models,
-                batch_indices,
                 *batch_parameters,
                 self._num_pixels,
                 self._pixel_size,
+                max_projection_memory=self._config.get("MAX_PROJECTION_MEMORY"),
+                whitening_filter=self._whitening_filter,
+                generator=noise_generator,
             )
             images.append(batch_images.cpu())
+            packed.append(batch_packed)
 
         images = torch.cat(images, dim=0)
 
         if return_parameters:
+            parameters = self._priors.unpack(torch.cat(packed, dim=0))
+            if indices is not None:
+                parameters[0] = indices
             return images.cpu(), parameters
         else:
             return images.cpu()
+
+    def simulate_to_disk(
+        self,
+        num_sim: int,
+        directory: str,
+        shard_size: int = 10000,
+        batch_size=None,
+        seed: Union[int, None] = None,
+    ) -> None:
+        """
+        Simulate cryo-EM images and stream them with their parameters into a simulation bank on disk.
+
+        The bank is a directory of .npy shards that can be read for training with
+        cryo_sbi.inference.simulation_bank.SimulationBankLoader.
+
+        Args:
+            num_sim (int): The number of images to simulate.
+            directory (str): The directory of the simulation bank.
+            shard_size (int, optional): The number of images per shard. Defaults to 10000.
+            batch_size (int, optional): The batch size to use for simulation. If None, each shard is simulated in a single batch.
+            seed (int, optional): Seed of the simulation, batches are numbered across shards as in simulate. If None, the global random number generator is used.
+
+        Returns:
+            None
+        """
+
+        num_pixels = int(self._config["N_PIXELS"])
+        writer = SimulationBankWriter(
+            directory, (num_pixels, num_pixels), self._priors.layout
+        )
+        batch_id = 0
+        for shard_start in range(0, num_sim, shard_size):
+            num_shard = min(shard_size, num_sim - shard_start)
+            shard_parameters, shard_images = writer.open_shard(num_shard)
+            shard_batch_size = num_shard if batch_size is None else batch_size
+            for i in range(0, num_shard, shard_batch_size):
+                num_batch = min(shard_batch_size, num_shard - i)
+                prior_generator, noise_generator = self._batch_generators(
+                    seed, 0, batch_id
+                )
+                batch_id += 1
+                packed = self._priors.sample_packed(
+                    (num_batch,), generator=prior_generator
+                )
+                batch_images = self._simulator(
+                    self._models,
+                    *self._priors.unpack(packed),
+                    self._num_pixels,
+                    self._pixel_size,
+                    max_projection_memory=self._config.get("MAX_PROJECTION_MEMORY"),
+                    whitening_filter=self._whitening_filter,
+                    generator=noise_generator,
+                )
+                shard_parameters[i : i + num_batch] = packed.cpu().numpy()
+                shard_images[i : i + num_batch] = batch_images.cpu().numpy()
+            shard_parameters.flush()
+            shard_images.flush()
+            del shard_parameters, shard_images
+        writer.close()
@@ -1,7 +1,115 @@
-import numpy as np
+import functools
 import torch
 
 
+class CTFOperator:
+    """
+    Contrast transfer function for images of a fixed size and pixel size.
+
+    The squared spatial frequencies of the real FFT grid are computed once at
+    construction, so applying the CTF only costs one rfft2 and one irfft2.
+
+    Args:
+        num_pixels (int): Number of pixels along one image side.
+        pixel_size (float): Pixel size in Angstrom.
+        device (torch.device, optional): Device of the frequency grid. Defaults to "cpu".
+        dtype (torch.dtype, optional): Data type of the frequency grid. Defaults to torch.float32.
+    """
+
+    def __init__(
+        self,
+        num_pixels: int,
+        pixel_size: float,
+        device: torch.device = "cpu",
+        dtype: torch.dtype = torch.float32,
+    ) -> None:
+        self.num_pixels = int(num_pixels)
+        self.pixel_size = float(pixel_size)
+        freq_x = torch.fft.fftfreq(
+            self.num_pixels, d=self.pixel_size, device=device, dtype=dtype
+        )
+        freq_y = torch.fft.rfftfreq(
+            self.num_pixels, d=self.pixel_size, device=device, dtype=dtype
+        )
+        self.freq2_2d = freq_x[:, None] ** 2 + freq_y[None, :] ** 2
+        # grid of unit pixel size in double precision, rescaled for tensor pixel sizes
+        freq_x = torch.fft.fftfreq(self.num_pixels, device=device, dtype=torch.float64)
+        freq_y = torch.fft.rfftfreq(self.num_pixels, device=device, dtype=torch.float64)
+        self._freq2_unit = freq_x[:, None] ** 2 + freq_y[None, :] ** 2
+
+    def spectrum(self, defocus, b_factor, amp, pixel_size=None) -> torch.Tensor:
+        """
+        Computes the CTF on the half-plane frequency grid of rfft2.
+
+        Args:
+            defocus (torch.Tensor): The defocus value.
+            b_factor (torch.Tensor): The B-factor value.
+            amp (torch.Tensor): The amplitude value.
+            pixel_size (torch.Tensor, optional): Pixel sizes replacing the one of the operator, the frequency grid is rescaled on every call. Defaults to None.
+
+        Returns:
+            torch.Tensor: The CTF of shape (num_batch, num_pixels, num_pixels // 2 + 1).
+        """
+
+        freq2_2d = self.freq2_2d
+        if pixel_size is not None:
+            # rescaled in double precision, the CTF oscillates fast at high frequencies
+            pixel_size = torch.as_tensor(
+                pixel_size, dtype=torch.float64, device=freq2_2d.device
+            )
+            freq2_2d = (self._freq2_unit / pixel_size**2).to(freq2_2d.dtype)
+
+        env = torch.exp(-b_factor * freq2_2d * 0.5)
+        phase = defocus * torch.pi * 2.0 * 10000 * 0.019866  # hardcoded for 300kV
+
+        ctf = -amp * torch.cos(phase * freq2_2d * 0.5) - torch.sqrt(
+            1 - amp**2
+        ) * torch.sin(phase * freq2_2d * 0.5)
+        return ctf * env / amp
+
+    def __call__(
+        self, image: torch.Tensor, defocus, b_factor, amp, pixel_size=None
+    ) -> torch.Tensor:
+        """
+        Applies the CTF to the image.
+
+        Args:
+            image (torch.Tensor): The images to apply the CTF to (num_batch, num_pixels, num_pixels).
+            defocus (torch.Tensor): The defocus value.
+            b_factor (torch.Tensor): The B-factor value.
+            amp (torch.Tensor): The amplitude value.
+            pixel_size (torch.Tensor, optional): Pixel size replacing the one of the operator. Defaults to None.
+
+        Returns:
+            torch.Tensor: The image with the CTF applied.
+        """
+
+        conv_image_ctf = torch.fft.rfft2(image) * self.spectrum(
+            defocus, b_factor, amp, pixel_size=pixel_size
+        )
+        return torch.fft.irfft2(conv_image_ctf, s=image.shape[-2:])
+
+
+@functools.lru_cache(maxsize=16)
+def get_ctf_operator(
+    num_pixels: int, pixel_size: float, device: torch.device, dtype: torch.dtype
+) -> CTFOperator:
+    """
+    Returns a cached CTF operator for the given image geometry.
+
+    Args:
+        num_pixels (int): Number of pixels along one image side.
+        pixel_size (float): Pixel size in Angstrom.
+        device (torch.device): Device of the frequency grid.
+        dtype (torch.dtype): Data type of the frequency grid.
+
+    Returns:
+        CTFOperator: The CTF operator.
+    """
+
+    return CTFOperator(num_pixels, pixel_size, device=device, dtype=dtype)
+
+
 def apply_ctf(image: torch.Tensor, defocus, b_factor, amp, pixel_size) -> torch.Tensor:
     """
     Applies the CTF to the image.
@@ -11,31 +119,18 @@ def apply_ctf(image: torch.Tensor, defocus, b_factor, amp, pixel_size) -> torch.
         defocus (torch.Tensor): The defocus value.
         b_factor (torch.Tensor): The B-factor value.
         amp (torch.Tensor): The amplitude value.
-        pixel_size (torch.Tensor): The pixel size value.
+        pixel_size (torch.Tensor): The pixel size value, a scalar selects a cached operator.
 
     Returns:
         torch.Tensor: The image with the CTF applied.
     """
 
-    num_batch, num_pixels, _ = image.shape
-    freq_pix_1d = torch.fft.fftfreq(num_pixels, d=pixel_size, device=image.device)
-    x, y = torch.meshgrid(freq_pix_1d, freq_pix_1d, indexing="ij")
-
-    freq2_2d = x**2 + y**2
-    freq2_2d = freq2_2d.expand(num_batch, -1, -1)
-    imag = torch.zeros_like(freq2_2d, device=image.device) * 1j
+    if isinstance(pixel_size, torch.Tensor) and pixel_size.numel() > 1:
+        # varying pixel sizes rescale a grid of unit pixel size on every call
+        ctf = get_ctf_operator(image.shape[-1], 1.0, image.device, image.dtype)
+        return ctf(image, defocus, b_factor, amp, pixel_size=pixel_size)
 
-    env = torch.exp(-b_factor * freq2_2d * 0.5)
-    phase = defocus * torch.pi * 2.0 * 10000 * 0.019866  # hardcoded 0.019866 for 300kV
-
-    ctf = (
-        -amp * torch.cos(phase * freq2_2d * 0.5)
-        - torch.sqrt(1 - amp**2) * torch.sin(phase * freq2_2d * 0.5)
-        + imag
+    ctf = get_ctf_operator(
+        image.shape[-1], float(pixel_size), image.device, image.dtype
     )
-    ctf = ctf * env / amp
-
-    conv_image_ctf = torch.fft.fft2(image) * ctf
-    image_ctf = torch.fft.ifft2(conv_image_ctf).real
-
-    return image_ctf
+    return ctf(image, defocus, b_factor, amp)
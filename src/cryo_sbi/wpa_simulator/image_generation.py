@@ -1,18 +1,22 @@
+from typing import Union
 import numpy as np
 import torch
 
 
-def gen_quat() -> torch.Tensor:
+def gen_quat(generator: torch.Generator = None) -> torch.Tensor:
     """
     Generate a random quaternion.
 
+    Args:
+        generator (torch.Generator, optional): Random number generator. Defaults to None.
+
     Returns:
         quat (np.ndarray): Random quaternion
 
     """
     count = 0
     while count < 1:
-        quat = 2 * torch.rand(size=(4,)) - 1
+        quat = 2 * torch.rand(size=(4,), generator=generator) - 1
         norm = torch.sqrt(torch.sum(quat**2))
         if 0.2 <= norm <= 1.0:
             quat /= norm
@@ -99,6 +103,237 @@ def project_density(
     return image
 
 
+def project_density_chunked(
+    coords: torch.Tensor,
+    quats: torch.Tensor,
+    sigma: torch.Tensor,
+    shift: torch.Tensor,
+    num_pixels: int,
+    pixel_size: float,
+    max_memory: int = 2**28,
+    truncation: Union[float, None] = 5.0,
+) -> torch.Tensor:
+    """
+    Generate 2D projections from a set of coordinates with bounded memory.
+
+    Same projection as project_density, but the separable Gaussians are evaluated in
+    chunks over images and atoms and accumulated into a preallocated image buffer,
+    so that the temporaries never exceed max_memory bytes. With truncation, every image
+    is evaluated in one square window bounding all of its atoms plus truncation * sigma,
+    and all windows get the width of the largest one in the batch. Every atom is still
+    evaluated on every pixel of the window, so this only saves work when the models
+    are small compared to the image. The density dropped outside the window is below
+    exp(-truncation**2 / 2) per atom.
+
+    Args:
+        coords (torch.Tensor): Coordinates of the atoms in the images (num_batch, 3, num_atoms).
+        quats (torch.Tensor): Quaternions to rotate the coordinates (num_batch, 4).
+        sigma (torch.Tensor): Standard deviation of the Gaussian function used to model electron density.
+        shift (torch.Tensor): In-plane shift of the projections (num_batch, 2).
+        num_pixels (int): Number of pixels along one image size.
+        pixel_size (float): Pixel size in Angstrom
+        max_memory (int, optional): Memory budget for the temporaries in bytes. Defaults to 2**28.
+        truncation (float, optional): Truncate the Gaussians after this many sigmas. None disables truncation. Defaults to 5.0.
+
+    Returns:
+        image (torch.Tensor): Images generated from the coordinates
+    """
+
+    num_batch, _, num_atoms = coords.shape
+    num_pixels = int(num_pixels)
+    pixel_size = float(pixel_size)
+    sigma = torch.as_tensor(sigma, device=coords.device).reshape(-1, 1, 1)
+    sigma = sigma.expand(num_batch, 1, 1)
+    norm = 1 / (2 * torch.pi * sigma**2 * num_atoms)
+
+    grid_min = -pixel_size * num_pixels * 0.5
+    grid = torch.arange(num_pixels, dtype=coords.dtype, device=coords.device)
+    grid = grid * pixel_size + grid_min
+
+    rot_matrix = gen_rot_matrix(quats)
+    coords_rot = torch.bmm(rot_matrix, coords)
+    coords_rot[:, :2, :] += shift.unsqueeze(-1)
+
+    if truncation is not None:
+        # every image gets its own window, all windows have the width of the largest one
+        margin = truncation * sigma.reshape(-1)
+        x_lower, x_upper = _pixel_windows(
+            coords_rot[:, 0, :], margin, grid_min, pixel_size, num_pixels
+        )
+        y_lower, y_upper = _pixel_windows(
+            coords_rot[:, 1, :], margin, grid_min, pixel_size, num_pixels
+        )
+        width = int(torch.maximum(x_upper - x_lower, y_upper - y_lower).max())
+        x_start = x_lower.clamp(max=num_pixels - width)
+        y_start = y_lower.clamp(max=num_pixels - width)
+    else:
+        width = num_pixels
+
+    image = torch.zeros(
+        (num_batch, num_pixels, num_pixels), dtype=coords.dtype, device=coords.device
+    )
+    if width <= 0:
+        return image
+
+    # every (image, atom) pair needs one row of gauss_x and one column of gauss_y
+    max_pairs = max(1, max_memory // (2 * width * coords.element_size()))
+    batch_chunk = min(num_batch, max_pairs)
+    atom_chunk = min(num_atoms, max(1, max_pairs // batch_chunk))
+    offsets = torch.arange(width, device=coords.device)
+
+    for b_start in range(0, num_batch, batch_chunk):
+        batch = slice(b_start, b_start + batch_chunk)
+        coords_x = coords_rot[batch, 0, :]
+        coords_y = coords_rot[batch, 1, :]
+        sigma_batch = sigma[batch]
+
+        if width == num_pixels:
+            grid_x = grid.reshape(1, -1, 1)
+            grid_y = grid.reshape(1, 1, -1)
+            image_window = image[batch]
+        else:
+            rows = x_start[batch].unsqueeze(-1) + offsets
+            cols = y_start[batch].unsqueeze(-1) + offsets
+            grid_x = grid[rows].unsqueeze(-1)
+            grid_y = grid[cols].unsqueeze(1)
+            image_window = torch.zeros(
+                (len(rows), width, width), dtype=coords.dtype, device=coords.device
+            )
+
+        for a_start in range(0, num_atoms, atom_chunk):
+            atoms = slice(a_start, a_start + atom_chunk)
+            gauss_x = grid_x - coords_x[:, atoms].unsqueeze(1)
+            gauss_x.div_(sigma_batch).square_().mul_(-0.5).exp_()
+            gauss_y = coords_y[:, atoms].unsqueeze(-1) - grid_y
+            gauss_y.div_(sigma_batch).square_().mul_(-0.5).exp_()
+            image_window.baddbmm_(gauss_x, gauss_y)
+
+        image_window.mul_(norm[batch])
+        if width < num_pixels:
+            images = torch.arange(b_start, b_start + len(rows), device=coords.device)
+            image[images.reshape(-1, 1, 1), rows.unsqueeze(-1), cols.unsqueeze(1)] = (
+                image_window
+            )
+
+    return image
+
+
+def project_density_fourier(
+    coords: torch.Tensor,
+    quats: torch.Tensor,
+    sigma: torch.Tensor,
+    shift: torch.Tensor,
+    num_pixels: int,
+    pixel_size: float,
+    max_memory: int = 2**28,
+    tolerance: float = 1e-6,
+) -> torch.Tensor:
+    """
+    Generate the Fourier transforms of 2D projections from a set of coordinates.
+
+    Uses the closed form Fourier transform of the Gaussians, which gives the rfft2 of the
+    image computed by project_density up to aliasing. For atoms away from the image edges,
+    the images agree to a relative error below 2e-3 for sigma of at least one pixel and
+    below 1e-4 for sigma of at least 1.5 pixels. Smaller sigmas are undersampled by
+    project_density, and the two differ by tens of percent at a quarter pixel.
+    Frequencies at which the Gaussian envelope falls below tolerance are set to zero
+    without being evaluated, which changes the spectrum by less than tolerance times
+    its zero frequency component for any sigma.
+
+    Args:
+        coords (torch.Tensor): Coordinates of the atoms in the images (num_batch, 3, num_atoms).
+        quats (torch.Tensor): Quaternions to rotate the coordinates (num_batch, 4).
+        sigma (torch.Tensor): Standard deviation of the Gaussian function used to model electron density.
+        shift (torch.Tensor): In-plane shift of the projections (num_batch, 2).
+        num_pixels (int): Number of pixels along one image size.
+        pixel_size (float): Pixel size in Angstrom
+        max_memory (int, optional): Memory budget for the temporaries in bytes. Defaults to 2**28.
+        tolerance (float, optional): Relative cutoff of the Gaussian envelope. Defaults to 1e-6.
+
+    Returns:
+        spectrum (torch.Tensor): Fourier transforms of the images (num_batch, num_pixels, num_pixels // 2 + 1)
+    """
+
+    num_batch, _, num_atoms = coords.shape
+    num_pixels = int(num_pixels)
+    pixel_size = float(pixel_size)
+    sigma = torch.as_tensor(sigma, device=coords.device).reshape(-1, 1, 1)
+    sigma = sigma.expand(num_batch, 1, 1)
+    grid_min = -pixel_size * num_pixels * 0.5
+
+    freq_x = torch.fft.fftfreq(
+        num_pixels, d=pixel_size, device=coords.device, dtype=coords.dtype
+    )
+    freq_y = torch.fft.rfftfreq(
+        num_pixels, d=pixel_size, device=coords.device, dtype=coords.dtype
+    )
+
+    rot_matrix = gen_rot_matrix(quats)
+    coords_rot = torch.bmm(rot_matrix, coords)
+    coords_rot[:, :2, :] += shift.unsqueeze(-1)
+    coords_rot[:, :2, :] -= grid_min
+
+    # every (image, atom) pair needs one complex row and one complex column
+    max_pairs = max(1, max_memory // (4 * num_pixels * coords.element_size()))
+    batch_chunk = min(num_batch, max_pairs)
+    atom_chunk = min(num_atoms, max(1, max_pairs // batch_chunk))
+
+    spectrum = torch.zeros(
+        (num_batch, num_pixels, freq_y.shape[0]),
+        dtype=torch.complex64 if coords.dtype == torch.float32 else torch.complex128,
+        device=coords.device,
+    )
+    for b_start in range(0, num_batch, batch_chunk):
+        batch = slice(b_start, b_start + batch_chunk)
+        sigma_batch = sigma[batch]
+
+        # |f| above which exp(-2 pi^2 sigma^2 f^2) < tolerance for all images
+        max_freq = (-np.log(tolerance) / (2 * np.pi**2)) ** 0.5 / sigma_batch.min()
+        index_x = torch.nonzero(freq_x.abs() <= max_freq).flatten()
+        num_freq_y = int((freq_y <= max_freq).sum().item())
+        sub_freq_x = freq_x[index_x].reshape(1, -1, 1)
+        sub_freq_y = freq_y[:num_freq_y].reshape(1, 1, -1)
+
+        sub_spectrum = torch.zeros(
+            (sigma_batch.shape[0], index_x.shape[0], num_freq_y),
+            dtype=spectrum.dtype,
+            device=spectrum.device,
+        )
+        for a_start in range(0, num_atoms, atom_chunk):
+            atoms = slice(a_start, a_start + atom_chunk)
+            angle_x = (
+                -2 * torch.pi * sub_freq_x * coords_rot[batch, 0, atoms].unsqueeze(1)
+            )
+            angle_y = (
+                -2 * torch.pi * coords_rot[batch, 1, atoms].unsqueeze(-1) * sub_freq_y
+            )
+            phase_x = torch.polar(torch.ones_like(angle_x), angle_x)
+            phase_y = torch.polar(torch.ones_like(angle_y), angle_y)
+            sub_spectrum.baddbmm_(phase_x, phase_y)
+
+        envelope = torch.exp(
+            -2 * torch.pi**2 * sigma_batch**2 * (sub_freq_x**2 + sub_freq_y**2)
+        ) / (pixel_size**2 * num_atoms)
+        spectrum[batch, :, :num_freq_y][:, index_x] = sub_spectrum * envelope
+
+    return spectrum
+
+
+def _pixel_windows(
+    coords: torch.Tensor, margin, grid_min: float, pixel_size: float, num_pixels: int
+):
+    """
+    Returns the range of pixel indices within margin of the coordinates of every image,
+    clipped to the image.
+    """
+
+    lower = (coords.amin(dim=-1) - margin - grid_min) / pixel_size
+    upper = (coords.amax(dim=-1) + margin - grid_min) / pixel_size
+    lower = lower.floor().long().clamp(0, num_pixels)
+    upper = (upper.ceil().long() + 1).clamp(0, num_pixels)
+    return lower, upper
+
+
 '''def project_density(
     atomic_model: torch.Tensor,
     quats: torch.Tensor,
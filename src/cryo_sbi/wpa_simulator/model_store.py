@@ -0,0 +1,210 @@
+from collections import OrderedDict
+from typing import Union
+import threading
+import numpy as np
+import torch
+
+
+class MemoryMappedModels:
+    """
+    Ensemble of coarse grained models memory mapped from disk.
+
+    Only the models selected by a simulation batch are read from the file. Indexing with a
+    tensor of indices reads every distinct model once, in file order. For CUDA devices the
+    models are read into a reusable pinned staging buffer and copied asynchronously to the
+    device. Optionally, the most recently used models are kept in an LRU cache on the device,
+    so frequently simulated models are not read and copied again.
+
+    Indexing returns a float32 tensor of shape (len(index), 3, num_beads) on the device, so the
+    store can be passed to the simulators in place of the tensor of models.
+
+    Args:
+        model_file (str): Path to the model file (.npy or .pt) of shape (num_models, 3, num_beads).
+        device (str, optional): Device of the gathered models. Defaults to "cpu".
+        cache_size (int, optional): Number of models cached on the device. Defaults to 0.
+        pin_memory (bool, optional): Pin the staging buffer. Defaults to True on CUDA devices.
+    """
+
+    def __init__(
+        self,
+        model_file: str,
+        device: str = "cpu",
+        cache_size: int = 0,
+        pin_memory: Union[bool, None] = None,
+    ) -> None:
+        self.model_file = model_file
+        if model_file.endswith("npy"):
+            self._models = np.load(model_file, mmap_mode="r")
+        elif model_file.endswith("pt"):
+            self._models = torch.load(model_file, mmap=True).numpy()
+        else:
+            raise NotImplementedError(
+                "Model file format not supported. Please use .npy or .pt."
+            )
+
+        self.device = torch.device(device)
+        self.pin_memory = (
+            self.device.type == "cuda" if pin_memory is None else pin_memory
+        )
+        self.cache_size = cache_size
+        self._buffer = torch.empty(0, *self._models.shape[1:], dtype=torch.float32)
+        self._copy_done = None
+        self._cache = torch.empty(
+            cache_size, *self._models.shape[1:], dtype=torch.float32, device=self.device
+        )
+        self._cache_slots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # the file is memory mapped again by every process instead of pickling the models
+        return {
+            "model_file": self.model_file,
+            "device": str(self.device),
+            "cache_size": self.cache_size,
+            "pin_memory": self.pin_memory,
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(**state)
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size(self._models.shape)
+
+    @property
+    def ndim(self) -> int:
+        return self._models.ndim
+
+    def _stage(self, indices: np.ndarray) -> torch.Tensor:
+        """
+        Reads the models of the sorted indices from the file and moves them to the device
+        through the staging buffer.
+        """
+
+        if self.device.type == "cpu":
+            return torch.from_numpy(
+                np.ascontiguousarray(self._models[indices], dtype=np.float32)
+            )
+
+        if self._copy_done is not None:
+            # the previous copy from the buffer must finish before it is overwritten
+            self._copy_done.synchronize()
+            self._copy_done = None
+        if len(self._buffer) < len(indices):
+            self._buffer = torch.empty(
+                len(indices), *self._models.shape[1:], dtype=torch.float32
+            )
+            if self.pin_memory:
+                self._buffer = self._buffer.pin_memory()
+
+        staged = self._buffer[: len(indices)]
+        staged.numpy()[:] = self._models[indices]
+        models = staged.to(self.device, non_blocking=self.pin_memory)
+        if self.pin_memory:
+            self._copy_done = torch.cuda.Event()
+            self._copy_done.record(torch.cuda.current_stream(self.device))
+        return models
+
+    def _gather_cached(self, indices: np.ndarray) -> torch.Tensor:
+        """
+        Gathers the models of the sorted indices from the device cache and the file.
+        """
+
+        is_hit = np.array([index in self._cache_slots for index in indices.tolist()])
+        models = torch.empty(
+            len(indices),
+            *self._models.shape[1:],
+            dtype=torch.float32,
+            device=self.device,
+        )
+        if is_hit.any():
+            hit_slots = [self._cache_slots[index] for index in indices[is_hit].tolist()]
+            for index in indices[is_hit].tolist():
+                self._cache_slots.move_to_end(index)
+            models[torch.from_numpy(np.flatnonzero(is_hit)).to(self.device)] = (
+                self._cache[torch.tensor(hit_slots, device=self.device)]
+            )
+        if not is_hit.all():
+            missing = indices[~is_hit]
+            missing_models = self._stage(missing)
+            models[torch.from_numpy(np.flatnonzero(~is_hit)).to(self.device)] = (
+                missing_models
+            )
+
+            # cache the last missing models, evicting the least recently used ones
+            new_slots = []
+            for index in missing[-self.cache_size :].tolist():
+                if len(self._cache_slots) < self.cache_size:
+                    slot = len(self._cache_slots)
+                else:
+                    _, slot = self._cache_slots.popitem(last=False)
+                self._cache_slots[index] = slot
+                new_slots.append(slot)
+            self._cache[torch.tensor(new_slots, device=self.device)] = missing_models[
+                -len(new_slots) :
+            ]
+        return models
+
+    def __getitem__(self, index) -> torch.Tensor:
+        """
+        Gathers the models of the given indices.
+
+        Args:
+            index (torch.Tensor): Indices of the models.
+
+        Returns:
+            torch.Tensor: Models of shape (len(index), 3, num_beads) on the device of the store.
+        """
+
+        index = torch.as_tensor(index).long().flatten().cpu().numpy()
+        if len(index) > 0 and (index.min() < -len(self) or index.max() >= len(self)):
+            raise IndexError(f"Model index out of range for {len(self)} models.")
+        unique_indices, inverse = np.unique(index % len(self), return_inverse=True)
+
+        with self._lock:
+            if self.cache_size > 0:
+                models = self._gather_cached(unique_indices)
+            else:
+                models = self._stage(unique_indices)
+
+        if np.array_equal(inverse, np.arange(len(index))):
+            return models
+        return models[torch.from_numpy(inverse).to(self.device)]
+
+
+def load_models(
+    model_file: str,
+    device: str = "cpu",
+    mmap: bool = False,
+    cache_size: int = 0,
+) -> Union[torch.Tensor, MemoryMappedModels]:
+    """
+    Loads an ensemble of coarse grained models as float32 on the device.
+
+    Args:
+        model_file (str): Path to the model file (.npy or .pt) of shape (num_models, 3, num_beads).
+        device (str, optional): Device of the models. Defaults to "cpu".
+        mmap (bool, optional): Memory map the models with MemoryMappedModels instead of loading them. Defaults to False.
+        cache_size (int, optional): Number of models cached on the device by MemoryMappedModels. Defaults to 0.
+
+    Returns:
+        Union[torch.Tensor, MemoryMappedModels]: The models.
+    """
+
+    if mmap:
+        return MemoryMappedModels(model_file, device=device, cache_size=cache_size)
+
+    if model_file.endswith("npy"):
+        models = torch.from_numpy(np.load(model_file))
+    elif model_file.endswith("pt"):
+        models = torch.load(model_file)
+    else:
+        raise NotImplementedError(
+            "Model file format not supported. Please use .npy or .pt."
+        )
+
+    # a single conversion avoids a second full copy of the models on the device
+    return models.to(device=device, dtype=torch.float32)
@@ -44,24 +44,33 @@ def get_snr(images, snr):
     return noise_power
 
 
-def add_noise(image: torch.Tensor, snr, seed=None) -> torch.Tensor:
+def add_noise(
+    image: torch.Tensor,
+    snr,
+    seed: Union[int, None] = None,
+    generator: Union[torch.Generator, None] = None,
+) -> torch.Tensor:
     """
     Adds noise to image.
 
     Args:
         image (torch.Tensor): Image of shape (n_pixels, n_pixels).
         image_params (dict): Dictionary with image parameters.
-        seed (int, optional): Seed for random number generator. Defaults to None.
+        seed (int, optional): Seed of a generator drawing the noise, the global generator is not reseeded. Defaults to None.
+        generator (torch.Generator, optional): Random number generator on the device of the image. Defaults to None.
 
     Returns:
         image_noise (torch.Tensor): Image with noise of shape (n_pixels, n_pixels) or (n_channels, n_pixels, n_pixels).
     """
 
     if seed is not None:
-        torch.manual_seed(seed)
+        assert generator is None, "Provide either a seed or a generator."
+        generator = torch.Generator(device=image.device).manual_seed(seed)
 
     noise_power = get_snr(image, snr)
-    noise = torch.randn_like(image, device=image.device)
+    noise = torch.randn(
+        image.shape, generator=generator, dtype=image.dtype, device=image.device
+    )
 
     noise = noise * noise_power.reshape(-1, 1, 1)
 
@@ -0,0 +1,29 @@
+import json
+import itertools
+import pytest
+
+IMAGE_CONFIG_FILE = "tests/config_files/image_params_testing.json"
+
+
+@pytest.fixture
+def image_config():
+    return json.load(open(IMAGE_CONFIG_FILE))
+
+
+@pytest.fixture
+def image_config_file(tmp_path):
+    """
+    Returns a function writing the test image config with the given overrides to a new
+    file in tmp_path and returning its path.
+    """
+
+    file_number = itertools.count()
+
+    def write_image_config(**overrides):
+        config = json.load(open(IMAGE_CONFIG_FILE))
+        config.update(overrides)
+        config_file = tmp_path / f"image_params_{next(file_number)}.json"
+        json.dump(config, open(config_file, "w"))
+        return str(config_file)
+
+    return write_image_config
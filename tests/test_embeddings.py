@@ -24,3 +24,24 @@ def test_embedding(embedding_name, num_images, out_dim):
     embedding = EMBEDDING_NETS[embedding_name](out_dim)
     out = embedding(test_images).shape
     assert out == torch.Size([num_images, out_dim]), embedding_name
+
+
+@pytest.mark.parametrize(
+    ("embedding_name", "base_name", "image_size", "frequency_cutoff"),
+    [
+        ("RESNET18_FFT_FILTER_132", "RESNET18_FFT_FILTER", 132, 25),
+        ("RESNET18_FFT_FILTER_256", "RESNET18_FFT_FILTER", 256, 10),
+        ("RESNET34_FFT_FILTER_256", "RESNET34_FFT_FILTER", 256, 50),
+    ],
+)
+def test_fft_embedding_kwargs(embedding_name, base_name, image_size, frequency_cutoff):
+    embedding = EMBEDDING_NETS[embedding_name](10)
+    configured_embedding = EMBEDDING_NETS[base_name](
+        10, image_size=image_size, frequency_cutoff=frequency_cutoff
+    )
+    configured_embedding.load_state_dict(embedding.state_dict())
+    configured_embedding.eval()
+    embedding.eval()
+
+    test_images = torch.randn(2, image_size, image_size)
+    assert torch.allclose(embedding(test_images), configured_embedding(test_images))
@@ -3,6 +3,7 @@ import os
 import torch
 import numpy as np
 import json
+import mrcfile
 
 from cryo_sbi.inference.models import build_models
 from cryo_sbi.inference.models.estimator_models import NPEWithEmbedding
@@ -12,7 +13,11 @@ from cryo_sbi.utils.estimator_utils import (
     compute_latent_repr,
     evaluate_log_prob,
     load_estimator,
+    compute_cached_latent_repr,
+    hash_estimator,
+    sample_posterior_streaming,
 )
+from cryo_sbi.utils.image_utils import MRCdataset, MRCloader, LowPassFilter
 
 
 @pytest.fixture
@@ -81,3 +86,197 @@ def test_load_estimator(train_params, train_config_path):
     )
     assert isinstance(estimator, NPEWithEmbedding)
     os.remove("tests/config_files/test_estimator.estimator")
+
+
+def test_cached_latent_repr(train_params, tmp_path):
+    estimator = build_models.build_npe_flow_model(train_params)
+    estimator.eval()
+    images = torch.randn((10, 128, 128))
+
+    embeddings = compute_cached_latent_repr(
+        estimator, images, str(tmp_path), batch_size=4
+    )
+    assert embeddings.shape == torch.Size([10, train_params["OUT_DIM"]])
+    assert len(list(tmp_path.iterdir())) == 1
+    assert torch.allclose(
+        embeddings, compute_latent_repr(estimator, images, batch_size=4), atol=1e-5
+    )
+
+    # second call reads the cache, new weights or images create a new entry
+    cached = compute_cached_latent_repr(estimator, images, str(tmp_path))
+    assert torch.equal(embeddings, cached)
+    assert len(list(tmp_path.iterdir())) == 1
+    compute_cached_latent_repr(estimator, images + 1, str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
+    with torch.no_grad():
+        estimator.embedding.resnet.fc.bias.add_(1.0)
+    compute_cached_latent_repr(estimator, images, str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_cached_latent_repr_images_key(train_params, tmp_path):
+    estimator = build_models.build_npe_flow_model(train_params)
+    estimator.eval()
+    cache_dir = tmp_path / "cache"
+    prefix = "/data/particles/" + 40 * "a"
+
+    embeddings_1 = compute_cached_latent_repr(
+        estimator, torch.randn((2, 128, 128)), str(cache_dir), images_key=prefix + "/1"
+    )
+    embeddings_2 = compute_cached_latent_repr(
+        estimator, torch.randn((3, 128, 128)), str(cache_dir), images_key=prefix + "/2"
+    )
+    assert embeddings_1.shape[0] == 2 and embeddings_2.shape[0] == 3
+    assert len(list(cache_dir.iterdir())) == 2
+    assert list(tmp_path.iterdir()) == [cache_dir]
+
+
+def test_cached_latent_repr_empty(train_params, tmp_path):
+    estimator = build_models.build_npe_flow_model(train_params)
+    estimator.eval()
+
+    embeddings = compute_cached_latent_repr(
+        estimator, torch.zeros((0, 128, 128)), str(tmp_path), batch_size=4
+    )
+    assert embeddings.shape == torch.Size([0, train_params["OUT_DIM"]])
+    assert [path.name.endswith(".partial.npy") for path in tmp_path.iterdir()] == [
+        False
+    ]
+
+
+def test_hash_estimator_filter(train_params):
+    train_params["EMBEDDING"] = "RESNET18_FFT_FILTER"
+    estimator = build_models.build_npe_flow_model(train_params)
+    estimator_hash = hash_estimator(estimator)
+    assert hash_estimator(estimator) == estimator_hash
+
+    # the mask of the filter is not part of the state dict
+    estimator.embedding._fft_filter = LowPassFilter(128, 30)
+    assert hash_estimator(estimator) != estimator_hash
+
+
+def test_posterior_from_cached_latent_repr(train_params, tmp_path):
+    estimator = build_models.build_npe_flow_model(train_params)
+    estimator.eval()
+    images = torch.randn((5, 128, 128))
+    embeddings = compute_cached_latent_repr(estimator, images, str(tmp_path))
+
+    theta = torch.linspace(0, 25, 7)
+    log_probs = evaluate_log_prob(estimator, images, theta)
+    log_probs_cached = evaluate_log_prob(
+        estimator, embeddings, theta, precomputed_embeddings=True
+    )
+    assert torch.allclose(log_probs, log_probs_cached, atol=1e-4)
+
+    samples = sample_posterior(
+        estimator, embeddings, num_samples=3, precomputed_embeddings=True
+    )
+    assert samples.shape == torch.Size([3, 5])
+
+
+@pytest.mark.parametrize(
+    ("num_images", "batch_size", "max_evaluations"),
+    [(7, 3, 2**20), (7, 0, 5), (6, 4, 1)],
+)
+def test_logprob_eval_batching(train_params, num_images, batch_size, max_evaluations):
+    estimator = build_models.build_npe_flow_model(train_params)
+    estimator.eval()
+    images = torch.randn((num_images, 128, 128))
+    theta = torch.linspace(0, 25, 9)
+
+    reference = evaluate_log_prob(estimator, images, theta)
+    log_probs = evaluate_log_prob(
+        estimator,
+        images,
+        theta,
+        batch_size=batch_size,
+        max_evaluations=max_evaluations,
+    )
+    assert torch.allclose(log_probs, reference, atol=1e-4)
+
+    theta_per_image = theta.reshape(-1, 1, 1).repeat(1, num_images, 1)
+    out = torch.zeros((9, num_images))
+    log_probs = evaluate_log_prob(
+        estimator,
+        images,
+        theta_per_image,
+        batch_size=batch_size,
+        max_evaluations=max_evaluations,
+        out=out,
+    )
+    assert log_probs is out
+    assert torch.allclose(log_probs, reference, atol=1e-4)
+
+
+@pytest.fixture
+def mrc_paths(tmp_path):
+    paths = []
+    for idx, num_particles in enumerate([3, 4]):
+        path = str(tmp_path / f"particles_{idx}.mrc")
+        with mrcfile.new(path) as mrc:
+            mrc.set_data(np.random.randn(num_particles, 128, 128).astype(np.float32))
+        paths.append(path)
+    return paths
+
+
+def test_sample_posterior_streaming(train_params, mrc_paths, tmp_path):
+    estimator = build_models.build_npe_flow_model(train_params)
+    estimator.eval()
+    output_dir = str(tmp_path / "posterior")
+
+    outputs = sample_posterior_streaming(
+        estimator,
+        MRCloader(mrc_paths),
+        output_dir,
+        num_samples=20,
+        batch_size=3,
+        histogram_bins=torch.tensor([-1e9, 0.0, 1e9]),
+    )
+    assert outputs["samples"].shape == (7, 20)
+    assert outputs["quantiles"].shape == (7, 3)
+    assert np.allclose(outputs["mean"], outputs["samples"].mean(axis=1), atol=1e-5)
+    assert np.all(outputs["histogram"].sum(axis=1) == 20)
+    assert np.all(outputs["quantiles"][:, 0] <= outputs["quantiles"][:, 2])
+    with open(os.path.join(output_dir, "progress.json")) as f:
+        assert json.load(f)["completed"] == 7
+
+
+def test_sample_posterior_streaming_resume(train_params, mrc_paths, tmp_path):
+    estimator = build_models.build_npe_flow_model(train_params)
+    estimator.eval()
+    output_dir = str(tmp_path / "posterior")
+    num_batches = []
+
+    def interrupt(images):
+        num_batches.append(images.shape[0])
+        if len(num_batches) == 2:
+            raise KeyboardInterrupt
+        return images
+
+    with pytest.raises(KeyboardInterrupt):
+        sample_posterior_streaming(
+            estimator,
+            MRCdataset(mrc_paths),
+            output_dir,
+            num_samples=5,
+            batch_size=3,
+            transform=interrupt,
+        )
+    first_batch = np.load(os.path.join(output_dir, "samples.npy"))[:3].copy()
+
+    outputs = sample_posterior_streaming(
+        estimator,
+        MRCdataset(mrc_paths),
+        output_dir,
+        num_samples=5,
+        batch_size=3,
+        transform=interrupt,
+    )
+    assert num_batches == [3, 3, 3, 1]
+    assert np.array_equal(outputs["samples"][:3], first_batch)
+    assert np.all(outputs["samples"][3:] != 0)
+
+    with pytest.raises(ValueError):
+        sample_posterior_streaming(
+            estimator, MRCdataset(mrc_paths), output_dir, num_samples=6
+        )
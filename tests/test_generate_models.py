@@ -0,0 +1,146 @@
+import os
+import numpy as np
+import torch
+import pytest
+
+from cryo_sbi.utils.generate_models import (
+    pdb_parser,
+    pdb_parser_,
+    traj_parser,
+    traj_parser_,
+    models_to_tensor,
+)
+
+
+def write_pdb(fname, coords):
+    with open(fname, "w") as pdb_file:
+        for i, (x, y, z) in enumerate(coords):
+            pdb_file.write(
+                f"ATOM  {i + 1:>5d}  CA  ALA A{i + 1:>4d}    "
+                f"{x:>8.3f}{y:>8.3f}{z:>8.3f}  1.00  0.00           C\n"
+            )
+        pdb_file.write("END\n")
+
+
+@pytest.fixture
+def pdb_files(tmp_path):
+    rng = np.random.default_rng(0)
+    for i in range(1, 8):
+        write_pdb(tmp_path / f"model_{i}.pdb", 10 * rng.standard_normal((5, 3)))
+    return str(tmp_path / "model_{}.pdb")
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_pdb_parser(tmp_path, pdb_files, n_workers):
+    output_file = str(tmp_path / "models.pt")
+    pdb_parser(pdb_files, 7, output_file, n_workers=n_workers)
+
+    models = torch.load(output_file)
+    expected = torch.stack([pdb_parser_(pdb_files.format(i)) for i in range(1, 8)])
+    assert models.shape == (7, 3, 5)
+    assert torch.allclose(models, expected)
+    assert not os.path.exists(f"{output_file}.partial.npy")
+
+
+def test_pdb_parser_cache(tmp_path, pdb_files):
+    cache_dir = str(tmp_path / "cache")
+    output_file = str(tmp_path / "models.npy")
+    pdb_parser(pdb_files, 7, output_file, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 7
+
+    # a modified file is parsed again, the others are read from the cache
+    write_pdb(pdb_files.format(3), np.ones((5, 3)))
+    pdb_parser(pdb_files, 7, output_file, n_workers=2, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 8
+
+    models = np.load(output_file)
+    assert np.allclose(models[2], 0.0, atol=1e-5)
+    assert np.allclose(models[3], pdb_parser_(pdb_files.format(4)).numpy())
+
+
+def test_pdb_parser_shape_mismatch(tmp_path, pdb_files):
+    write_pdb(pdb_files.format(5), np.ones((4, 3)))
+    with pytest.raises(ValueError):
+        pdb_parser(pdb_files, 7, str(tmp_path / "models.npy"))
+
+
+def test_models_to_tensor_npy(tmp_path, pdb_files):
+    output_file = str(tmp_path / "models.npy")
+    models_to_tensor(pdb_files, output_file, n_pdbs=7, n_workers=2)
+    assert np.load(output_file).shape == (7, 3, 5)
+
+
+def write_trajectory(tmp_path, n_residues=6, n_frames=10):
+    import MDAnalysis as mda
+    from scipy.spatial.transform import Rotation
+
+    rng = np.random.default_rng(1)
+    top_file = str(tmp_path / "top.pdb")
+    with open(top_file, "w") as pdb_file:
+        for i, (x, y, z) in enumerate(10 * rng.standard_normal((3 * n_residues, 3))):
+            name = ["N", "CA", "C"][i % 3]
+            pdb_file.write(
+                f"ATOM  {i + 1:>5d}  {name:<3s} ALA A{i // 3 + 1:>4d}    "
+                f"{x:>8.3f}{y:>8.3f}{z:>8.3f}  1.00  0.00           {name[0]}\n"
+            )
+        pdb_file.write("END\n")
+
+    traj_file = str(tmp_path / "traj.trr")
+    universe = mda.Universe(top_file)
+    positions = universe.atoms.positions.copy()
+    rotations = Rotation.random(n_frames, random_state=2).as_matrix()
+    with mda.Writer(traj_file, universe.atoms.n_atoms) as writer:
+        for rotation in rotations:
+            universe.atoms.positions = (
+                positions @ rotation.T
+                + 5 * rng.standard_normal(3)
+                + rng.standard_normal(positions.shape)
+            )
+            writer.write(universe.atoms)
+    return top_file, traj_file
+
+
+def align_traj_reference(top_file, traj_file):
+    import MDAnalysis as mda
+    from MDAnalysis.analysis import align
+
+    ref = mda.Universe(top_file)
+    ref.atoms.translate(-ref.atoms.center_of_mass())
+    mobile = mda.Universe(top_file, traj_file)
+    align.AlignTraj(mobile, ref, select="name CA", in_memory=True).run()
+    return np.stack(
+        [mobile.select_atoms("name CA").positions.T for _ in mobile.trajectory]
+    )
+
+
+def test_traj_parser_matches_align_traj(tmp_path):
+    top_file, traj_file = write_trajectory(tmp_path)
+    expected = align_traj_reference(top_file, traj_file)
+
+    models = traj_parser_(top_file, traj_file, chunk_size=4)
+    assert models.shape == (10, 3, 6)
+    assert np.allclose(models.numpy(), expected, atol=1e-3)
+
+
+@pytest.mark.parametrize("output_name", ["models.npy", "models.pt"])
+def test_traj_parser_frame_range(tmp_path, output_name):
+    top_file, traj_file = write_trajectory(tmp_path)
+    expected = align_traj_reference(top_file, traj_file)[1:9:3]
+
+    output_file = str(tmp_path / output_name)
+    traj_parser(
+        top_file,
+        traj_file,
+        output_file,
+        start_frame=1,
+        stop_frame=9,
+        stride=3,
+        chunk_size=2,
+    )
+    if output_name.endswith("pt"):
+        models = torch.load(output_file).numpy()
+    else:
+        models = np.load(output_file)
+    assert models.shape == (3, 3, 6)
+    assert np.allclose(models, expected, atol=1e-3)
+    assert not os.path.exists(f"{output_file}.partial.npy")
@@ -1,4 +1,7 @@
 import pytest
+import pickle
+import numpy as np
+import mrcfile
 import torch
 from cryo_sbi.utils import image_utils as iu
 
@@ -106,3 +109,232 @@ def test_image_whithening_batched():
     images = torch.randn((10, 100, 100))
     images_whitened = whitening_transform(images)
     assert images_whitened.shape == (10, 100, 100)
+
+
+@pytest.fixture
+def mrc_stacks(tmp_path):
+    stacks = [
+        np.random.randn(3, 16, 16).astype(np.float32),
+        np.random.randn(16, 16).astype(np.float32),
+        np.random.randn(4, 16, 16).astype(np.float32),
+    ]
+    paths = []
+    for idx, stack in enumerate(stacks):
+        path = str(tmp_path / f"particles_{idx}.mrc")
+        with mrcfile.new(path) as mrc:
+            mrc.set_data(stack)
+        paths.append(path)
+    particles = np.concatenate([stack.reshape(-1, 16, 16) for stack in stacks])
+    return paths, particles
+
+
+@pytest.mark.parametrize("max_open_files", [1, 64])
+def test_mrc_dataset_get_image(mrc_stacks, max_open_files):
+    paths, particles = mrc_stacks
+    dataset = iu.MRCdataset(paths, max_open_files=max_open_files)
+    dataset.build_index_map()
+
+    for idx in range(len(particles)):
+        assert torch.equal(dataset.get_image(idx), torch.from_numpy(particles[idx]))
+
+    for idx in ([0, 1, 2], [7, 0, 3, 5, 1], np.arange(8), torch.tensor([6, 4])):
+        images = dataset.get_image(idx)
+        assert isinstance(images, torch.Tensor)
+        assert torch.equal(images, torch.from_numpy(particles[np.asarray(idx)]))
+    assert len(dataset._handles) <= max_open_files
+    dataset.close()
+    assert len(dataset._handles) == 0
+
+
+def test_mrc_dataset_pickle(mrc_stacks):
+    paths, particles = mrc_stacks
+    dataset = iu.MRCdataset(paths)
+    dataset.build_index_map()
+    dataset.get_image([0, 4])
+
+    copied_dataset = pickle.loads(pickle.dumps(dataset))
+    assert torch.equal(copied_dataset.get_image(5), torch.from_numpy(particles[5]))
+    assert torch.equal(copied_dataset[1][1], torch.from_numpy(particles[3]))
+
+
+def test_mrc_dataset_index_map(mrc_stacks, tmp_path):
+    paths, particles = mrc_stacks
+    dataset = iu.MRCdataset(paths[:2])
+    dataset.build_index_map(num_workers=2)
+    assert dataset.num_particles == 4
+    with pytest.raises(IndexError):
+        dataset.get_image(4)
+
+    dataset.add_paths(paths[2:])
+    assert dataset.num_particles == 8
+    assert torch.equal(dataset.get_image([3, 7]), torch.from_numpy(particles[[3, 7]]))
+
+    index_file = str(tmp_path / "index_map.npz")
+    dataset.save_index_map(index_file)
+    loaded_dataset = iu.MRCdataset(paths)
+    loaded_dataset.load_index_map(index_file)
+    assert loaded_dataset.num_particles == 8
+    assert torch.equal(loaded_dataset.get_image(6), torch.from_numpy(particles[6]))
+
+
+def test_mrc_dataset_load_index_map_incremental(mrc_stacks, tmp_path):
+    paths, particles = mrc_stacks
+
+    # index map with one entry per particle, as written by earlier versions
+    index_file = str(tmp_path / "index_map.npz")
+    np.savez(
+        index_file,
+        path_index=[0, 0, 0, 1],
+        file_index=[0, 1, 2, 0],
+        paths=paths[:2],
+    )
+    dataset = iu.MRCdataset(paths)
+    dataset.load_index_map(index_file)
+    assert dataset.num_particles == 8
+    assert torch.equal(dataset.get_image(np.arange(8)), torch.from_numpy(particles))
+
+    with pytest.raises(AssertionError):
+        iu.MRCdataset(paths[::-1]).load_index_map(index_file)
+
+
+@pytest.mark.parametrize(
+    ("batch_size", "num_workers", "drop_last"),
+    [(3, 0, False), (5, 0, True), (2, 2, False), (8, 0, False)],
+)
+def test_mrc_particle_loader(mrc_stacks, batch_size, num_workers, drop_last):
+    paths, particles = mrc_stacks
+    loader = iu.MRCParticleLoader(
+        paths,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        drop_last=drop_last,
+        pin_memory=False,
+    )
+
+    seen = []
+    for indices, images in loader:
+        assert images.shape[0] == indices.shape[0] <= batch_size
+        if num_workers == 0 and not drop_last:
+            assert images.shape[0] == batch_size or indices[-1] == len(particles) - 1
+        assert torch.equal(images, torch.from_numpy(particles[indices.numpy()]))
+        seen.append(indices)
+    seen = torch.cat(seen).sort().values
+    if drop_last:
+        assert len(seen) == (len(particles) // batch_size) * batch_size
+    else:
+        assert torch.equal(seen, torch.arange(len(particles)))
+
+
+def test_mrc_particle_loader_transform(mrc_stacks):
+    paths, _ = mrc_stacks
+    loader = iu.MRCParticleLoader(
+        paths,
+        batch_size=4,
+        transform=iu.NormalizeIndividual(),
+        num_workers=2,
+        pin_memory=False,
+    )
+    for _, images in loader:
+        assert images.mean(dim=[1, 2]).abs().max() < 1e-4
+
+
+def _low_pass_filter_reference(image, image_size, frequency_cutoff):
+    mask = iu.circular_mask(image_size, frequency_cutoff, inside=False)
+    fft_image = torch.fft.fftshift(torch.fft.fft2(image), dim=(-2, -1))
+    fft_image[:, mask] = 0
+    return torch.fft.ifft2(torch.fft.fftshift(fft_image, dim=(-2, -1))).real
+
+
+@pytest.mark.parametrize(
+    ("image_size", "frequency_cutoff"), [(128, 25), (132, 25), (256, 10), (100, 30)]
+)
+def test_low_pass_filter_matches_fft2(image_size, frequency_cutoff):
+    low_pass_filter = iu.LowPassFilter(image_size, frequency_cutoff)
+    images = torch.randn((3, image_size, image_size))
+
+    filtered_images = low_pass_filter(images)
+    reference = _low_pass_filter_reference(images, image_size, frequency_cutoff)
+    assert torch.allclose(filtered_images, reference, atol=1e-5)
+    assert torch.allclose(low_pass_filter(images[0]), reference[0], atol=1e-5)
+
+
+def test_transform_buffers_not_in_state_dict():
+    low_pass_filter = iu.LowPassFilter(64, 10)
+    mask = iu.Mask(64, 20)
+    assert len(low_pass_filter.state_dict()) == 0
+    assert len(mask.state_dict()) == 0
+
+    low_pass_filter.to(torch.float64)
+    assert low_pass_filter.rfft_mask.dtype == torch.float64
+
+
+def test_mask_in_place():
+    mask = iu.Mask(64, 20, inside=False)
+    images = torch.ones((2, 64, 64))
+    masked_images = mask(images)
+    assert masked_images.data_ptr() == images.data_ptr()
+    assert torch.all(masked_images[:, mask.mask] == 0)
+    assert torch.all(masked_images[:, ~mask.mask] == 1)
+
+
+def test_psd_accumulator_matches_batch_statistics(tmp_path):
+    images = torch.randn((50, 16, 16), dtype=torch.float64) * torch.linspace(1, 2, 16)
+    accumulator = iu.PSDAccumulator(tolerance=0.0)
+    for image_batch in torch.split(images, 7):
+        accumulator.update(image_batch)
+
+    psd = torch.abs(torch.fft.fft2(images)) ** 2
+    assert accumulator.count == 50
+    assert torch.allclose(accumulator.mean, psd.mean(dim=0).float(), rtol=1e-4)
+    assert torch.allclose(accumulator.variance, psd.var(dim=0).float(), rtol=1e-4)
+
+    path = str(tmp_path / "psd.pt")
+    accumulator.save(path)
+    restored = iu.PSDAccumulator.load(path)
+    restored.update(images[:5])
+    accumulator.update(images[:5])
+    assert restored.count == 55
+    assert torch.equal(restored.mean, accumulator.mean)
+
+
+def test_psd_accumulator_convergence():
+    accumulator = iu.PSDAccumulator(tolerance=1e-2, mask_radius=6)
+    num_batches = 0
+    while not accumulator.update(torch.randn((64, 16, 16))):
+        num_batches += 1
+        assert num_batches < 1000
+    assert accumulator.relative_error < 1e-2
+    # the PSD of white noise has a standard deviation close to its mean
+    assert accumulator.count > 0.5 / 1e-2**2
+    assert accumulator.mean.shape == torch.Size([16, 16])
+
+
+def _colored_noise(num_images, image_size):
+    freq = torch.fft.fftfreq(image_size)
+    spectrum = 1.0 / (0.05 + freq[:, None] ** 2 + freq[None, :] ** 2)
+    noise = torch.fft.fft2(torch.randn((num_images, image_size, image_size)))
+    return torch.fft.ifft2(noise * spectrum**0.5).real
+
+
+def test_image_whitening_fit(tmp_path):
+    images = _colored_noise(500, 32)
+    whitening_transform = iu.WhitenImage(32).fit(
+        [(None, batch) for batch in torch.split(images, 100)]
+    )
+
+    whitened_psd = (torch.abs(torch.fft.fft2(whitening_transform(images))) ** 2).mean(0)
+    colored_psd = (torch.abs(torch.fft.fft2(images)) ** 2).mean(0)
+    relative_spread = lambda psd: (psd.std() / psd.mean()).item()
+    assert relative_spread(whitened_psd) < 0.2 < relative_spread(colored_psd)
+
+    path = str(tmp_path / "whitening.pt")
+    whitening_transform.save(path)
+    loaded_transform = iu.WhitenImage.load(path)
+    assert torch.allclose(loaded_transform(images[:3]), whitening_transform(images[:3]))
+
+    # the fitted filter does not depend on the batch
+    assert torch.allclose(
+        whitening_transform(images[:2])[0],
+        whitening_transform(images[:1])[0],
+        atol=1e-5,
+    )
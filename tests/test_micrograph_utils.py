@@ -1,4 +1,6 @@
 import pytest
+import numpy as np
+import mrcfile
 import torch
 import torchvision.transforms as transforms
 from cryo_sbi.utils.image_utils import NormalizeIndividual
@@ -38,3 +40,126 @@ def test_compute_average_psd():
     )
     avg_psd = mu.compute_average_psd(random_patches)
     assert avg_psd.shape == torch.Size([10, 10])
+
+
+def _assert_patches_in_micrograph(patches, micrograph):
+    patch_size = patches.shape[-1]
+    for patch in patches:
+        top, left = divmod(int(patch[0, 0]), micrograph.shape[1])
+        assert torch.equal(
+            patch, micrograph[top : top + patch_size, left : left + patch_size]
+        )
+
+
+@pytest.mark.parametrize("batch_size", [1, 16])
+def test_random_micrograph_patches_batched(batch_size):
+    micrograph = torch.arange(100 * 120, dtype=torch.float32).reshape(100, 120)
+    random_patches = mu.RandomMicrographPatches(
+        micro_graphs=[micrograph],
+        patch_size=12,
+        transform=None,
+        max_iter=5,
+        batch_size=batch_size,
+    )
+    batches = list(random_patches)
+    assert len(batches) == 5
+    for patches in batches:
+        assert patches.shape == torch.Size([batch_size, 12, 12])
+        _assert_patches_in_micrograph(patches, micrograph)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+def test_random_micrograph_patches_cuda():
+    micrographs = [
+        torch.arange(100 * 120, dtype=torch.float32, device="cuda").reshape(100, 120),
+        torch.arange(80 * 72, dtype=torch.float32, device="cuda").reshape(80, 72),
+    ]
+    random_patches = mu.RandomMicrographPatches(
+        micro_graphs=micrographs,
+        patch_size=12,
+        transform=None,
+        max_iter=3,
+        batch_size=16,
+    )
+    for patches in random_patches:
+        assert patches.device == micrographs[0].device
+        assert patches.shape == torch.Size([16, 12, 12])
+
+
+def test_random_micrograph_patches_mmap(tmp_path):
+    micrographs = [
+        np.arange(64 * 64, dtype=np.float32).reshape(64, 64),
+        np.arange(80 * 72, dtype=np.float32).reshape(80, 72),
+    ]
+    paths = []
+    for idx, micrograph in enumerate(micrographs):
+        path = str(tmp_path / f"micrograph_{idx}.mrc")
+        with mrcfile.new(path) as mrc:
+            mrc.set_data(micrograph)
+        paths.append(path)
+
+    random_patches = mu.RandomMicrographPatches(
+        micro_graphs=paths, patch_size=16, transform=None, max_iter=3, batch_size=8
+    )
+    for patches in random_patches:
+        assert patches.shape == torch.Size([8, 16, 16])
+        for patch in patches:
+            in_micrograph = [
+                torch.any(
+                    torch.all(
+                        torch.from_numpy(micrograph).unfold(0, 16, 1).unfold(1, 16, 1)
+                        == patch,
+                        dim=-1,
+                    ).all(dim=-1)
+                )
+                for micrograph in micrographs
+            ]
+            assert any(in_micrograph)
+
+
+def test_compute_average_psd_batched():
+    images = torch.randn(20, 16, 16)
+    avg_psd = mu.compute_average_psd(images)
+    reference = torch.mean(torch.abs(torch.fft.fft2(images)) ** 2, dim=0)
+    assert torch.allclose(avg_psd, reference, rtol=1e-4, atol=1e-4)
+
+    micrograph = torch.randn(128, 128)
+    random_patches = mu.RandomMicrographPatches(
+        micro_graphs=[micrograph],
+        patch_size=15,
+        transform=None,
+        max_iter=4,
+        batch_size=32,
+    )
+    avg_psd = mu.compute_average_psd(random_patches)
+    assert avg_psd.shape == torch.Size([15, 15])
+    assert torch.allclose(avg_psd, avg_psd.flip(0, 1).roll((1, 1), dims=(0, 1)))
+
+
+def test_compute_average_psd_tolerance():
+    micrograph = torch.randn(256, 256)
+    random_patches = mu.RandomMicrographPatches(
+        micro_graphs=[micrograph],
+        patch_size=16,
+        transform=None,
+        max_iter=10000,
+        batch_size=64,
+    )
+    avg_psd = mu.compute_average_psd(random_patches, tolerance=1e-2)
+    assert avg_psd.shape == torch.Size([16, 16])
+    assert random_patches._current_iter < 10000
+
+
+def test_random_micrograph_patches_restart_after_break():
+    micrograph = torch.randn(128, 128)
+    random_patches = mu.RandomMicrographPatches(
+        micro_graphs=[micrograph],
+        patch_size=16,
+        transform=None,
+        max_iter=5,
+        batch_size=4,
+    )
+    for i, _ in enumerate(random_patches):
+        if i == 2:
+            break
+    assert len(list(random_patches)) == 5
@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+import pytest
+
+from cryo_sbi.wpa_simulator.cryo_em_simulator import CryoEmSimulator
+from cryo_sbi.wpa_simulator.model_store import MemoryMappedModels, load_models
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    models = torch.load("tests/models/hsp90_models.pt").numpy().astype(np.float64)
+    np.save(tmp_path / "models.npy", models)
+    return str(tmp_path / "models.npy")
+
+
+def test_load_models(model_file):
+    models = load_models(model_file)
+    assert models.dtype == torch.float32
+    assert models.shape == (20, 3, 1207)
+    assert torch.equal(models, load_models("tests/models/hsp90_models.pt"))
+
+    with pytest.raises(NotImplementedError):
+        load_models("models.txt")
+
+
+@pytest.mark.parametrize("cache_size", [0, 4, 32])
+@pytest.mark.parametrize("file_format", ["npy", "pt"])
+def test_memory_mapped_models(model_file, cache_size, file_format):
+    if file_format == "pt":
+        model_file = "tests/models/hsp90_models.pt"
+    models = load_models(model_file)
+    store = load_models(model_file, mmap=True, cache_size=cache_size)
+    assert isinstance(store, MemoryMappedModels)
+    assert len(store) == len(models)
+    assert store.shape == models.shape and store.ndim == 3
+
+    for _ in range(5):
+        index = torch.randint(0, len(models), (12, 1)).float()
+        gathered = store[index.round().long().flatten()]
+        assert gathered.dtype == torch.float32
+        assert torch.equal(gathered, models[index.round().long().flatten()])
+    assert len(store._cache_slots) <= cache_size
+
+    assert torch.equal(store[torch.tensor([-1, 0])], models[torch.tensor([-1, 0])])
+    with pytest.raises(IndexError):
+        store[torch.tensor([len(models)])]
+
+
+def test_simulator_mmap_models(image_config_file, model_file):
+    sim = CryoEmSimulator(image_config_file(MODEL_FILE=model_file))
+    mmap_sim = CryoEmSimulator(
+        image_config_file(MODEL_FILE=model_file, MMAP_MODELS=True, MODEL_CACHE_SIZE=8)
+    )
+    assert isinstance(mmap_sim._models, MemoryMappedModels)
+    assert mmap_sim.max_index == sim.max_index
+
+    torch.manual_seed(0)
+    images = sim.simulate(6)
+    torch.manual_seed(0)
+    mmap_images = mmap_sim.simulate(6)
+    assert torch.allclose(images, mmap_images)
@@ -26,3 +26,69 @@ def test_sample_npe_model(train_params, batch_size, sample_size):
     test_image = torch.randn((batch_size, 128, 128))
     samples = posterior_model.sample(test_image, shape=(sample_size,))
     assert samples.shape == torch.Size([sample_size, batch_size, 1])
+
+
+@pytest.mark.parametrize(
+    ("precision", "channels_last"), [("bf16", False), ("bf16", True)]
+)
+def test_npe_model_precision(train_params, precision, channels_last):
+    train_params["PRECISION"] = precision
+    train_params["CHANNELS_LAST"] = channels_last
+    posterior_model = build_models.build_npe_flow_model(train_params)
+    reference_model = build_models.build_npe_flow_model(
+        {**train_params, "PRECISION": "fp32", "CHANNELS_LAST": False}
+    )
+    reference_model.load_state_dict(posterior_model.state_dict())
+
+    test_image = torch.randn((4, 128, 128))
+    theta = torch.rand((4, 1))
+    log_prob = posterior_model(theta, test_image)
+    assert log_prob.dtype == torch.float32
+    assert posterior_model.embed(test_image).dtype == torch.float32
+    assert torch.allclose(
+        posterior_model.embed(test_image),
+        reference_model.embed(test_image),
+        atol=0.1,
+        rtol=0.1,
+    )
+    log_prob.mean().backward()
+
+
+def test_npe_model_unknown_precision(train_params):
+    train_params["PRECISION"] = "int8"
+    with pytest.raises(NotImplementedError):
+        build_models.build_npe_flow_model(train_params)
+
+
+def test_embedding_kwargs_from_config(train_params):
+    train_params["EMBEDDING"] = "RESNET18_FFT_FILTER"
+    train_params["EMBEDDING_KWARGS"] = {"image_size": 64, "frequency_cutoff": 10}
+    posterior_model = build_models.build_npe_flow_model(train_params)
+    samples = posterior_model.sample(torch.randn((2, 64, 64)), shape=(3,))
+    assert samples.shape == torch.Size([3, 2, 1])
+
+
+def test_compile_embedding(train_params):
+    posterior_model = build_models.build_npe_flow_model(train_params)
+    posterior_model.eval()
+    state_dict_keys = set(posterior_model.state_dict().keys())
+    test_image = torch.randn((2, 128, 128))
+    reference = posterior_model.embed(test_image)
+
+    posterior_model.compile_embedding(backend="eager")
+    assert set(posterior_model.state_dict().keys()) == state_dict_keys
+    assert torch.allclose(posterior_model.embed(test_image), reference, atol=1e-5)
+
+
+def test_trace_embedding(train_params, tmp_path):
+    train_params["EMBEDDING"] = "RESNET18_FFT_FILTER"
+    posterior_model = build_models.build_npe_flow_model(train_params)
+    posterior_model.eval()
+    test_image = torch.randn((2, 128, 128))
+
+    path = str(tmp_path / "embedding.pt")
+    posterior_model.trace_embedding(test_image, path=path)
+    traced_embedding = torch.jit.load(path)
+    assert torch.allclose(
+        traced_embedding(test_image), posterior_model.embed(test_image), atol=1e-5
+    )
@@ -0,0 +1,155 @@
+import pytest
+import torch
+import numpy as np
+from scipy import stats
+
+from cryo_sbi.inference.priors import (
+    gen_quats,
+    get_generator,
+    batch_generator,
+    get_image_priors,
+    QuaternionPrior,
+    PriorLoader,
+)
+from cryo_sbi.wpa_simulator.image_generation import gen_rot_matrix
+
+
+@pytest.mark.parametrize(("num_quats"), [1, 10, 1024])
+def test_gen_quats_shape(num_quats):
+    quats = gen_quats(num_quats)
+
+    assert quats.shape == torch.Size([num_quats, 4])
+    assert torch.allclose(torch.linalg.vector_norm(quats, dim=1), torch.ones(num_quats))
+
+
+def test_gen_quats_seeded():
+    quats_1 = gen_quats(100, generator=torch.Generator().manual_seed(0))
+    quats_2 = gen_quats(100, generator=torch.Generator().manual_seed(0))
+    quats_3 = gen_quats(100, generator=torch.Generator().manual_seed(1))
+
+    assert torch.equal(quats_1, quats_2)
+    assert not torch.equal(quats_1, quats_3)
+
+
+def test_quaternion_prior():
+    prior = QuaternionPrior("cpu", generator=torch.Generator().manual_seed(0))
+    quats = prior.sample((50,))
+
+    assert quats.shape == torch.Size([50, 4])
+    assert torch.equal(quats, gen_quats(50, generator=torch.Generator().manual_seed(0)))
+
+
+def test_gen_quats_uniform_on_so3():
+    num_quats = 20000
+    quats = gen_quats(num_quats, generator=torch.Generator().manual_seed(42))
+
+    # For uniform rotations the rotation angle has the CDF (theta - sin(theta)) / pi
+    angles = (2 * torch.arccos(quats[:, 0].abs().clamp(max=1.0))).numpy()
+    assert stats.kstest(angles, lambda x: (x - np.sin(x)) / np.pi).pvalue > 0.01
+
+    # A uniformly rotated unit vector is uniformly distributed on the sphere
+    rotated_z = gen_rot_matrix(quats)[:, :, 2].numpy()
+    for dim in range(3):
+        assert stats.kstest(rotated_z[:, dim], stats.uniform(-1, 2).cdf).pvalue > 0.01
+
+
+def test_image_prior_packed(image_config):
+    prior = get_image_priors(19, image_config, device="cpu")
+    packed = prior.sample_packed((100,))
+
+    assert packed.shape == torch.Size([100, prior.num_parameters])
+    assert packed.is_contiguous()
+    assert list(prior.layout.keys()) == list(prior.parameter_names)
+
+    index = packed[:, prior.layout["index"]]
+    assert ((index >= 0) & (index <= 19)).all()
+    assert (packed[:, prior.layout["amp"]] == image_config["AMP"]).all()
+    sigma = packed[:, prior.layout["sigma"]]
+    assert (
+        (sigma >= image_config["SIGMA"][0]) & (sigma <= image_config["SIGMA"][1])
+    ).all()
+    quats = packed[:, prior.layout["quaternion"]]
+    assert torch.allclose(torch.linalg.vector_norm(quats, dim=1), torch.ones(100))
+
+
+def test_image_prior_unpack(image_config):
+    prior = get_image_priors(19, image_config, device="cpu")
+    packed = prior.sample_packed((10,))
+    parameters = prior.unpack(packed)
+    expected_shapes = [(10, 1), (10, 4), (10, 1, 1), (10, 2)] + 4 * [(10, 1, 1)]
+
+    assert [tuple(param.shape) for param in parameters] == expected_shapes
+    for param in parameters:
+        assert param.data_ptr() >= packed.data_ptr()
+        assert param.data_ptr() < packed.data_ptr() + packed.nbytes
+
+
+def test_prior_loader_packed(image_config):
+    prior = get_image_priors(19, image_config, device="cpu")
+    loader = PriorLoader(prior, batch_size=16, packed=True)
+    packed = next(iter(loader))
+
+    assert packed.shape == torch.Size([16, prior.num_parameters])
+
+
+def test_get_generator():
+    sample = lambda *key: torch.rand(8, generator=get_generator(0, *key))
+
+    assert torch.equal(sample(3), sample(3))
+    assert not torch.equal(sample(3), sample(4))
+    assert not torch.equal(sample(0, 3), sample(1, 3))
+    assert not torch.equal(sample(0, 3), sample(0, 3, 1))
+
+
+def test_batch_generator():
+    sample = lambda *key: torch.rand(8, generator=batch_generator(0, *key))
+
+    assert torch.equal(sample(1, 2, "prior"), sample(1, 2, "prior"))
+    assert not torch.equal(sample(1, 2, "prior"), sample(1, 2, "noise"))
+    assert not torch.equal(sample(1, 2, "prior"), sample(1, 3, "prior"))
+    with pytest.raises(ValueError):
+        batch_generator(0, 1, 2, "shift")
+
+
+def test_image_prior_generator(image_config):
+    prior = get_image_priors(19, image_config, device="cpu")
+    packed_1 = prior.sample_packed((10,), generator=get_generator(0, 1))
+    packed_2 = prior.sample_packed((10,), generator=get_generator(0, 1))
+    packed_3 = prior.sample_packed((10,), generator=get_generator(0, 2))
+
+    assert torch.equal(packed_1, packed_2)
+    assert not torch.equal(packed_1, packed_3)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_prior_loader_seeded(image_config, num_workers):
+    prior = get_image_priors(19, image_config, device="cpu")
+    loader = PriorLoader(
+        prior, batch_size=8, packed=True, seed=0, stream=1, num_workers=num_workers
+    )
+    batches = [batch for batch, _ in zip(loader, range(4))]
+
+    # every batch can be sampled again from its number, independent of the workers
+    for batch_id, batch in enumerate(batches):
+        expected = prior.sample_packed(
+            (8,), generator=batch_generator(0, 1, batch_id, "prior")
+        )
+        assert torch.equal(batch, expected)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_prior_loader_pinned(image_config, num_workers):
+    prior = get_image_priors(19, image_config, device="cpu")
+    assert prior.sample_packed((8,), pin_memory=True).is_pinned()
+
+    loader = PriorLoader(
+        prior, batch_size=8, packed=True, pin_memory=True, num_workers=num_workers
+    )
+    packed = next(iter(loader))
+    assert packed.is_pinned()
+    assert torch.equal(packed.to("cuda", non_blocking=True).cpu(), packed)
+
+    # samples of a prior on the GPU are not pinned
+    cuda_prior = get_image_priors(19, image_config, device="cuda")
+    assert cuda_prior.sample_packed((8,), pin_memory=True).is_cuda
@@ -0,0 +1,63 @@
+import pytest
+import torch
+import numpy as np
+
+from cryo_sbi import CryoEmSimulator
+from cryo_sbi.inference.simulation_bank import SimulationBankLoader
+
+
+@pytest.fixture
+def simulation_bank(tmp_path):
+    sim = CryoEmSimulator("tests/config_files/image_params_testing.json")
+    sim.simulate_to_disk(25, str(tmp_path), shard_size=10, batch_size=4)
+    return str(tmp_path)
+
+
+def test_simulate_to_disk(simulation_bank):
+    loader = SimulationBankLoader(simulation_bank, batch_size=4, shuffle=False)
+    index = loader.dataset.index
+
+    assert index["num_simulations"] == 25
+    assert [shard["num_simulations"] for shard in index["shards"]] == [10, 10, 5]
+    assert len(loader) == 8
+
+    images = np.load(f"{simulation_bank}/images_00000.npy", mmap_mode="r")
+    assert images.shape == (10, 64, 64)
+    assert np.isfinite(images).all()
+
+
+def test_simulation_bank_loader(simulation_bank):
+    loader = SimulationBankLoader(simulation_bank, batch_size=4, seed=0)
+    amp_columns = loader.dataset.parameter_layout["amp"]
+
+    num_simulations = 0
+    for parameters, images in loader:
+        assert parameters.shape[0] == images.shape[0] <= 4
+        assert images.shape[1:] == torch.Size([64, 64])
+        assert torch.allclose(parameters[:, amp_columns], torch.tensor(0.1))
+        num_simulations += images.shape[0]
+    assert num_simulations == 25
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_simulation_bank_loader_epochs(simulation_bank, num_workers):
+    def epoch_orders(loader, num_epochs):
+        return [
+            torch.cat([parameters for parameters, _ in loader])
+            for _ in range(num_epochs)
+        ]
+
+    loader = SimulationBankLoader(
+        simulation_bank, batch_size=4, seed=0, num_workers=num_workers
+    )
+    first_epoch, second_epoch = epoch_orders(loader, 2)
+    assert not torch.equal(first_epoch, second_epoch)
+    assert torch.equal(
+        torch.sort(first_epoch, dim=0).values, torch.sort(second_epoch, dim=0).values
+    )
+
+    # the order of every epoch is reproduced from the seed
+    loader = SimulationBankLoader(
+        simulation_bank, batch_size=4, seed=0, num_workers=num_workers
+    )
+    assert torch.equal(epoch_orders(loader, 2)[1], second_epoch)
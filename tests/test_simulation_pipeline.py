@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from cryo_sbi.inference.simulation_pipeline import SimulationPipeline, ThroughputCounter
+
+
+def make_simulate_batch(batch_size=4):
+    counter = iter(range(10**6))
+
+    def simulate_batch():
+        idx = next(counter)
+        return torch.full((batch_size, 1), float(idx)), torch.randn(batch_size, 8, 8)
+
+    return simulate_batch
+
+
+@pytest.mark.parametrize(("prefetch"), [0, 1, 3])
+def test_simulation_pipeline_batches(prefetch):
+    pipeline = SimulationPipeline(make_simulate_batch(), prefetch=prefetch)
+
+    for epoch in range(2):
+        batches = list(pipeline.batches(5))
+        assert len(batches) == 5
+        assert [batch[0][0].item() for batch in batches] == list(
+            range(5 * epoch, 5 * epoch + 5)
+        )
+    assert pipeline.simulation.num_items == 40
+    assert pipeline.simulation.rate > 0
+
+
+def test_simulation_pipeline_early_stop():
+    pipeline = SimulationPipeline(make_simulate_batch(), prefetch=2)
+    for i, _ in enumerate(pipeline.batches(100)):
+        if i == 2:
+            break
+    assert len(list(pipeline.batches(3))) == 3
+
+
+def test_simulation_pipeline_error():
+    def simulate_batch():
+        raise RuntimeError("simulation failed")
+
+    pipeline = SimulationPipeline(simulate_batch, prefetch=2)
+    with pytest.raises(RuntimeError, match="simulation failed"):
+        list(pipeline.batches(3))
+
+
+def test_throughput_counter():
+    counter = ThroughputCounter()
+    counter.add(10, 2.0)
+    with counter.measure(5):
+        pass
+
+    assert counter.num_items == 15
+    assert counter.rate > 0
+    counter.reset()
+    assert counter.rate == 0.0
@@ -0,0 +1,68 @@
+import torch
+import pytest
+
+from cryo_sbi.inference.priors import batch_generator
+from cryo_sbi.inference.simulation_workers import SimulationWorkerPool
+from cryo_sbi.wpa_simulator.model_store import load_models
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_simulation_worker_pool(image_config, mmap):
+    models = load_models(image_config["MODEL_FILE"], mmap=mmap)
+    with SimulationWorkerPool(
+        models, image_config, batch_size=4, num_workers=2, num_threads=1, seed=0
+    ) as pool:
+        for epoch in range(2):
+            batches = list(pool.batches(3))
+            assert len(batches) == 3
+            for parameters, images in batches:
+                assert parameters.shape == (4, pool.prior.num_parameters)
+                assert images.shape == (4, 64, 64)
+                assert torch.isfinite(images).all()
+                index = pool.prior.unpack(parameters)[0]
+                assert ((index >= 0) & (index <= len(models) - 1)).all()
+    assert pool.simulation.num_items == 24
+    assert pool.simulation.rate > 0
+
+
+def test_simulation_worker_pool_error(image_config):
+    image_config["WHITENING_FILTER"] = "missing_whitening_filter.pt"
+    models = load_models(image_config["MODEL_FILE"])
+    pool = SimulationWorkerPool(
+        models, image_config, batch_size=4, num_workers=1, num_threads=1
+    )
+    with pytest.raises(RuntimeError, match="Simulation worker failed"):
+        list(pool.batches(1))
+    pool.close()
+
+
+def test_simulation_worker_pool_seeded(image_config):
+    models = load_models(image_config["MODEL_FILE"])
+    with SimulationWorkerPool(
+        models,
+        image_config,
+        batch_size=4,
+        num_workers=2,
+        num_threads=1,
+        seed=0,
+        stream=3,
+    ) as pool:
+        batches = list(pool.batches(4))
+
+    # the batches are yielded in the order of the stream, regardless of the workers
+    for batch_id, (parameters, _) in enumerate(batches):
+        expected = pool.prior.sample_packed(
+            (4,), generator=batch_generator(0, 3, batch_id, "prior")
+        )
+        assert torch.equal(parameters, expected)
+
+
+def test_simulation_worker_pool_num_threads(image_config, monkeypatch):
+    models = load_models(image_config["MODEL_FILE"])
+    monkeypatch.setattr("os.cpu_count", lambda: 16)
+    monkeypatch.setattr(torch, "get_num_threads", lambda: 4)
+
+    pool = SimulationWorkerPool(models, image_config, batch_size=4, num_workers=3)
+    assert pool.num_threads == 4
+    pool = SimulationWorkerPool(models, image_config, batch_size=4, num_workers=16)
+    assert pool.num_threads == 1
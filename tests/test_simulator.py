@@ -3,16 +3,23 @@ import torch
 import numpy as np
 import json
 
-from cryo_sbi.wpa_simulator.cryo_em_simulator import cryo_em_simulator, CryoEmSimulator
-from cryo_sbi.wpa_simulator.ctf import apply_ctf
+from cryo_sbi.wpa_simulator.cryo_em_simulator import (
+    cryo_em_simulator,
+    cryo_em_simulator_fourier,
+    CryoEmSimulator,
+)
+from cryo_sbi.wpa_simulator.ctf import apply_ctf, get_ctf_operator
 from cryo_sbi.wpa_simulator.image_generation import (
     project_density,
+    project_density_chunked,
+    project_density_fourier,
     gen_quat,
     gen_rot_matrix,
 )
 from cryo_sbi.wpa_simulator.noise import add_noise, circular_mask, get_snr
 from cryo_sbi.wpa_simulator.normalization import gaussian_normalize_image
-from cryo_sbi.inference.priors import get_image_priors
+from cryo_sbi.inference.priors import get_image_priors, gen_quats
+from cryo_sbi.utils.image_utils import WhitenImage
 
 
 def test_apply_ctf():
@@ -33,6 +40,80 @@ def test_apply_ctf():
     assert not torch.allclose(image_ctf, image)
 
 
+def apply_ctf_full_fft(image, defocus, b_factor, amp, pixel_size):
+    num_pixels = image.shape[-1]
+    freq_pix_1d = torch.fft.fftfreq(num_pixels, d=pixel_size, dtype=image.dtype)
+    x, y = torch.meshgrid(freq_pix_1d, freq_pix_1d, indexing="ij")
+    freq2_2d = x**2 + y**2
+
+    env = torch.exp(-b_factor * freq2_2d * 0.5)
+    phase = defocus * torch.pi * 2.0 * 10000 * 0.019866
+    ctf = -amp * torch.cos(phase * freq2_2d * 0.5) - torch.sqrt(
+        1 - amp**2
+    ) * torch.sin(phase * freq2_2d * 0.5)
+    ctf = ctf * env / amp
+    return torch.fft.ifft2(torch.fft.fft2(image) * ctf).real
+
+
+@pytest.mark.parametrize(("num_pixels"), [64, 65])
+@pytest.mark.parametrize(
+    ("pixel_size"), [2.06, torch.tensor(2.06, dtype=torch.float64)]
+)
+def test_apply_ctf_matches_full_fft(num_pixels, pixel_size):
+    # double precision, the phase of the CTF is too large for a float32 comparison
+    image = torch.randn(3, num_pixels, num_pixels, dtype=torch.float64)
+    defocus = torch.tensor([1.0, 2.0, 3.0], dtype=torch.float64).reshape(-1, 1, 1)
+    b_factor = torch.tensor([1.0, 50.0, 100.0], dtype=torch.float64).reshape(-1, 1, 1)
+    amp = torch.tensor([0.1, 0.1, 0.1], dtype=torch.float64).reshape(-1, 1, 1)
+
+    image_ctf = apply_ctf(image, defocus, b_factor, amp, pixel_size)
+    expected = apply_ctf_full_fft(image, defocus, b_factor, amp, pixel_size)
+
+    assert torch.allclose(image_ctf, expected, atol=1e-4)
+
+
+def test_ctf_operator_cached():
+    ctf_1 = get_ctf_operator(64, 2.06, torch.device("cpu"), torch.float32)
+    ctf_2 = get_ctf_operator(64, 2.06, torch.device("cpu"), torch.float32)
+    ctf_3 = get_ctf_operator(64, 1.0, torch.device("cpu"), torch.float32)
+
+    assert ctf_1 is ctf_2
+    assert ctf_1 is not ctf_3
+    assert ctf_1.freq2_2d.shape == torch.Size([64, 33])
+
+
+def test_apply_ctf_tensor_pixel_size_cached():
+    image = torch.randn(2, 32, 32)
+    defocus = torch.tensor([1.0, 2.0]).reshape(-1, 1, 1)
+    b_factor = torch.tensor([50.0, 100.0]).reshape(-1, 1, 1)
+    amp = torch.tensor([0.1, 0.1]).reshape(-1, 1, 1)
+
+    apply_ctf(image, defocus, b_factor, amp, torch.tensor(1.7))
+    hits = get_ctf_operator.cache_info().hits
+    apply_ctf(image, defocus, b_factor, amp, torch.tensor(1.7))
+
+    assert get_ctf_operator.cache_info().hits == hits + 1
+
+
+def test_apply_ctf_varying_pixel_size():
+    image = torch.randn(2, 32, 32, dtype=torch.float64)
+    defocus = torch.tensor([1.0, 2.0], dtype=torch.float64).reshape(-1, 1, 1)
+    b_factor = torch.tensor([50.0, 100.0], dtype=torch.float64).reshape(-1, 1, 1)
+    amp = torch.tensor([0.1, 0.1], dtype=torch.float64).reshape(-1, 1, 1)
+    pixel_size = torch.tensor([1.5, 2.06], dtype=torch.float64).reshape(-1, 1, 1)
+
+    image_ctf = apply_ctf(image, defocus, b_factor, amp, pixel_size)
+    for i in range(2):
+        expected = apply_ctf_full_fft(
+            image[i : i + 1],
+            defocus[i],
+            b_factor[i],
+            amp[i],
+            float(pixel_size[i]),
+        )
+        assert torch.allclose(image_ctf[i : i + 1], expected, atol=1e-4)
+
+
 def test_gen_rot_matrix():
     # Create a test quaternion
     quat = torch.tensor([[1.0, 0.0, 0.0, 0.0]])
@@ -98,3 +179,166 @@ def test_simulator_custom_indices(num_images):
 
     assert (parameters[0] == test_indices).all().item()
     assert images.shape == torch.Size([num_images, 64, 64])
+
+
+@pytest.mark.parametrize(
+    ("max_memory", "truncation"), [(2**28, None), (2**28, 5.0), (10000, 5.0), (1, 5.0)]
+)
+@pytest.mark.parametrize("num_pixels", [64, 256])
+def test_project_density_chunked(max_memory, truncation, num_pixels):
+    models = torch.load("tests/models/hsp90_models.pt").to(torch.float32)
+    num_images = 8
+    generator = torch.Generator().manual_seed(0)
+    coords = models[torch.randint(0, len(models), (num_images,), generator=generator)]
+    quats = gen_quats(num_images, generator=generator)
+    sigma = torch.linspace(0.5, 5.0, num_images).reshape(-1, 1, 1)
+    shift = 10 * torch.randn(num_images, 2, generator=generator)
+    num_pixels = torch.tensor(num_pixels)
+    pixel_size = torch.tensor(2.06)
+
+    image = project_density(coords.clone(), quats, sigma, shift, num_pixels, pixel_size)
+    image_chunked = project_density_chunked(
+        coords.clone(),
+        quats,
+        sigma,
+        shift,
+        num_pixels,
+        pixel_size,
+        max_memory=max_memory,
+        truncation=truncation,
+    )
+
+    assert image_chunked.shape == image.shape
+    assert torch.allclose(image_chunked, image, atol=1e-4 * image.abs().max())
+
+
+def test_simulator_projection_memory(image_config_file):
+    sim = CryoEmSimulator(image_config_file(MAX_PROJECTION_MEMORY=2**16))
+    images = sim.simulate(5)
+    assert images.shape == torch.Size([5, 64, 64])
+
+
+@pytest.mark.parametrize(("sigma_min", "tolerance"), [(2.06, 2e-3), (3.0, 1e-4)])
+def test_project_density_fourier(sigma_min, tolerance):
+    models = torch.load("tests/models/hsp90_models.pt").to(torch.float32)
+    num_images = 8
+    generator = torch.Generator().manual_seed(0)
+    coords = models[torch.randint(0, len(models), (num_images,), generator=generator)]
+    quats = gen_quats(num_images, generator=generator)
+    sigma = torch.linspace(sigma_min, 5.0, num_images).reshape(-1, 1, 1)
+    shift = 10 * torch.randn(num_images, 2, generator=generator)
+    num_pixels = torch.tensor(128)
+    pixel_size = torch.tensor(2.06)
+
+    image = project_density(coords.clone(), quats, sigma, shift, num_pixels, pixel_size)
+    spectrum = project_density_fourier(
+        coords.clone(), quats, sigma, shift, num_pixels, pixel_size, max_memory=2**20
+    )
+    image_ctf = apply_ctf(
+        image, torch.tensor(2.0), torch.tensor(50.0), torch.tensor(0.1), pixel_size
+    )
+    image_ctf_fourier = apply_ctf(
+        torch.fft.irfft2(spectrum, s=(128, 128)),
+        torch.tensor(2.0),
+        torch.tensor(50.0),
+        torch.tensor(0.1),
+        pixel_size,
+    )
+
+    assert spectrum.shape == torch.Size([num_images, 128, 65])
+    assert torch.allclose(
+        image_ctf_fourier, image_ctf, atol=tolerance * image_ctf.abs().max()
+    )
+
+
+@pytest.mark.parametrize("sigma", [0.5, 2.06, 5.0])
+def test_project_density_fourier_tolerance(sigma):
+    models = torch.load("tests/models/hsp90_models.pt").to(torch.float32)
+    num_images = 4
+    generator = torch.Generator().manual_seed(0)
+    coords = models[torch.randint(0, len(models), (num_images,), generator=generator)]
+    quats = gen_quats(num_images, generator=generator)
+    shift = 10 * torch.randn(num_images, 2, generator=generator)
+    tolerance = 1e-6
+
+    spectrum = project_density_fourier(
+        coords.clone(), quats, sigma, shift, 128, 2.06, tolerance=tolerance
+    )
+    spectrum_full = project_density_fourier(
+        coords.clone(), quats, sigma, shift, 128, 2.06, tolerance=1e-300
+    )
+    max_error = (spectrum - spectrum_full).abs().amax(dim=(1, 2))
+    zero_freq = spectrum_full[:, 0, 0].abs()
+
+    assert (max_error <= tolerance * zero_freq).all()
+
+
+def test_simulator_fourier(image_config_file):
+    sim = CryoEmSimulator(image_config_file(FOURIER_SIMULATION=True))
+    images = sim.simulate(5)
+    assert images.shape == torch.Size([5, 64, 64])
+    assert torch.isfinite(images).all()
+
+
+@pytest.mark.parametrize("fourier_simulation", [False, True])
+def test_simulator_whitening_filter(tmp_path, image_config_file, fourier_simulation):
+    sim = CryoEmSimulator(image_config_file(FOURIER_SIMULATION=fourier_simulation))
+
+    # a flat noise PSD leaves the images unchanged
+    whitening = WhitenImage(64)
+    whitening.set_noise_psd(torch.ones(64, 64))
+    whitening.save(str(tmp_path / "whitening.pt"))
+    whitened_sim = CryoEmSimulator(
+        image_config_file(
+            FOURIER_SIMULATION=fourier_simulation,
+            WHITENING_FILTER=str(tmp_path / "whitening.pt"),
+        )
+    )
+
+    torch.manual_seed(0)
+    images = sim.simulate(4)
+    torch.manual_seed(0)
+    whitened_images = whitened_sim.simulate(4)
+    assert torch.allclose(images, whitened_images, atol=1e-4)
+
+
+def test_simulator_whitening_filter_size(tmp_path, image_config_file):
+    whitening = WhitenImage(32)
+    whitening.set_noise_psd(torch.ones(32, 32))
+    whitening.save(str(tmp_path / "whitening.pt"))
+
+    with pytest.raises(ValueError):
+        CryoEmSimulator(
+            image_config_file(WHITENING_FILTER=str(tmp_path / "whitening.pt"))
+        )
+
+
+def test_add_noise_generator():
+    images = torch.randn(4, 32, 32)
+    snr = torch.full((4, 1, 1), -1.0)
+
+    torch.manual_seed(0)
+    expected_state = torch.random.get_rng_state()
+    noisy_1 = add_noise(images, snr, seed=1)
+    assert torch.equal(torch.random.get_rng_state(), expected_state)
+
+    noisy_2 = add_noise(images, snr, generator=torch.Generator().manual_seed(1))
+    assert torch.equal(noisy_1, noisy_2)
+    assert not torch.equal(noisy_1, add_noise(images, snr, seed=2))
+
+
+@pytest.mark.parametrize("fourier_simulation", [False, True])
+def test_simulator_seeded(image_config_file, fourier_simulation):
+    sim = CryoEmSimulator(image_config_file(FOURIER_SIMULATION=fourier_simulation))
+
+    images, parameters = sim.simulate(9, batch_size=3, seed=0, return_parameters=True)
+    assert torch.equal(images, sim.simulate(9, batch_size=3, seed=0))
+    assert not torch.equal(images, sim.simulate(9, batch_size=3, seed=1))
+
+    # a single batch is simulated again from its number
+    batch_images, batch_parameters = sim.simulate(
+        3, batch_size=3, seed=0, first_batch=2, return_parameters=True
+    )
+    assert torch.equal(batch_images, images[6:])
+    for param, batch_param in zip(parameters, batch_parameters):
+        assert torch.equal(batch_param, param[6:])
@@ -0,0 +1,112 @@
+import os
+import json
+import socket
+import torch
+import torch.multiprocessing as mp
+
+import cryo_sbi.inference.train_npe_model as train_npe_model
+from cryo_sbi import CryoEmSimulator
+from cryo_sbi.wpa_simulator.model_store import load_models
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def train_rank(rank, world_size, directory, train_kwargs):
+    # keeps the estimator of every rank to compare the parameters after training
+    estimators = []
+    load_model = train_npe_model.load_model
+
+    def keep_model(*args):
+        estimators.append(load_model(*args))
+        return estimators[-1]
+
+    train_npe_model.load_model = keep_model
+    torch.set_num_threads(1)
+    train_npe_model.npe_train_no_saving(
+        world_size=world_size,
+        rank=rank,
+        estimator_file=os.path.join(directory, f"estimator_{rank}.pt"),
+        loss_file=os.path.join(directory, f"loss_{rank}.pt"),
+        **train_kwargs,
+    )
+    torch.save(
+        estimators[0].state_dict(), os.path.join(directory, f"parameters_{rank}.pt")
+    )
+
+
+def test_npe_train_distributed_gloo(tmp_path, monkeypatch):
+    train_config = json.load(
+        open("tests/config_files/training_params_npe_testing.json")
+    )
+    train_config.update(
+        EMBEDDING="ConvEncoder_Tutorial",
+        OUT_DIM=16,
+        NUM_TRANSFORM=1,
+        NUM_HIDDEN_FLOW=1,
+        HIDDEN_DIM_FLOW=16,
+        BATCH_SIZE=2,
+    )
+    train_config_file = str(tmp_path / "train_params.json")
+    json.dump(train_config, open(train_config_file, "w"))
+    train_kwargs = dict(
+        image_config="tests/config_files/image_params_testing.json",
+        train_config=train_config_file,
+        epochs=1,
+        n_workers=0,
+        saving_frequency=10,
+        simulation_batch_size=2,
+        seed=0,
+    )
+
+    monkeypatch.setenv("MASTER_ADDR", "127.0.0.1")
+    monkeypatch.setenv("MASTER_PORT", str(free_port()))
+    mp.spawn(train_rank, args=(2, str(tmp_path), train_kwargs), nprocs=2, join=True)
+
+    # the ranks start from different initializations, DDP keeps them in sync
+    parameters = [torch.load(tmp_path / f"parameters_{rank}.pt") for rank in range(2)]
+    assert parameters[0].keys() == parameters[1].keys()
+    for name in parameters[0]:
+        assert torch.equal(parameters[0][name], parameters[1][name])
+
+    assert os.path.exists(tmp_path / "estimator_0.pt")
+    assert os.path.exists(tmp_path / "loss_0.pt")
+    assert os.path.exists(tmp_path / "estimator_0.pt_epoch=0")
+    assert not os.path.exists(tmp_path / "estimator_1.pt")
+    assert not os.path.exists(tmp_path / "estimator_1.pt_epoch=0")
+    assert not os.path.exists(tmp_path / "loss_1.pt")
+    estimator = torch.load(tmp_path / "estimator_0.pt")
+    for name in parameters[0]:
+        assert torch.equal(estimator[name], parameters[0][name])
+
+
+def test_seeded_simulation_paths_agree(image_config, image_config_file):
+    # batch i of stream 1 is the same for simulate, the training and the worker pool
+    sim = CryoEmSimulator(image_config_file())
+    images, parameters = sim.simulate(
+        12, batch_size=4, seed=0, stream=1, return_parameters=True
+    )
+    packed = torch.cat([param.reshape(12, -1) for param in parameters], dim=1)
+
+    models = load_models(image_config["MODEL_FILE"])
+    pipeline = train_npe_model.build_simulation_pipeline(
+        image_config, models, 4, seed=0, stream=1
+    )
+    for batch_id, (batch_packed, batch_images) in enumerate(pipeline.batches(3)):
+        assert torch.equal(batch_packed, packed[4 * batch_id : 4 * batch_id + 4])
+        assert torch.allclose(
+            batch_images, images[4 * batch_id : 4 * batch_id + 4], atol=1e-5
+        )
+
+    pool = train_npe_model.build_simulation_pipeline(
+        image_config, models, 4, simulation_workers=2, seed=0, stream=1
+    )
+    with pool:
+        for batch_id, (batch_packed, batch_images) in enumerate(pool.batches(3)):
+            assert torch.equal(batch_packed, packed[4 * batch_id : 4 * batch_id + 4])
+            assert torch.allclose(
+                batch_images, images[4 * batch_id : 4 * batch_id + 4], atol=1e-5
+            )